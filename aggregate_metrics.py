@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import math
+from argparse import ArgumentParser
+
+
+def load_sidecars(paths):
+    """
+    Reads the JSON metrics sidecars of the jobs, from files or recursively from directories.
+    Other JSON files (predictions) are skipped.
+    """
+    files = []
+    for metrics_path in paths:
+        if os.path.isdir(metrics_path):
+            for root, _, names in os.walk(metrics_path):
+                files.extend(os.path.join(root, name) for name in names if name.endswith(".json"))
+        else:
+            files.append(metrics_path)
+
+    sidecars = []
+    for metrics_file in sorted(files):
+        try:
+            with open(metrics_file, "r") as f:
+                metrics = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if isinstance(metrics, dict) and "stage" in metrics and "phases" in metrics:
+            sidecars.append(metrics)
+    return sidecars
+
+
+def percentile(values, q):
+    """Nearest rank percentile of a list of values."""
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100.0 * len(values)) - 1)]
+
+
+def input_files(job):
+    """
+    Number of input files passed to a job, as workflow_generator.py counts them for the
+    estimates and resource requests. Older sidecars only have the `files` counter.
+    """
+    if job.get("input_files") is not None:
+        return job["input_files"]
+    return job["counters"].get("files", 0)
+
+
+def group_by_stage(sidecars):
+    stages = {}
+    for metrics in sidecars:
+        stages.setdefault(metrics["stage"], []).append(metrics)
+    return stages
+
+
+def aggregate(sidecars):
+    """
+    Aggregates the sidecars per stage.
+
+    Returns:
+        Dictionary of stage to job time distribution, peak memory, per phase totals and
+        share of the job time, counter totals and rates per second of job time.
+    """
+    report = {}
+    for stage, jobs in sorted(group_by_stage(sidecars).items()):
+        wall = [job["wall_s"] for job in jobs]
+        total_wall = sum(wall)
+        phases, counters = {}, {}
+        for job in jobs:
+            for name, phase in job["phases"].items():
+                total = phases.setdefault(name, {"wall_s": 0.0, "cpu_s": 0.0, "calls": 0})
+                for k in total:
+                    total[k] += phase[k]
+            for name, value in job["counters"].items():
+                counters[name] = counters.get(name, 0) + value
+        for phase in phases.values():
+            phase["share"] = phase["wall_s"] / total_wall if total_wall else 0.0
+
+        report[stage] = {
+            "jobs": len(jobs),
+            "wall_s": {"total": total_wall, "mean": total_wall / len(jobs), "p50": percentile(wall, 50), "p95": percentile(wall, 95), "max": max(wall)},
+            "cpu_s": sum(job["cpu_s"] + job.get("children_cpu_s", 0) for job in jobs) / len(jobs),
+            "peak_rss_kb": {"mean": sum(job["peak_rss_kb"] for job in jobs) / len(jobs), "max": max(job["peak_rss_kb"] for job in jobs)},
+            "phases": phases,
+            "counters": counters,
+            "rates": {f"{name}_per_s": value / total_wall for name, value in counters.items() if total_wall},
+        }
+    return report
+
+
+def fit_coefficients(sidecars):
+    """
+    Fits the per stage coefficients of the `--dry-run` estimates of workflow_generator.py.
+
+    The CPU seconds of a job (with its ffmpeg children) are fitted by least squares as a
+    fixed part per job plus a part per input file. When the jobs of a stage all have the
+    same number of files, or the fit is negative, the whole time is attributed to the files.
+    """
+    coefficients = {}
+    for stage, jobs in sorted(group_by_stage(sidecars).items()):
+        files = [input_files(job) for job in jobs]
+        cpu = [job["cpu_s"] + job.get("children_cpu_s", 0) for job in jobs]
+        written = sum(job["counters"].get("bytes_written", 0) for job in jobs)
+        mean_files, mean_cpu = sum(files) / len(jobs), sum(cpu) / len(jobs)
+
+        if not sum(files):
+            coefficients[stage] = {"job_cpu_s": mean_cpu, "file_cpu_s": 0.0, "file_output_bytes": 0.0}
+            continue
+
+        job_cpu, file_cpu = -1.0, -1.0
+        variance = sum((f - mean_files) ** 2 for f in files)
+        if variance > 0:
+            file_cpu = sum((f - mean_files) * (c - mean_cpu) for f, c in zip(files, cpu)) / variance
+            job_cpu = mean_cpu - file_cpu * mean_files
+        if job_cpu < 0 or file_cpu < 0:
+            job_cpu, file_cpu = 0.0, sum(cpu) / sum(files)
+
+        coefficients[stage] = {"job_cpu_s": job_cpu, "file_cpu_s": file_cpu, "file_output_bytes": written / sum(files)}
+    return coefficients
+
+
+def fit_resource_profile(sidecars, headroom=1.25):
+    """
+    Fits the per stage resource profile of `--resource-profile` of workflow_generator.py.
+
+    Cores are the CPU time over the wall time of the busiest job, rounded. Memory is
+    a part per input file, the least squares slope of the peak RSS (of the job or its
+    children), plus the largest remainder, so that it covers every measured job. Disk is
+    the largest bytes read, fetched and written per input file, on top of the base disk
+    of the built-in profile. Memory and disk get `headroom` on top.
+    """
+    profile = {}
+    for stage, jobs in sorted(group_by_stage(sidecars).items()):
+        files = [input_files(job) for job in jobs]
+        rss_mb = [max(job["peak_rss_kb"], job.get("children_peak_rss_kb", 0)) / 1024 for job in jobs]
+        mean_files, mean_rss = sum(files) / len(jobs), sum(rss_mb) / len(jobs)
+
+        memory_per_file = 0.0
+        variance = sum((f - mean_files) ** 2 for f in files)
+        if variance > 0:
+            memory_per_file = max(0.0, sum((f - mean_files) * (r - mean_rss) for f, r in zip(files, rss_mb)) / variance)
+        memory = max(r - memory_per_file * f for f, r in zip(files, rss_mb))
+
+        disk_per_file = max((sum(job["counters"].get(name, 0) for name in ("bytes_read", "bytes_fetched", "bytes_written")) / f / 2**20 if f else 0.0) for f, job in zip(files, jobs))
+        cpus = max(round((job["cpu_s"] + job.get("children_cpu_s", 0)) / job["wall_s"]) if job["wall_s"] > 0 else 1 for job in jobs)
+
+        profile[stage] = {
+            "cpus": max(1, cpus),
+            "memory_mb": math.ceil(memory * headroom),
+            "memory_mb_per_file": memory_per_file * headroom,
+            "disk_mb_per_file": disk_per_file * headroom,
+            "disk_mb_per_input_mb": 0.0,
+        }
+    return profile
+
+
+def print_report(report):
+    for stage, stats in report.items():
+        wall = stats["wall_s"]
+        print("{}: {} jobs, wall mean {:.2f}s p50 {:.2f}s p95 {:.2f}s max {:.2f}s, cpu mean {:.2f}s, peak rss max {:.0f} MB".format(
+            stage, stats["jobs"], wall["mean"], wall["p50"], wall["p95"], wall["max"], stats["cpu_s"], stats["peak_rss_kb"]["max"] / 1024))
+        for name, phase in sorted(stats["phases"].items(), key=lambda x: -x[1]["wall_s"]):
+            print("    {:<16} {:10.2f}s wall {:10.2f}s cpu {:6.1%} {:>8} calls".format(name, phase["wall_s"], phase["cpu_s"], phase["share"], phase["calls"]))
+        for name, value in sorted(stats["rates"].items()):
+            print("    {:<24} {:.2f}".format(name, value))
+
+
+def main():
+    parser = ArgumentParser(description="Aggregate the metrics sidecars of an orcasound workflow into a per stage report")
+    parser.add_argument("-i", "--input", metavar="INPUT_PATH", nargs='+', required=True, help="Metrics sidecars, or directories searched recursively for them (e.g. the output directory).")
+    parser.add_argument("-o", "--output", metavar="OUTPUT_FILE", type=str, default=None, help="Write the report as JSON to this file.")
+    parser.add_argument("-r", "--resource-profile", metavar="OUTPUT_FILE", type=str, default=None, help="Write the per stage resource profile of workflow_generator.py --resource-profile to this file.")
+    parser.add_argument("-c", "--coefficients", metavar="OUTPUT_FILE", type=str, default=None, help="Write the per stage coefficients of workflow_generator.py --dry-run to this file.")
+
+    args = parser.parse_args()
+
+    sidecars = load_sidecars(args.input)
+    if not sidecars:
+        print("No metrics sidecars found in {}".format(" ".join(args.input)))
+        return
+
+    report = aggregate(sidecars)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.coefficients:
+        with open(args.coefficients, "w") as f:
+            json.dump(fit_coefficients(sidecars), f, indent=2)
+
+    if args.resource_profile:
+        with open(args.resource_profile, "w") as f:
+            json.dump(fit_resource_profile(sidecars), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""
+Compares the intermediate audio formats of convert2wav.
+
+Encodes a synthetic HLS segment (tone + noise, 48 kHz stereo AAC in MPEG-TS), converts it
+to every format and measures the decode time, the size on disk and the time it takes
+`AudioFile` and `save_spectrogram` to read it back.
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+from audio_io import read_audio
+from convert2wav import AUDIO_FORMATS, audio_extension, convert_with_ffmpeg
+from synthetic import write_segment
+
+
+def timed(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_format(input_ts, work_dir, audio_format, repeat):
+    output_file = os.path.join(work_dir, "live0" + audio_extension(audio_format))
+    def decode():
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        convert_with_ffmpeg(input_ts, output_file, audio_format)
+
+    result = {"format": audio_format}
+    result["decode_s"] = timed(decode, repeat)
+    result["bytes"] = os.path.getsize(output_file)
+    result["read_s"] = timed(lambda: read_audio(output_file), repeat)
+
+    try:
+        import params
+        from dataloader import AudioFile
+        result["audio_file_s"] = timed(lambda: AudioFile(output_file, params.SAMPLE_RATE), repeat)
+    except ImportError as e:
+        print("Skipping AudioFile: {}".format(e), file=sys.stderr)
+
+    try:
+        from convert2spectrogram import save_spectrogram
+        png_file = os.path.join(work_dir, "live0.png")
+        result["save_spectrogram_s"] = timed(lambda: save_spectrogram(output_file, png_file), repeat)
+    except ImportError as e:
+        print("Skipping save_spectrogram: {}".format(e), file=sys.stderr)
+
+    return result
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark the intermediate audio formats")
+    parser.add_argument("-n", "--repeat", metavar="INT", type=int, default=5, help="Repetitions per measurement (default: 5)")
+    parser.add_argument("-d", "--duration", metavar="FLOAT", type=float, default=10, help="Segment duration in seconds (default: 10)")
+    parser.add_argument("-o", "--output", metavar="STR", type=str, default=None, help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        input_ts = os.path.join(work_dir, "live0.ts")
+        write_segment(input_ts, args.duration)
+        for audio_format in AUDIO_FORMATS:
+            results.append(bench_format(input_ts, work_dir, audio_format, args.repeat))
+
+    for result in results:
+        print("  ".join("{}={}".format(k, round(v, 4) if isinstance(v, float) else v) for k, v in result.items()))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
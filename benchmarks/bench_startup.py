@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""
+Measures the startup time of the bin/ stage scripts.
+
+Every entry point is run with `--help`, which imports its modules and exits before doing
+any work, under `python -X importtime`. The best wall time of the runs is compared with the
+budget of the entry point, and the slowest top level imports are reported. Exits with 1 if
+any entry point is over its budget.
+"""
+
+import os
+import sys
+import json
+import time
+import subprocess
+from argparse import ArgumentParser
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin")
+
+# seconds, torch and librosa are needed by every job running the model
+BUDGETS = {
+    "convert2wav.py": 1.0,
+    "convert2spectrogram.py": 1.0,
+    "spectrogram_archive.py": 0.5,
+    "merge.py": 0.5,
+    "inference.py": 5.0,
+    "process_chunk.py": 5.0,
+}
+
+
+def top_imports(importtime_log, top):
+    """Returns the `top` slowest top level imports of a `-X importtime` log as (module, seconds)."""
+    imports = []
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # nested imports are indented
+        if not name.startswith("  "):
+            imports.append((name.strip(), int(cumulative) / 1e6))
+    return sorted(imports, key=lambda x: -x[1])[:top]
+
+
+def bench_entry_point(script, repeat, top):
+    best, log = None, ""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, "-X", "importtime", script, "--help"], cwd=BIN_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        elapsed = time.perf_counter() - start
+        if process.returncode != 0:
+            return {"script": script, "error": process.stderr.strip().splitlines()[-1]}
+        if best is None or elapsed < best:
+            best, log = elapsed, process.stderr
+
+    return {"script": script, "startup_s": best, "top_imports": top_imports(log, top)}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark the startup time of the stage scripts")
+    parser.add_argument("-n", "--repeat", metavar="INT", type=int, default=3, help="Runs per entry point, the best one is kept (default: 3)")
+    parser.add_argument("-t", "--top", metavar="INT", type=int, default=5, help="Slowest top level imports to report (default: 5)")
+    parser.add_argument("-b", "--budgets", metavar="STR", type=str, default=None, help="JSON file of {script: seconds} overriding the default budgets")
+    parser.add_argument("-o", "--output", metavar="STR", type=str, default=None, help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    budgets = dict(BUDGETS)
+    if args.budgets:
+        with open(args.budgets, "r") as f:
+            budgets.update(json.load(f))
+
+    results, over_budget = [], []
+    for script, budget in budgets.items():
+        result = bench_entry_point(script, args.repeat, args.top)
+        result["budget_s"] = budget
+        results.append(result)
+
+        if "error" in result:
+            over_budget.append(script)
+            print("{}: failed, {}".format(script, result["error"]))
+            continue
+        if result["startup_s"] > budget:
+            over_budget.append(script)
+        print("{}: {:.3f}s (budget {:.1f}s){}".format(script, result["startup_s"], budget, "  OVER BUDGET" if result["startup_s"] > budget else ""))
+        for module, seconds in result["top_imports"]:
+            print("    {:<30} {:.3f}s".format(module, seconds))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if over_budget:
+        print("Over budget: {}".format(", ".join(over_budget)))
+        sys.exit(1)
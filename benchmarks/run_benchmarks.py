@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+"""
+Offline benchmarks of the processing stages.
+
+Every benchmark runs on synthetic inputs (see `synthetic.py`) in its own process, so that its
+peak RSS is its own, and reports the best time of `--repeat` runs with the throughput in the
+unit of its stage:
+
+    convert2wav        .ts segments decoded to wav per second
+    save_spectrogram   wav files rendered to png per second
+    predict            windows per second of OrcaDetectionModel.predict with a random VGGish
+    merge_predictions  predictions files merged per second
+    create_workflow    catalog segments planned per second (needs the Pegasus API)
+
+Results are written as JSON. `--compare BASELINE` flags the benchmarks whose throughput
+dropped, or whose peak RSS grew, by more than `--tolerance` and exits with 1 if any did.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import tempfile
+import multiprocessing
+from argparse import ArgumentParser
+from datetime import datetime
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "bin"))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, ".."))
+
+
+def best_time(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_convert2wav(work_dir, args):
+    import synthetic
+    from convert2wav import convert2wav
+
+    hls_dir = os.path.join(work_dir, "hls")
+    synthetic.write_hls(hls_dir, args.segments, args.duration, args.tone, args.noise)
+    seconds = best_time(lambda: convert2wav(hls_dir, os.path.join(work_dir, "wav_{}".format(time.perf_counter_ns()))), args.repeat)
+    return {"seconds": seconds, "throughput": args.segments / seconds, "unit": "segments/s"}
+
+
+def bench_save_spectrogram(work_dir, args):
+    import synthetic
+    from convert2spectrogram import create_spec_name, save_spectrogram
+
+    wavs = synthetic.write_wavs(os.path.join(work_dir, "wav"), args.segments, args.duration, (args.tone,), args.noise)
+    png_dir = os.path.join(work_dir, "png")
+    seconds = best_time(lambda: [save_spectrogram(wav, create_spec_name(wav, png_dir)) for wav in wavs], args.repeat)
+    return {"seconds": seconds, "throughput": len(wavs) / seconds, "unit": "files/s"}
+
+
+def bench_predict(work_dir, args):
+    import torch
+    import synthetic
+    from inference import OrcaDetectionModel
+
+    torch.manual_seed(0)
+    wavs = synthetic.write_wavs(os.path.join(work_dir, "wav"), args.segments, args.duration, (args.tone,), args.noise)
+    # no checkpoint in an empty directory, the VGGish weights stay randomly initialized
+    checkpoint_dir = os.path.join(work_dir, "checkpoints")
+    os.makedirs(checkpoint_dir)
+    orca_model = OrcaDetectionModel(checkpoint_dir, use_cuda=False)
+
+    windows = []
+    def predict():
+        windows[:] = [len(orca_model.predict(wav)["local_predictions"]) for wav in wavs]
+    seconds = best_time(predict, args.repeat)
+    return {"seconds": seconds, "throughput": sum(windows) / seconds, "unit": "windows/s"}
+
+
+def bench_merge_predictions(work_dir, args):
+    import synthetic
+    from merge import merge_predictions
+
+    files = synthetic.write_predictions(os.path.join(work_dir, "predictions"), args.predictions_files, args.segments)
+    seconds = best_time(lambda: merge_predictions(files), args.repeat)
+    return {"seconds": seconds, "throughput": len(files) / seconds, "unit": "files/s"}
+
+
+def bench_create_workflow(work_dir, args):
+    import synthetic
+    from workflow_generator import OrcasoundWorkflow
+
+    catalog_file = os.path.join(work_dir, "catalog.csv")
+    catalog = synthetic.write_catalog(catalog_file, days=args.days)
+    start_date = datetime.fromtimestamp(int(catalog["Timestamp"].min()))
+    end_date = datetime.fromtimestamp(int(catalog["Timestamp"].max()))
+
+    def create_workflow():
+        workflow = OrcasoundWorkflow(sensors=["rpi_bush_point"], start_date=start_date, end_date=end_date, max_files=200, dagfile=os.path.join(work_dir, "workflow.yml"))
+        workflow.s3_cache_file = catalog_file
+        workflow.create_replica_catalog()
+        workflow.create_workflow()
+    seconds = best_time(create_workflow, args.repeat)
+    return {"seconds": seconds, "throughput": len(catalog.index) / seconds, "unit": "segments/s"}
+
+
+BENCHMARKS = {
+    "convert2wav": bench_convert2wav,
+    "save_spectrogram": bench_save_spectrogram,
+    "predict": bench_predict,
+    "merge_predictions": bench_merge_predictions,
+    "create_workflow": bench_create_workflow,
+}
+
+
+def run_benchmark(name, args):
+    """Runs a benchmark in a temporary directory and adds the peak RSS of the process."""
+    with tempfile.TemporaryDirectory() as work_dir:
+        try:
+            result = BENCHMARKS[name](work_dir, args)
+        except ImportError as e:
+            return {"skipped": str(e)}
+    # kilobytes on Linux
+    result["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def run_isolated(name, args):
+    """Runs a benchmark in a new process."""
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(run_benchmark, (name, args))
+
+
+def compare(results, baseline, tolerance):
+    """Returns the regressions of `results` against `baseline` as messages."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None or "throughput" not in base or "throughput" not in result:
+            continue
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append("{}: throughput {:.2f} {} < baseline {:.2f}".format(name, result["throughput"], result["unit"], base["throughput"]))
+        if result["peak_rss_kb"] > base["peak_rss_kb"] * (1 + tolerance):
+            regressions.append("{}: peak RSS {} kB > baseline {} kB".format(name, result["peak_rss_kb"], base["peak_rss_kb"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Run the offline benchmarks of the processing stages")
+    parser.add_argument("-b", "--benchmarks", metavar="STR", type=str, nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS), help="Benchmarks to run (default: all)")
+    parser.add_argument("-n", "--repeat", metavar="INT", type=int, default=3, help="Repetitions per benchmark, the best one is kept (default: 3)")
+    parser.add_argument("-s", "--segments", metavar="INT", type=int, default=20, help="Segments (or wav files) per benchmark (default: 20)")
+    parser.add_argument("-d", "--duration", metavar="FLOAT", type=float, default=10, help="Segment duration in seconds (default: 10)")
+    parser.add_argument("--tone", metavar="FLOAT", type=float, default=3000, help="Tone frequency in Hz (default: 3000)")
+    parser.add_argument("--noise", metavar="FLOAT", type=float, default=0.1, help="Noise amplitude (default: 0.1)")
+    parser.add_argument("--predictions-files", metavar="INT", type=int, default=100, help="Predictions files merged by merge_predictions (default: 100)")
+    parser.add_argument("--days", metavar="INT", type=int, default=7, help="Days of catalog planned by create_workflow (default: 7)")
+    parser.add_argument("-o", "--output", metavar="STR", type=str, default=None, help="Write the results as JSON to this file")
+    parser.add_argument("-c", "--compare", metavar="STR", type=str, default=None, help="Baseline results JSON to check for regressions")
+    parser.add_argument("-t", "--tolerance", metavar="FLOAT", type=float, default=0.1, help="Relative throughput drop or peak RSS growth flagged as a regression (default: 0.1)")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.benchmarks:
+        results[name] = run_isolated(name, args)
+        if "skipped" in results[name]:
+            print("{}: skipped, {}".format(name, results[name]["skipped"]))
+        else:
+            print("{}: {:.3f}s, {:.2f} {}, peak RSS {} kB".format(name, results[name]["seconds"], results[name]["throughput"], results[name]["unit"], results[name]["peak_rss_kb"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "created": datetime.utcnow().isoformat(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "processor": platform.processor(),
+                "cpus": os.cpu_count(),
+                "parameters": vars(args),
+                "results": results,
+            }, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+        if regressions:
+            sys.exit(1)
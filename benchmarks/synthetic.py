@@ -0,0 +1,148 @@
+"""
+Synthetic inputs for the benchmarks
+
+HLS segments and wav files of tones in noise at 48 kHz, predictions files and S3 catalogs,
+generated locally so that the benchmarks do not depend on the S3 buckets. Run as a script it
+writes a live HLS stream in real time, to test `bin/stream_detect.py` against.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+from argparse import ArgumentParser
+
+import numpy as np
+
+SAMPLE_RATE = 48000
+
+
+def write_segment(output_file, duration_s=10, tone_hz=3000, noise_amplitude=0.1, sample_rate=SAMPLE_RATE):
+    """Encodes a stereo tone + noise segment the way the hydrophones stream it (AAC in MPEG-TS)."""
+    import ffmpeg
+
+    tone = ffmpeg.input("sine=frequency={}:sample_rate={}:duration={}".format(tone_hz, sample_rate, duration_s), f="lavfi")
+    noise = ffmpeg.input("anoisesrc=color=pink:amplitude={}:sample_rate={}:duration={}".format(noise_amplitude, sample_rate, duration_s), f="lavfi")
+    mixed = ffmpeg.filter([tone, noise], "amix", inputs=2).filter("aformat", channel_layouts="stereo")
+    ffmpeg.output(mixed, output_file, acodec="aac", f="mpegts").overwrite_output().run(capture_stdout=True, capture_stderr=True)
+
+
+def write_hls(output_dir, segments=10, duration_s=10, tone_hz=3000, noise_amplitude=0.1, sample_rate=SAMPLE_RATE):
+    """Writes `live0.ts` ... `live<segments-1>.ts`, encoding the first one and copying it."""
+    os.makedirs(output_dir, exist_ok=True)
+    first = os.path.join(output_dir, "live0.ts")
+    write_segment(first, duration_s, tone_hz, noise_amplitude, sample_rate)
+    with open(first, "rb") as f:
+        data = f.read()
+    for i in range(1, segments):
+        with open(os.path.join(output_dir, "live{}.ts".format(i)), "wb") as f:
+            f.write(data)
+    return sorted(os.path.join(output_dir, name) for name in os.listdir(output_dir))
+
+
+def synthesize(duration_s=10, tones_hz=(3000,), noise_amplitude=0.1, sample_rate=SAMPLE_RATE, seed=0):
+    """Returns mono int16 samples of tones in white noise."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration_s * sample_rate)) / sample_rate
+    audio = sum(np.sin(2 * np.pi * tone_hz * t) for tone_hz in tones_hz) / max(len(tones_hz), 1) * 0.5
+    audio = audio + rng.normal(0, noise_amplitude, len(t))
+    return (np.clip(audio, -1, 1) * (2 ** 15 - 1)).astype(np.int16)
+
+
+def write_wavs(output_dir, files=10, duration_s=10, tones_hz=(3000,), noise_amplitude=0.1, sample_rate=SAMPLE_RATE):
+    """Writes `live0.wav` ... `live<files-1>.wav` with a different noise seed each."""
+    from scipy.io import wavfile
+
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for i in range(files):
+        paths.append(os.path.join(output_dir, "live{}.wav".format(i)))
+        wavfile.write(paths[-1], sample_rate, synthesize(duration_s, tones_hz, noise_amplitude, sample_rate, seed=i))
+    return paths
+
+
+def write_predictions(output_dir, files=100, segments=200, windows=4, sensor="rpi_bush_point", seed=0):
+    """Writes predictions files of `segments` results with `windows` windows each, one timestamp per file."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for i in range(files):
+        results = {}
+        for j in range(segments):
+            confidences = np.round(rng.random(windows), 3)
+            results["live{}.wav".format(j)] = {
+                "local_predictions": (confidences > 0.7).astype(int).tolist(),
+                "local_confidences": confidences.tolist(),
+                "global_prediction": int((confidences > 0.7).sum() >= 3),
+                "global_confidence": float(confidences.mean() * 100),
+            }
+        paths.append(os.path.join(output_dir, "predictions_{}_{}.json".format(sensor, 1628553600 + i * 21600)))
+        with open(paths[-1], "w") as f:
+            json.dump({sensor: {str(1628553600 + i * 21600): [results]}}, f)
+    return paths
+
+
+def write_catalog(output_file, sensors=("rpi_bush_point",), start=1628553600, days=1, timestamps_per_day=4, segments=2160, segment_bytes=160000):
+    """Writes an S3 catalog csv of the streaming bucket layout (`<sensor>/hls/<ts>/live<n>.ts`)."""
+    import pandas as pd
+
+    rows = []
+    for sensor in sensors:
+        for day in range(days):
+            for k in range(timestamps_per_day):
+                ts = start + day * 86400 + k * 86400 // timestamps_per_day
+                for n in range(segments):
+                    key = "{}/hls/{}/live{}.ts".format(sensor, ts, n)
+                    rows.append((key, ts + 1, hashlib.md5(key.encode()).hexdigest(), segment_bytes, "STANDARD", sensor, "hls", ts, "live{}.ts".format(n)))
+    catalog = pd.DataFrame(rows, columns=["Key", "LastModified", "ETag", "Size", "StorageClass", "Sensor", "Protocol", "Timestamp", "Filename"])
+    catalog.to_csv(output_file, index=False)
+    return catalog
+
+
+def write_live(root, sensor="rpi_bush_point", segments=None, duration_s=10, interval_s=None, tone_hz=3000, noise_amplitude=0.1, ts=None):
+    """
+    Writes a live HLS stream to `<root>/<sensor>/hls/<ts>/` the way a hydrophone uploads it: a new
+    `live<n>.ts` every `interval_s` seconds (default: `duration_s`, real time) followed by the
+    `live.m3u8` playlist listing it. Segments are renamed into place once complete.
+    `segments` is the number of segments to write, default is to write until interrupted.
+    """
+    ts = int(time.time()) if ts is None else ts
+    ts_dir = os.path.join(root, sensor, "hls", str(ts))
+    os.makedirs(ts_dir, exist_ok=True)
+    template = os.path.join(ts_dir, ".template.ts")
+    write_segment(template, duration_s, tone_hz, noise_amplitude)
+    interval_s = duration_s if interval_s is None else interval_s
+
+    n = 0
+    while segments is None or n < segments:
+        started = time.time()
+        segment = os.path.join(ts_dir, "live{}.ts".format(n))
+        shutil.copyfile(template, segment + ".tmp")
+        os.replace(segment + ".tmp", segment)
+        with open(os.path.join(ts_dir, "live.m3u8.tmp"), "w") as f:
+            f.write("#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:{}\n#EXT-X-MEDIA-SEQUENCE:0\n".format(int(duration_s)))
+            for i in range(n + 1):
+                f.write("#EXTINF:{:.3f},\nlive{}.ts\n".format(duration_s, i))
+        os.replace(os.path.join(ts_dir, "live.m3u8.tmp"), os.path.join(ts_dir, "live.m3u8"))
+        n += 1
+        time.sleep(max(0.0, interval_s - (time.time() - started)))
+    os.remove(template)
+    return ts_dir
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Write a synthetic live HLS stream in real time")
+    parser.add_argument("-o", "--output-dir", metavar="STR", type=str, required=True, help="Root of the HLS streams, segments go to <output-dir>/<sensor>/hls/<ts>/")
+    parser.add_argument("-s", "--sensor", metavar="STR", type=str, default="rpi_bush_point", help="Sensor name (default: rpi_bush_point)")
+    parser.add_argument("-n", "--segments", metavar="INT", type=int, default=None, help="Number of segments to write (default: until interrupted)")
+    parser.add_argument("-d", "--duration", metavar="FLOAT", type=float, default=10, help="Segment duration in seconds (default: 10)")
+    parser.add_argument("-i", "--interval", metavar="FLOAT", type=float, default=None, help="Seconds between two segments (default: the segment duration)")
+    parser.add_argument("--tone", metavar="FLOAT", type=float, default=3000, help="Tone frequency in Hz (default: 3000)")
+    parser.add_argument("--noise", metavar="FLOAT", type=float, default=0.1, help="Noise amplitude (default: 0.1)")
+    args = parser.parse_args()
+
+    try:
+        write_live(args.output_dir, args.sensor, args.segments, args.duration, args.interval, args.tone, args.noise)
+    except KeyboardInterrupt:
+        pass
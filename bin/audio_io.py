@@ -0,0 +1,53 @@
+"""
+Reading and writing of the intermediate audio files
+
+"""
+
+import glob
+from os import path
+
+from scipy.io import wavfile
+
+AUDIO_EXTENSIONS = (".wav", ".flac")
+
+
+def list_audio(input_dir):
+    """Returns the sorted paths of the audio files in a directory."""
+    audio_files = []
+    for extension in AUDIO_EXTENSIONS:
+        audio_files.extend(glob.glob(path.join(input_dir, f"*{extension}")))
+    return sorted(audio_files)
+
+
+def read_audio(file_path, mmap=False):
+    """Reads an audio file as (samplerate, data), with data as stored (int16 for mono16 and flac).
+
+    `mmap` only applies to `.wav` files.
+    """
+    if str(file_path).endswith(".flac"):
+        import soundfile
+
+        data, samplerate = soundfile.read(str(file_path), dtype="int16")
+        return samplerate, data
+    return wavfile.read(file_path, mmap=mmap)
+
+
+def audio_info(file_path):
+    """Returns (samplerate, number of frames, dtype as read) of an audio file, reading its header only."""
+    if str(file_path).endswith(".flac"):
+        import soundfile
+
+        info = soundfile.info(str(file_path))
+        return info.samplerate, info.frames, "int16"
+    samplerate, data = wavfile.read(file_path, mmap=True)
+    return samplerate, len(data), data.dtype
+
+
+def write_audio(file_path, samplerate, data):
+    """Writes an audio file, as FLAC if the path ends with `.flac` and as wav otherwise."""
+    if str(file_path).endswith(".flac"):
+        import soundfile
+
+        soundfile.write(str(file_path), data, samplerate)
+    else:
+        wavfile.write(file_path, samplerate, data)
@@ -1,13 +1,14 @@
 #!/usr/bin/env python3
 
 import argparse, sys
+import io
 import logging
-import glob
+import os
 from os import path
 from pathlib import Path
 
-import matplotlib.pyplot as plt
-from scipy.io import wavfile
+from audio_io import list_audio, read_audio
+from telemetry import telemetry
 
 
 def create_spec_name(wav_name, output_dir=None):
@@ -25,6 +26,16 @@ def create_spec_name(wav_name, output_dir=None):
     return f"{spec_name}.png"
 
 
+def pyplot():
+    """Imports pyplot on first use, with the non-interactive Agg backend."""
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    return plt
+
+
 def plot_psd(data, samplerate, nfft=256, noverlap=128):
     """Plots power spectral density spectrogram.
 
@@ -34,45 +45,60 @@ def plot_psd(data, samplerate, nfft=256, noverlap=128):
         `nfft`: The number of data points used in each block for the FFT. A power 2 is most efficient.
         `noverlap`: The number of points of overlap between blocks.
     """
+    plt = pyplot()
     plt.specgram(data, Fs=samplerate, NFFT=nfft, noverlap=noverlap)
     plt.ylabel("Frequency [Hz]")
     cbar = plt.colorbar()
     cbar.set_label("DB")
 
 
-def save_spectrogram(input_wav, plot_path=None, nfft=256):
+def save_spectrogram(input_wav, plot_path=None, nfft=256, archive=None):
     """Saves power spectral density spectrogram to file.
 
     Args:
-        `input_wav`: Path to the input .wav file.
+        `input_wav`: Path to the input .wav (or .flac) file.
         `plot_path`: Path to the output spectrogram file. Default is `input_wav` with .png extension.
         `nfft`: The number of data points used in each block for the FFT. A power 2 is most efficient.
+        `archive`: `SpectrogramArchive` to add the spectrogram to instead of writing `plot_path`.
     Returns:
-        Path to the spectrogram.
+        Path to the spectrogram, or its segment name in `archive`.
     """
-    samplerate, data = wavfile.read(input_wav)
+    plt = pyplot()
+    with telemetry.phase("load"):
+        samplerate, data = read_audio(input_wav)
     noverlap = nfft // 2 if nfft <= 128 else 128
 
-    title = path.splitext(path.basename(input_wav))[0]
-    plt.title(title)
-    if len(data.shape) == 1:
-        plot_psd(data, samplerate, nfft, noverlap)
-    else:
-        plt.subplot(211)
-        plot_psd(data[:, 0], samplerate, nfft, noverlap)
-        title = f"{title}\nChannel 0 above, Channel 1 below"
+    with telemetry.phase("stft"):
+        title = path.splitext(path.basename(input_wav))[0]
         plt.title(title)
-
-        plt.subplot(212)
-        plot_psd(data[:, 1], samplerate, nfft, noverlap)
-
-    plt.xlabel("Time [s]")
-
-    if plot_path is None:
-        plot_path = f"{path.splitext(input_wav)[0]}.png"
-    else:
-        Path(path.dirname(plot_path)).mkdir(parents=True, exist_ok=True)
-    plt.savefig(plot_path)
+        if len(data.shape) == 1:
+            plot_psd(data, samplerate, nfft, noverlap)
+        else:
+            plt.subplot(211)
+            plot_psd(data[:, 0], samplerate, nfft, noverlap)
+            title = f"{title}\nChannel 0 above, Channel 1 below"
+            plt.title(title)
+
+            plt.subplot(212)
+            plot_psd(data[:, 1], samplerate, nfft, noverlap)
+
+        plt.xlabel("Time [s]")
+
+    with telemetry.phase("serialization"):
+        if archive is not None:
+            plot_path = path.splitext(path.basename(input_wav))[0]
+            buffer = io.BytesIO()
+            plt.savefig(buffer, format="png")
+            archive.add(plot_path, buffer.getvalue())
+            telemetry.count("bytes_written", len(buffer.getvalue()))
+        else:
+            if plot_path is None:
+                plot_path = f"{path.splitext(input_wav)[0]}.png"
+            else:
+                Path(path.dirname(plot_path)).mkdir(parents=True, exist_ok=True)
+            plt.savefig(plot_path)
+            telemetry.count_file("bytes_written", plot_path)
+    telemetry.count_input("convert2spectrogram", input_wav)
 
     plt.cla()
     plt.close("all")
@@ -90,14 +116,16 @@ if __name__ == "__main__":
     parser.add_argument(
         "-i",
         "--input-dir",
-        default=".",
-        help="Path to the input directory with `.wav` files. Default is `.`",
+        nargs="+",
+        default=["."],
+        help="Paths to the input directories with `.wav` (or `.flac`) files. Default is `.`",
     )
     parser.add_argument(
         "-o",
         "--output-dir",
-        default="png",
-        help="Path to the output directory for spectrograms. Default is `png`.",
+        nargs="+",
+        default=["png"],
+        help="Paths to the output directories for spectrograms, one per input directory. Default is `png`.",
     )
     parser.add_argument(
         "-n",
@@ -106,8 +134,34 @@ if __name__ == "__main__":
         default=256,
         help="The number of data points used in each block for the FFT. A power 2 is most efficient. Default is %(default)s.",
     )
+    parser.add_argument(
+        "-p",
+        "--pack",
+        action="store_true",
+        help="Pack the spectrograms of each input directory in one archive. The output paths are the archives.",
+    )
+    parser.add_argument(
+        "--metrics",
+        default=None,
+        help="Path to the JSON metrics sidecar of the job. Default is a file in the directory of `$ORCASOUND_METRICS` if set, else no metrics.",
+    )
     args = parser.parse_args()
-
-    for input_wav in sorted(glob.glob(path.join(args.input_dir, "*.wav"))):
-        output_fname = create_spec_name(input_wav, args.output_dir)
-        save_spectrogram(input_wav, output_fname, args.nfft)
+    if len(args.input_dir) != len(args.output_dir):
+        parser.error("expected one output directory per input directory")
+    telemetry.configure("convert2spectrogram", args.metrics)
+    telemetry.record_inputs(sum(len(list_audio(input_dir)) for input_dir in args.input_dir))
+
+    for input_dir, output_dir in zip(args.input_dir, args.output_dir):
+        # the job creates its own output directories, the workflow has no mkdir jobs
+        os.makedirs(path.dirname(output_dir) or "." if args.pack else output_dir, exist_ok=True)
+        input_wavs = list_audio(input_dir)
+        if args.pack:
+            from spectrogram_archive import SpectrogramArchive
+
+            with SpectrogramArchive(output_dir) as archive:
+                for input_wav in input_wavs:
+                    save_spectrogram(input_wav, nfft=args.nfft, archive=archive)
+        else:
+            for input_wav in input_wavs:
+                output_fname = create_spec_name(input_wav, output_dir)
+                save_spectrogram(input_wav, output_fname, args.nfft)
@@ -3,41 +3,140 @@
 import argparse
 import glob
 import logging
+import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os import path
 from pathlib import Path
 
 import ffmpeg
 
-def convert_with_ffmpeg(input_file, output_file):
+from telemetry import telemetry
+
+AUDIO_FORMATS = {
+    # ffmpeg defaults, native sample rate and channels
+    "wav": {},
+    # mono 16-bit PCM at the sample rate of the model
+    "mono16": {"ac": 1, "acodec": "pcm_s16le"},
+    # mono 16-bit FLAC at the sample rate of the model
+    "flac": {"ac": 1, "acodec": "flac", "sample_fmt": "s16"},
+}
+
+
+def audio_extension(audio_format):
+    """Returns the file extension of an intermediate audio format."""
+    return ".flac" if audio_format == "flac" else ".wav"
+
+
+def convert_with_ffmpeg(input_file, output_file, audio_format="wav", sample_rate=48000):
     """Converts input file using ffmpeg."""
     try:
+        output_args = dict(AUDIO_FORMATS[audio_format])
+        if output_args:
+            output_args["ar"] = sample_rate
         ffmpeg_input = ffmpeg.input(input_file)
-        ffmpeg_output = ffmpeg.output(ffmpeg_input, output_file)
-        ffmpeg_output.run(capture_stdout=True, capture_stderr=True)
+        ffmpeg_output = ffmpeg.output(ffmpeg_input, output_file, **output_args)
+        with telemetry.phase("decode"):
+            ffmpeg_output.run(capture_stdout=True, capture_stderr=True)
+        telemetry.count_input("convert2wav", input_file)
+        telemetry.count_file("bytes_written", output_file)
     except ffmpeg.Error as e:
         logging.error(e.stdout.decode("utf8"))
         logging.error(e.stderr.decode("utf8"))
         raise e
 
 
-def convert2wav(input_dir, output_dir):
+def convert2wav(input_dir, output_dir, audio_format="wav", sample_rate=48000):
     """
     Converts all `.ts` files available in the folder to `.wav`.
 
-    All files will have the following format: `liveXXXX.wav`
+    All files will have the following format: `liveXXXX.wav` (`liveXXXX.flac` for `flac`)
 
     Args:
         `input_dir`: Path to the input directory with `.ts` files.
         `output_dir`: Path to the output directory.
+        `audio_format`: One of `wav` (ffmpeg defaults), `mono16` or `flac` (mono 16-bit at `sample_rate`).
+        `sample_rate`: Sample rate of the `mono16` and `flac` formats.
     Returns:
         None
     """
-    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    # the job creates its own output directories, the workflow has no mkdir jobs
+    os.makedirs(output_dir, exist_ok=True)
 
     for input_ts in sorted(glob.glob(path.join(input_dir, "*.ts"))):
         uri = input_ts[input_ts.rfind("/")+1:]
-        convert_with_ffmpeg(input_ts, path.join(output_dir, uri).replace(".ts", ".wav"))
+        convert_with_ffmpeg(input_ts, path.join(output_dir, uri).replace(".ts", audio_extension(audio_format)), audio_format, sample_rate)
+
+
+def create_s3_client(max_pool_connections=16, max_attempts=5, region_name=None):
+    """Creates an unsigned S3 client with a bounded connection pool and retries."""
+    import botocore.session
+    from botocore import UNSIGNED
+    from botocore.config import Config
+
+    config = Config(
+        signature_version=UNSIGNED,
+        max_pool_connections=max_pool_connections,
+        retries={"max_attempts": max_attempts, "mode": "standard"},
+    )
+    return botocore.session.get_session().create_client("s3", region_name=region_name, config=config)
+
+
+def fetch_object(s3_client, bucket, key, output_file, max_attempts=5):
+    """Downloads an S3 object to a file, retrying interrupted transfers."""
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    Path(path.dirname(output_file) or ".").mkdir(parents=True, exist_ok=True)
+    for attempt in range(max_attempts):
+        try:
+            with telemetry.phase("fetch"):
+                response = s3_client.get_object(Bucket=bucket, Key=key)
+                with open(output_file, "wb") as f:
+                    for chunk in iter(lambda: response["Body"].read(1 << 20), b""):
+                        f.write(chunk)
+            telemetry.count_file("bytes_fetched", output_file)
+            return output_file
+        except (BotoCoreError, ClientError) as e:
+            if attempt == max_attempts - 1:
+                raise e
+            logging.warning(f"Fetching s3://{bucket}/{key} failed ({e}), retrying...")
+            time.sleep(0.1 * 2 ** attempt)
+
+
+def convert2wav_prefetch(bucket, keys, output_dirs, workers=16, s3_client=None, audio_format="wav", sample_rate=48000):
+    """
+    Fetches `.ts` files from S3 concurrently and converts each one to `.wav` as soon as it arrives.
+
+    Every key is downloaded to the same relative path, so `rpi_bush_point/hls/1628553618/live0.ts`
+    is converted into the output directory mapped to `rpi_bush_point/hls/1628553618`.
+    Each `.ts` file is removed once it is decoded, so the job's disk usage stays at the decoded audio.
+
+    Args:
+        `bucket`: Name of the S3 bucket.
+        `keys`: S3 keys of the `.ts` files.
+        `output_dirs`: Dictionary of key directory to output directory.
+        `workers`: Number of concurrent downloads.
+        `s3_client`: botocore S3 client. Default is an unsigned client with `workers` connections.
+        `audio_format`: One of `wav` (ffmpeg defaults), `mono16` or `flac` (mono 16-bit at `sample_rate`).
+        `sample_rate`: Sample rate of the `mono16` and `flac` formats.
+    Returns:
+        None
+    """
+    if s3_client is None:
+        s3_client = create_s3_client(max_pool_connections=workers)
+
+    for output_dir in output_dirs.values():
+        os.makedirs(output_dir, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch_object, s3_client, bucket, key, key) for key in keys]
+        for future in as_completed(futures):
+            input_ts = future.result()
+            output_dir = output_dirs[path.dirname(input_ts)]
+            convert_with_ffmpeg(input_ts, path.join(output_dir, path.basename(input_ts)).replace(".ts", audio_extension(audio_format)), audio_format, sample_rate)
+            # the fetched .ts is not a workflow file, only its decoded audio is kept
+            os.remove(input_ts)
 
 
 if __name__ == "__main__":
@@ -50,15 +149,64 @@ if __name__ == "__main__":
     parser.add_argument(
         "-i",
         "--input-dir",
-        default=".",
-        help="Path to the input directory with `.ts` files. Default is `.`",
+        nargs="+",
+        default=["."],
+        help="Paths to the input directories with `.ts` files. Default is `.`",
     )
     parser.add_argument(
         "-o",
         "--output-dir",
+        nargs="+",
+        default=["wav"],
+        help="Paths to the output directories for wavs, one per input directory. Default is `wav`.",
+    )
+    parser.add_argument(
+        "-b",
+        "--bucket",
+        default="streaming-orcasound-net",
+        help="S3 bucket to fetch `--keys` from. Default is `streaming-orcasound-net`.",
+    )
+    parser.add_argument(
+        "-k",
+        "--keys",
+        nargs="+",
+        default=None,
+        help="S3 keys of the `.ts` files to fetch into the input directories before converting them.",
+    )
+    parser.add_argument(
+        "--prefetch-workers",
+        type=int,
+        default=16,
+        help="Number of concurrent downloads with `--keys`. Default is %(default)s.",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=list(AUDIO_FORMATS),
         default="wav",
-        help="Path to the output directory for wavs. Default is `wav`.",
+        help="Intermediate audio format: `wav` (ffmpeg defaults), `mono16` or `flac` (mono 16-bit at `--sample-rate`). Default is `wav`.",
+    )
+    parser.add_argument(
+        "-r",
+        "--sample-rate",
+        type=int,
+        default=48000,
+        help="Sample rate of the `mono16` and `flac` formats. Default is %(default)s.",
+    )
+    parser.add_argument(
+        "--metrics",
+        default=None,
+        help="Path to the JSON metrics sidecar of the job. Default is a file in the directory of `$ORCASOUND_METRICS` if set, else no metrics.",
     )
     args = parser.parse_args()
+    if len(args.input_dir) != len(args.output_dir):
+        parser.error("expected one output directory per input directory")
+    telemetry.configure("convert2wav", args.metrics)
+    telemetry.record_inputs(len(args.keys) if args.keys else sum(len(glob.glob(path.join(i, "*.ts"))) for i in args.input_dir))
 
-    convert2wav(path.normpath(args.input_dir), args.output_dir)
+    if args.keys:
+        output_dirs = {path.normpath(i): o for i, o in zip(args.input_dir, args.output_dir)}
+        convert2wav_prefetch(args.bucket, args.keys, output_dirs, args.prefetch_workers, audio_format=args.format, sample_rate=args.sample_rate)
+    else:
+        for input_dir, output_dir in zip(args.input_dir, args.output_dir):
+            convert2wav(path.normpath(input_dir), output_dir, args.format, args.sample_rate)
@@ -1,62 +1,107 @@
 import librosa
-import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 import os
-from tqdm import tqdm
-from scipy.io import wavfile
 from pathlib import Path
 from math import ceil
+from collections import OrderedDict
+from functools import reduce
+from multiprocessing import Pool
 from torch.utils.data import Dataset
+from audio_io import AUDIO_EXTENSIONS, audio_info, read_audio, write_audio
+from telemetry import telemetry
 import params
 
 def s_to_samples(duration,sr):
     return int(duration*sr)
 
+def window_features(audio_window,sr,mode='mel_spec'):
+    """Log (mel) spectrogram of a window of float32 samples at `sr`, dimension: T x F"""
+    with telemetry.phase("stft"):
+        spec = np.abs(librosa.core.stft(
+            audio_window,
+            n_fft=params.N_FFT,
+            hop_length=int(params.HOP_S*sr)
+            )) # ok with defaults n_fft=2048
+        if mode=='spec':
+            return np.log(spec).T # dimension: T x F
+        # roughly trying out some params based on https://seaworld.org/animals/all-about/killer-whale/communication/
+        mel_fbank = librosa.filters.mel(
+            sr,
+            n_fft=params.N_FFT,
+            n_mels=params.N_MELS,
+            fmin=params.MEL_MIN_FREQ,
+            fmax=params.MEL_MAX_FREQ
+        )
+        mel_spec = np.dot(mel_fbank,spec)
+        return np.log(mel_spec).T # dimension: T x F
+
 class AudioFile:
     """
     Attributes:
         sr (int)
         nsamples (int)
         duration (float)
-        audio (float32 array)
+        audio (float32 array, or the int16 samples as stored when memory-mapped)
         name (str)
+
+    With `mmap` a `.wav` file is memory-mapped and only the windows being processed are
+    scaled to float32. The samples at the original rate are kept in `audio_original`
+    only with `keep_original`, for the `audio_orig_sr` mode.
     """
-    def __init__(self,file_path,target_sr):
+    def __init__(self,file_path,target_sr,mmap=False,keep_original=False):
         file_path = Path(file_path) 
         self.name = file_path.name
+        self.audio_original = None
 
-        if file_path.suffix == '.wav':
-            sr, audio = wavfile.read(file_path)
-            if audio.dtype=="int16":
-                audio = audio.astype('float32') / (2 ** 15)
-            elif audio.dtype=="float32":
-                pass
-            else:
+        if file_path.suffix in AUDIO_EXTENSIONS:
+            with telemetry.phase("load"):
+                sr, audio = read_audio(file_path, mmap=mmap)
+            if audio.dtype not in ("int16","float32"):
                 raise Exception("Error, wav format {} not supported for {}".format(audio.dtype,self.name)) 
             # if multichannel wav recordings, use the first channel
             if len(audio.shape)>1:
                 audio = audio[:,0]
+            if not mmap or sr != target_sr:
+                audio = self.as_float(audio)
 
             if sr != target_sr: # convert to a common sampling rate
                 print("Warning: Resampling file {} with SR: {}, dtype: {}".format(
                     self.name, target_sr, audio.dtype)
                 )
-                self.audio_original = audio
-                self.sr_original = sr
                 og_directory = Path(file_path).parent / "original_{:.1f}_kHz".format(sr/1000.0)
                 os.makedirs(og_directory, exist_ok=True)
-                wavfile.write(og_directory / self.name, self.sr_original, self.audio_original)
-                audio = librosa.core.resample(audio, sr, target_sr) 
-                wavfile.write(file_path, target_sr, audio)
+                write_audio(og_directory / self.name, sr, audio)
+                if keep_original:
+                    self.audio_original = audio
+                with telemetry.phase("resample"):
+                    audio = librosa.core.resample(audio, sr, target_sr) 
+                write_audio(file_path, target_sr, audio)
                 print("Overwritten file at {} and copied original to {}".format(file_path, og_directory))
-            else:
+            elif keep_original:
                 self.audio_original = audio
-                self.sr_original = target_sr
+            self.sr_original = sr
             self.sr, self.audio = target_sr, audio
         self.nsamples = len(self.audio)
         self.duration = self.nsamples/self.sr
+
+    @staticmethod
+    def as_float(samples):
+        """Scales int16 samples to float32 in [-1, 1), float32 samples are returned as is"""
+        if samples.dtype=="int16":
+            return samples.astype('float32') / (2 ** 15)
+        return samples
     
+    @classmethod
+    def from_array(cls,name,audio,sr):
+        """Creates an AudioFile from float32 samples already at `sr`"""
+        audio_file = cls.__new__(cls)
+        audio_file.name = name
+        audio_file.sr, audio_file.audio = sr, audio
+        audio_file.sr_original, audio_file.audio_original = sr, audio
+        audio_file.nsamples = len(audio)
+        audio_file.duration = audio_file.nsamples/sr
+        return audio_file
+
     def extend(self,target_duration_s):
         target_nsamples = s_to_samples(target_duration_s,self.sr)
         if target_nsamples > self.nsamples:
@@ -66,53 +111,175 @@ class AudioFile:
             self.duration = self.nsamples/self.sr
     
     def get_window(self,start_idx,end_idx,mode='mel_spec'):
-        audio_window = self.audio[start_idx:end_idx]
+        audio_window = self.as_float(self.audio[start_idx:end_idx])
         if mode=='audio':
             return audio_window 
         elif mode=='audio_orig_sr':
+            if self.audio_original is None:
+                raise Exception("Error, {} was loaded without keep_original".format(self.name))
             start_idx = int(start_idx*self.sr_original/self.sr)
             end_idx = int(end_idx*self.sr_original/self.sr)
-            return self.audio_original[start_idx:end_idx]
-        elif mode=='spec':
-            spec = np.abs(librosa.core.stft(
-                audio_window,
-                n_fft=params.N_FFT,
-                hop_length=int(params.HOP_S*self.sr)
-                )) # ok with defaults n_fft=2048 
-            return np.log(spec).T # dimension: T x F
-        elif mode=='mel_spec':
-            spec = np.abs(librosa.core.stft(
-                audio_window,
-                n_fft=params.N_FFT,
-                hop_length=int(params.HOP_S*self.sr)
-                )) # ok with defaults n_fft=2048
-            # roughly trying out some params based on https://seaworld.org/animals/all-about/killer-whale/communication/
-            mel_fbank = librosa.filters.mel(
-                self.sr,
-                n_fft=params.N_FFT,
-                n_mels=params.N_MELS,
-                fmin=params.MEL_MIN_FREQ,
-                fmax=params.MEL_MAX_FREQ
-            )
-            mel_spec = np.dot(mel_fbank,spec)
-            return np.log(mel_spec).T # dimension: T x F
+            return self.as_float(self.audio_original[start_idx:end_idx])
+        elif mode in ('spec','mel_spec'):
+            return window_features(audio_window,self.sr,mode)
+
+
+# a window or segment: (file id, start sample, end sample, label)
+WINDOW_DTYPE = np.dtype([('file',np.int32),('start',np.int64),('end',np.int64),('label',np.int8)])
+
+def available_cpus():
+    """CPUs this process may run on, the cores of a batch slot rather than of the whole node"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+def audio_nsamples(file_path,target_sr,min_window_s):
+    """
+    Number of samples of the AudioFile of `file_path` once resampled to target_sr and extended to min_window_s, from the file header.
+    Raises on the formats AudioFile does not support, like AudioFile does
+    """
+    sr, nsamples, dtype = audio_info(file_path)
+    if dtype not in ("int16","float32"):
+        raise Exception("Error, wav format {} not supported for {}".format(dtype,Path(file_path).name))
+    if sr != target_sr:
+        nsamples = int(np.ceil(nsamples*target_sr/sr))
+    target_nsamples = s_to_samples(min_window_s,target_sr)
+    if 0 < nsamples < target_nsamples:
+        nsamples *= ceil(target_nsamples/nsamples)
+    return nsamples
+
+def segments_from_annotations(file_ids,start_idxs,duration_idxs,nsamples,min_window_idx):
+    """
+    Creates the sequential segments of positive and negative examples of annotated files, in one pass over all annotations.
+    Per file, in annotation order:
+        - annotations starting past the end of the file are ignored
+        - the gap since the end of the previous annotation is a negative segment if it is at least min_window_idx long
+        - an annotation of at least min_window_idx is a positive segment (clipped to the file), a shorter one is
+          extended to min_window_idx if the file is long enough and dropped otherwise
+        - the rest of the file after the last annotation is a negative segment if it is at least min_window_idx long
+
+    Arguments:
+        file_ids (int array): file of each annotation, indexing nsamples
+        start_idxs, duration_idxs (int arrays): annotations in samples
+        nsamples (int array): samples per file
+        min_window_idx (int)
+    Returns:
+        segments (WINDOW_DTYPE array) ordered by file and annotation
+    """
+    order = np.argsort(file_ids,kind='stable')
+    f, si, di = file_ids[order], start_idxs[order], duration_idxs[order]
+    valid = si < nsamples[f] # prevent some errors
+    f, si, di = f[valid], si[valid], di[valid]
+    n = nsamples[f]
+
+    # short annotations are extended when possible (segment from master tape)
+    extended = (di < min_window_idx) & (si+min_window_idx < n)
+    ei = np.where(extended, si+min_window_idx, si+di)
+    first, last = np.ones(len(f), dtype=bool), np.ones(len(f), dtype=bool)
+    first[1:] = last[:-1] = f[1:] != f[:-1]
+    prev_ei = np.zeros(len(f), dtype=np.int64)
+    prev_ei[1:] = ei[:-1]
+    prev_ei[first] = 0
+    last_ei = np.zeros(len(nsamples), dtype=np.int64)
+    last_ei[f[last]] = ei[last]
+
+    negative = (si-prev_ei) >= min_window_idx
+    positive = (di >= min_window_idx) | extended
+    tail = (nsamples-last_ei) >= min_window_idx
+    files = np.arange(len(nsamples))
+
+    # negative, then positive segment of every annotation, then the tail of every file
+    rank = np.arange(len(f))
+    keys = np.concatenate([2*rank[negative], 2*rank[positive]+1, np.full(tail.sum(), 2*len(f))])
+    segments = np.zeros(len(keys), dtype=WINDOW_DTYPE)
+    segments['file'] = np.concatenate([f[negative], f[positive], files[tail]])
+    segments['start'] = np.concatenate([prev_ei[negative], si[positive], last_ei[tail]])
+    segments['end'] = np.concatenate([si[negative], np.minimum(ei, n)[positive], nsamples[tail]])
+    segments['label'] = np.concatenate([np.zeros(negative.sum()), np.ones(positive.sum()), np.zeros(tail.sum())])
+    return segments[np.lexsort((keys, segments['file']))]
+
+def split_segments_in_windows(segments,window_idx,hop_idx):
+    """
+    Splits segments into windows of window_idx every hop_idx samples.
+    A segment is kept whole if it is shorter than a window by less than a hop, and dropped if shorter than that.
+
+    An example illustration with (len = 7, window = 3, hop = 1)
+    Samples:    - - - - - - -
+    Indexes:    0 1 2 3 4 5 6
+    Windows:    * * * * *          total = 5
+    Formula:    (len - window)/hop + 1
+    """
+    num_windows = (np.maximum(segments['end']-segments['start'],0) - window_idx) // hop_idx + 1
+    counts = np.where(num_windows == 0, 1, np.maximum(num_windows,0)) # smaller than max are kept whole
+    windows = np.repeat(segments, counts)
+    split = np.repeat(num_windows > 0, counts)
+    i = np.arange(len(windows)) - np.repeat(np.cumsum(counts)-counts, counts)
+    windows['start'][split] += i[split]*hop_idx
+    windows['end'][split] = windows['start'][split] + window_idx
+    #TODO@Akash: support some random jitter when splitting into windows
+    return windows
+
+
+def accumulate_window_stats(dataset,indices):
+    """
+    Accumulates the features of windows of a dataset, in float64.
+    Returns (number of windows, mean and M2 of the window means (Welford), sum of the window variances)
+    """
+    num_windows, mean, m2, variance_sum = 0, np.zeros(params.N_MELS), np.zeros(params.N_MELS), np.zeros(params.N_MELS)
+    for file_id, start_idx, end_idx, label in dataset.windows[indices]:
+        data = dataset.audio_file(file_id).get_window(start_idx,end_idx,dataset.get_mode)
+        window_mean = data.mean(axis=0,dtype=np.float64)
+        num_windows += 1
+        delta = window_mean - mean
+        mean += delta/num_windows
+        m2 += delta*(window_mean - mean)
+        variance_sum += data.var(axis=0,dtype=np.float64)
+    return num_windows, mean, m2, variance_sum
+
+def merge_window_stats(a,b):
+    """Merges two accumulations of accumulate_window_stats (Chan et al.)"""
+    num_a, mean_a, m2_a, variance_sum_a = a
+    num_b, mean_b, m2_b, variance_sum_b = b
+    num_windows = num_a + num_b
+    if num_windows == 0:
+        return a
+    delta = mean_b - mean_a
+    mean = mean_a + delta*num_b/num_windows
+    m2 = m2_a + m2_b + delta**2*num_a*num_b/num_windows
+    return num_windows, mean, m2, variance_sum_a + variance_sum_b
+
+# dataset of the normalization statistics worker processes
+stats_dataset = None
+
+def init_stats_worker(dataset):
+    global stats_dataset
+    stats_dataset = dataset
+
+def worker_window_stats(indices):
+    return accumulate_window_stats(stats_dataset,indices)
 
 
 class AudioFileDataset(Dataset):
     """
-    Given a tsv with (wav_file,start_time,duration) loads audio and indexes it into windows.
+    Given a tsv with (wav_file,start_time,duration) indexes the audio into windows.
     AudioFileDataset[index] returns (window,label), where window can be audio, spectrogram, or mel_spectrum depending on get_mode.  
 
-    Internally indexes AudioFiles and maintains list of segments and windows used to index into them. Also extends audio files < min_window_s by repeating them. 
+    Segments and windows are WINDOW_DTYPE arrays indexing into the files, which are opened on demand and kept
+    in an LRU of max_open_files AudioFiles. Also extends audio files < min_window_s by repeating them. 
     """
     def __init__(self, wav_dir, tsv_file, 
         min_window_s=params.WINDOW_S, max_window_s=params.WINDOW_S, hop_s=0.0,
         mean=None, invstd=None, sr=params.SAMPLE_RATE, 
-        get_mode='mel_spec', transform=None, jitter=False, random_seed=42):
+        get_mode='mel_spec', transform=None, jitter=False, random_seed=42, mmap=False, max_open_files=64, num_workers=None):
         # wav_dir, tsv_file, max_window_s
         """
-        load all wavfiles into memory (data is not too large so can get away with this, else use memmap option while reading wavfiles)
+        only reads the file headers, audio is loaded (or memory-mapped with `mmap`) when a window is requested.
+        num_workers processes compute mean and invstd when they are not provided (default: the CPUs available to the job)
         """
+        # training only dependencies, inference uses AudioFileWindower
+        import pandas as pd
+        from tqdm import tqdm
+
         self.df = pd.read_csv(tsv_file,sep='\t')
         self.max_window_s = max_window_s
         self.min_window_s = min_window_s
@@ -126,24 +293,16 @@ class AudioFileDataset(Dataset):
         np.random.seed(self.random_seed)
         assert get_mode in ['audio','spec','mel_spec', 'audio_orig_sr']
         self.sr, self.get_mode = sr, get_mode
+        self.mmap, self.max_open_files = mmap, max_open_files
+        self.open_files = OrderedDict()
 
-        self.audio_files, self.segments, self.windows = {}, [], []
-        wav_iterator = tqdm(self.df.wav_filename.unique())
-        for wav_filename in wav_iterator:
-            wav_iterator.set_description(wav_filename)
-            wav_df = self.df[self.df['wav_filename']==wav_filename]
-            wav_path = Path(wav_dir)/wav_filename
-            audio_file = AudioFile(wav_path,self.sr)
-            audio_file.extend(self.min_window_s)
-            start_times, durations = wav_df['start_time_s'], wav_df['duration_s']
-            wav_segments, wav_windows = self.index_audio_file(
-                audio_file,start_times,durations,
-                self.min_window_s, self.max_window_s,
-                hop_s=self.hop_s
-                )
-            self.segments.extend(wav_segments)
-            self.windows.extend(wav_windows)
-            self.audio_files[wav_filename] = audio_file 
+        file_ids, filenames = pd.factorize(self.df['wav_filename'])
+        self.file_paths = [ Path(wav_dir)/wav_filename for wav_filename in filenames ]
+        self.nsamples = np.array([ audio_nsamples(wav_path,self.sr,self.min_window_s) for wav_path in tqdm(self.file_paths) ], dtype=np.int64)
+        start_idxs = (self.df['start_time_s'].values*self.sr).astype(np.int64)
+        duration_idxs = (self.df['duration_s'].values*self.sr).astype(np.int64)
+        self.segments = segments_from_annotations(file_ids, start_idxs, duration_idxs, self.nsamples, s_to_samples(self.min_window_s,self.sr))
+        self.windows = split_segments_in_windows(self.segments, s_to_samples(self.max_window_s,self.sr), s_to_samples(self.hop_s,self.sr))
 
         # if mean and invstd were not provided, calculate them
         if os.path.exists(mean) and os.path.exists(invstd):
@@ -151,152 +310,78 @@ class AudioFileDataset(Dataset):
             print("Loaded mean and invstd from:",mean,invstd)
         else:
             # calculate the mean and invstd from data 
-            self.mean, self.invstd = self.calculate_mean_and_invstd()
+            self.mean, self.invstd = self.calculate_mean_and_invstd(num_workers)
             np.savetxt(mean, self.mean)
             np.savetxt(invstd, self.invstd)
     
-    def calculate_mean_and_invstd(self):
-        mean = np.zeros(params.N_MELS)
-        num_windows = len(self.windows)
-        for i in range(num_windows):
-            start_idx, end_idx, label, audio_file = self.windows[i]
-            data = audio_file.get_window(start_idx,end_idx,self.get_mode)
-            mean += data.mean(axis=0)
-
-        mean = mean/num_windows
-
-        variance = np.zeros(params.N_MELS)
-        for i in range(num_windows):
-            start_idx, end_idx, label, audio_file = self.windows[i]
-            data = audio_file.get_window(start_idx,end_idx,self.get_mode)
-            variance += ((data-mean)**2).mean(axis=0)
-        variance /= num_windows
-        invstd = 1/np.sqrt(variance)
+    def audio_file(self,file_id):
+        """Returns the AudioFile of a file id, opening it if it is not in the LRU of open files"""
+        audio_file = self.open_files.pop(file_id, None)
+        if audio_file is None:
+            audio_file = AudioFile(self.file_paths[file_id],self.sr,mmap=self.mmap,keep_original=(self.get_mode=='audio_orig_sr'))
+            audio_file.extend(self.min_window_s)
+            if len(self.open_files) >= self.max_open_files:
+                self.open_files.popitem(last=False)
+        self.open_files[file_id] = audio_file
+        return audio_file
 
-        return mean, invstd
-        
-    def index_audio_file(self,audio_file,start_times,durations,min_window_s,max_window_s, hop_s=0.0):
+    def calculate_mean_and_invstd(self,num_workers=None):
         """
-        Given an audio_file and sorted annotations (start_times, durations), creates sequential segments and windows of postive and negative examples.
-        First, create sequential segments of min_window_s
-        [ segment: a tuple (start_idx,end_idx,label,audio_file) ]
-        Then split each segment into windows with max_window_s 
-
-        Arguments:
-            audio_file (AudioFile)
-            start_times (iterable)
-            durations (iterable)
-            min_window_s (float)
-            max_window_s (float)
-        Returns:
-            segments (list)
-            windows (list)
+        Per mel bin mean over the window means, and variance over all windows around it, in one pass.
+        The windows are split in contiguous chunks accumulated by `num_workers` processes (default: the CPUs available to the job).
         """
-        
-        # segments on and between annotations
-        segments = self.segments_from_annotations(
-            audio_file, start_times, durations, min_window_s
-            )
-        # split each segment into windows
-        windows = []
-        for segment in segments:
-            windows.extend(
-                self.split_segment_in_windows(audio_file, segment, max_window_s, hop_s)
-                )
-        
-        return segments, windows
+        num_workers = num_workers or available_cpus()
+        chunks = np.array_split(np.arange(len(self.windows)), 4*num_workers)
+        if num_workers == 1:
+            window_stats = [ accumulate_window_stats(self,indices) for indices in chunks ]
+        else:
+            with Pool(num_workers, initializer=init_stats_worker, initargs=(self,)) as pool:
+                window_stats = pool.map(worker_window_stats, chunks)
+
+        num_windows, mean, m2, variance_sum = reduce(merge_window_stats, window_stats)
+        # mean over the windows of mean((data-mean)**2) = mean of the window variances + variance of the window means
+        variance = (variance_sum + m2)/num_windows
+        invstd = 1/np.sqrt(variance)
+
+        return mean, invstd
+
+    def __getstate__(self):
+        # open files are not shared with worker processes, each opens its own
+        state = self.__dict__.copy()
+        state['open_files'] = OrderedDict()
+        return state
     
     def __len__(self):
         return len(self.windows)
     
     def __getitem__(self,index):
-        start_idx, end_idx, label, audio_file = self.windows[index]
+        file_id, start_idx, end_idx, label = self.windows[index]
         if self.jitter:
             # perturb windows so each audio file is processed slightly differently each epoch
             hop_idx = s_to_samples(self.hop_s, self.sr)
             perturb_min = min(start_idx, hop_idx)
-            perturb_max = min(audio_file.nsamples - end_idx, hop_idx)
+            perturb_max = min(self.nsamples[file_id] - end_idx, hop_idx)
             perturb_idx = np.random.randint(-perturb_min, perturb_max)
             start_idx += perturb_idx
             end_idx += perturb_idx
-        data = audio_file.get_window(start_idx, end_idx, self.get_mode)
+        data = self.audio_file(file_id).get_window(start_idx, end_idx, self.get_mode)
         if (self.mean is not None) and (self.invstd is not None) and ('audio' not in self.get_mode):
             data -= self.mean
             data *= self.invstd 
         if self.transform is not None:
             data = self.transform(data)
-        return data, label
-    
-    def segments_from_annotations(self,audio_file,start_times,durations,min_window_s):
-        sr = audio_file.sr
-        start_idxs = [s_to_samples(t,sr) for t in start_times]
-        duration_idxs = [s_to_samples(t,sr) for t in durations ]
-        min_window_idx = s_to_samples(min_window_s,sr)
-
-        # iterate through the annotations in order. if we find a jump
-        # add a negative segment. can deal with overlapping segments
-        segments, curr_idx, nsamples = [], 0, audio_file.nsamples 
-        for i in range(len(start_idxs)):
-            si, di = start_idxs[i], duration_idxs[i]
-            ei = si+di # end of segment
-
-            if si < nsamples: # prevent some errors
-
-                if (si-curr_idx) >= min_window_idx: # add negative segment if gap is large enough 
-                    segments.append((curr_idx,si,0,audio_file)) # use zero for negative
-
-                # add annotation directly if it's a minimum size 
-                if (di >= min_window_idx): 
-                    segments.append((si,min(ei,nsamples),1,audio_file)) # use one for positive
-                # extend annotation if possible (segment from master tape)
-                elif (si+min_window_idx) < nsamples: 
-                    ei = si+min_window_idx
-                    segments.append((si,ei,1,audio_file)) # use one for positive
-
-                curr_idx = ei
-
-        if (nsamples-curr_idx) >= min_window_idx: # adding empty segment at end
-            segments.append((curr_idx,nsamples,0,audio_file)) 
-        return segments
-    
-    def split_segment_in_windows(self,audio_file,segment,max_window_s, hop_s=0.0):
-        """
-        Splits a segment (start, end, label, wav) into non-overlapping chunks of window_size
-
-        An example illustration with (len = 7, window = 3, hop = 1)
-        Samples:    - - - - - - -
-        Indexes:    0 1 2 3 4 5 6
-        Windows:    * * * * *          total = 5
-        Formula:    (len - window)/hop + 1
-        """
-        si, ei, label, audio_file = segment  # si, ei are sample indexes of the segment
-        w = s_to_samples(max_window_s, audio_file.sr) 
-        # if no hop specified, defaults to hop=window size i.e. non-overlapping windows
-        hop = s_to_samples(hop_s, audio_file.sr) if hop_s > 0.0 else w
-        num_windows = (len(range(si,ei)) - w) // hop + 1
-
-        if num_windows == 0:
-            return [segment]  # smaller than max
-        else:
-            windows_list = []
-            for i in range(num_windows):
-                start = si + i*hop
-                end = start + w
-                current_window = (start, end, label, audio_file)
-                #TODO@Akash: support some random jitter when splitting into windows
-                windows_list.append(current_window)
-            return windows_list
+        return data, int(label)
     
     def plot_for_debug(self,audio_fname,mode='windows'):
-        plot_chunks, yi, sr = [], 0, self.audio_files[audio_fname].sr
-        if mode=='windows':
-            chunks = [ w for w in self.windows if w[-1].name == audio_fname ]
-        else: 
-            chunks = [ s for s in self.segments if s[-1].name == audio_fname ]
-        for c in chunks: # create line segments for each window
-            plot_chunks.append((c[0]/sr,c[1]/sr)) # convert index to time
+        import matplotlib.pyplot as plt
+
+        plot_chunks, yi, sr = [], 0, self.sr
+        file_id = [ p.name for p in self.file_paths ].index(audio_fname)
+        chunks = self.windows if mode=='windows' else self.segments
+        for c in chunks[chunks['file']==file_id]: # create line segments for each window
+            plot_chunks.append((c['start']/sr,c['end']/sr)) # convert index to time
             plot_chunks.append((yi,yi))
-            plot_chunks.append('g' if c[2]==1 else 'r')
+            plot_chunks.append('g' if c['label']==1 else 'r')
             yi += 0.1      
         _ = plt.plot(*plot_chunks)
         plt.show()
@@ -304,13 +389,14 @@ class AudioFileDataset(Dataset):
 
 class AudioFileWindower(AudioFileDataset):
     def __init__(self,
-        audio_file_paths,window_s=params.WINDOW_S, hop_s=0.0, mean=None,invstd=None,sr=params.SAMPLE_RATE,get_mode='mel_spec',transform=None):
+        audio_file_paths,window_s=params.WINDOW_S, hop_s=0.0, mean=None,invstd=None,sr=params.SAMPLE_RATE,get_mode='mel_spec',transform=None,mmap=False,max_open_files=64):
         """
-        load all wavfiles into memory (data is not too large so can get away with this, else use memmap option while reading wavfiles)
+        only reads the file headers, audio is loaded (or memory-mapped with `mmap`) when a window is requested
         """
         # 
         self.audio_file_paths = [ Path(p) for p in audio_file_paths ]
         self.window_s = window_s
+        self.min_window_s = window_s
         self.transform = transform
         self.jitter = False
         if (mean is not None) and (invstd is not None):
@@ -320,22 +406,23 @@ class AudioFileWindower(AudioFileDataset):
             self.mean, self.invstd = None, None
         assert get_mode in ['audio','spec','mel_spec']
         self.sr, self.get_mode = sr, get_mode
-        self.audio_files, self.segments, self.windows = {}, [], []
+        self.mmap, self.max_open_files = mmap, max_open_files
+        self.open_files = OrderedDict()
+
+        self.file_paths, nsamples = [], []
         for audio_file_path in self.audio_file_paths:
             print("Loading file:",audio_file_path.name)
             try:
-                audio_file = AudioFile(audio_file_path,self.sr)
-                audio_file.extend(self.window_s)
-                start_times, durations = [0.], [audio_file.duration]
-                wav_segments, wav_windows = self.index_audio_file(
-                    audio_file,start_times,durations,
-                    self.window_s, self.window_s, hop_s
-                    )
-                self.segments.extend(wav_segments)
-                self.windows.extend(wav_windows)
-                self.audio_files[audio_file_path.name] = audio_file 
+                nsamples.append(audio_nsamples(audio_file_path,self.sr,self.window_s))
+                self.file_paths.append(audio_file_path)
             except Exception as e:
                 print("Error with file:",audio_file_path.name,e)
+        # every file is a single annotation covering its whole duration
+        self.nsamples = np.array(nsamples, dtype=np.int64)
+        duration_idxs = (self.nsamples/self.sr*self.sr).astype(np.int64)
+        window_idx = s_to_samples(self.window_s,self.sr)
+        self.segments = segments_from_annotations(np.arange(len(self.nsamples)), np.zeros(len(self.nsamples), dtype=np.int64), duration_idxs, self.nsamples, window_idx)
+        self.windows = split_segments_in_windows(self.segments, window_idx, s_to_samples(hop_s,self.sr) if hop_s > 0.0 else window_idx)
 
 def debug_error_with_indexing():
     dataset = AudioFileDataset("../train_data/wav","../train_data/train.tsv",2,2)
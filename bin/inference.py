@@ -1,18 +1,16 @@
 #!/usr/bin/env python3
 
-import os, sys, json, glob
+import os, re, sys, json
 import torch
 import numpy as np
-import pandas as pd
 import params 
 import argparse
 
 from model import get_model_or_checkpoint
-from scipy.io import wavfile
-from collections import defaultdict
-from dataloader import AudioFileWindower 
+from dataloader import AudioFile, AudioFileWindower, audio_nsamples, s_to_samples, window_features
+from audio_io import list_audio
+from telemetry import telemetry
 from pathlib import Path
-from tqdm import tqdm
 
 
 """
@@ -30,7 +28,8 @@ Steps:
 class OrcaDetectionModel():
     def __init__(self, model_path, threshold=0.7, min_num_positive_calls_threshold=3, hop_s=2.45, rolling_avg=False, use_cuda=False):
         #i initialize model
-        self.model, _ = get_model_or_checkpoint(params.MODEL_NAME, model_path, use_cuda=use_cuda)
+        with telemetry.phase("model_load"):
+            self.model, _ = get_model_or_checkpoint(params.MODEL_NAME, model_path, use_cuda=use_cuda)
         self.model.eval()
         #self.mean = os.path.join(model_path, params.MEAN_FILE)
         #self.invstd = os.path.join(model_path, params.INVSTD_FILE)
@@ -41,6 +40,20 @@ class OrcaDetectionModel():
         self.hop_s = hop_s
         self.rolling_avg = rolling_avg
 
+    def predict_window(self, mel_spec_window):
+        """Runs the model on the mel spectrogram of a window and returns (prediction, confidence)."""
+        input_data = torch.from_numpy(mel_spec_window).float().unsqueeze(0).unsqueeze(0)
+        with telemetry.phase("forward"):
+            pred, _ = self.model(input_data)
+        telemetry.count("windows")
+        posterior = np.exp(pred.detach().cpu().numpy())
+
+        pred_id = 0
+        if posterior[0,1] > self.threshold:
+            pred_id = 1
+        confidence = round(float(posterior[0,1]),3)
+        return pred_id, confidence
+
     def split_and_predict(self, wav_file_path):
         """
         Args contains:
@@ -48,12 +61,14 @@ class OrcaDetectionModel():
             - model_path 
         """
 
+        from tqdm import tqdm
+
         # initialize parameters
         wavfile_path = wav_file_path
         chunk_duration=params.INFERENCE_CHUNK_S
 
         audio_file_windower = AudioFileWindower(
-                [wavfile_path], mean=self.mean, invstd=self.invstd, hop_s=self.hop_s
+                [wavfile_path], mean=self.mean, invstd=self.invstd, hop_s=self.hop_s, mmap=True
             )
         window_s = audio_file_windower.window_s
 
@@ -64,36 +79,33 @@ class OrcaDetectionModel():
             }
 
         # iterate through dataloader and add accumulate predictions
-        for i in tqdm(range(len(audio_file_windower))):
-            # get a mel spec for the window 
-            audio_file_windower.get_mode = 'mel_spec'
-            mel_spec_window, _ = audio_file_windower[i]
-            # run inference on window
-            input_data = torch.from_numpy(mel_spec_window).float().unsqueeze(0).unsqueeze(0)
-            pred, _ = self.model(input_data)
-            posterior = np.exp(pred.detach().cpu().numpy())
-
-            pred_id = 0
-            if posterior[0,1] > self.threshold:
-                pred_id = 1
-            confidence = round(float(posterior[0,1]),3)
+        try:
+            for i in tqdm(range(len(audio_file_windower))):
+                # get a mel spec for the window 
+                audio_file_windower.get_mode = 'mel_spec'
+                mel_spec_window, _ = audio_file_windower[i]
+                # run inference on window
+                pred_id, confidence = self.predict_window(mel_spec_window)
 
-            result_json["local_predictions"].append(pred_id)
-            result_json["local_confidences"].append(confidence)
+                result_json["local_predictions"].append(pred_id)
+                result_json["local_confidences"].append(confidence)
+        except Exception as e:
+            # the audio is only loaded with the first window, a file failing to load has no predictions
+            print("Error with file:", Path(wav_file_path).name, e)
+            result_json["local_predictions"], result_json["local_confidences"] = [], []
         
-        submission = pd.DataFrame(dict(
-            wav_filename=Path(wav_file_path).name,
-            start_time_s=[i*self.hop_s for i in range(len(audio_file_windower))],
-            duration_s=self.hop_s,
-            confidence=result_json['local_confidences']
-        ))
-
-        if self.rolling_avg:
-            rolling_scores = submission['confidence'].rolling(2).mean()
-            rolling_scores[0] = submission['confidence'][0]
-            submission['confidence'] = rolling_scores
-            result_json["local_confidences"] = submission['confidence'].tolist()
-        result_json['submission'] = submission
+        confidences = result_json["local_confidences"]
+        if self.rolling_avg and len(confidences) > 1:
+            confidences = [confidences[0]] + [(a + b) / 2 for a, b in zip(confidences[:-1], confidences[1:])]
+            result_json["local_confidences"] = confidences
+
+        # columns of a submission DataFrame, kept as lists so inference does not need pandas
+        result_json['submission'] = dict(
+            wav_filename=[Path(wav_file_path).name]*len(confidences),
+            start_time_s=[i*self.hop_s for i in range(len(confidences))],
+            duration_s=[self.hop_s]*len(confidences),
+            confidence=confidences
+        )
 
         return result_json
 
@@ -126,10 +138,286 @@ class OrcaDetectionModel():
         return result_json
 
     def predict(self, wav_file_path):
+        telemetry.count_input("inference", wav_file_path)
         result_json = self.split_and_predict(wav_file_path)
         result_json = self.aggregate_predictions(result_json)
         return result_json
 
+    def predict_stream(self, wav_file_paths, window_s=params.WINDOW_S, block_s=params.INFERENCE_CHUNK_S):
+        """
+        Treats consecutive segments of a stream as one continuous recording.
+
+        Windows are taken every `hop_s` across segment boundaries, plus one window
+        aligned with the end of the stream so the tail is covered. Every window is
+        reported in the segment it starts in, with its offset in `window_offsets_s`.
+        The segments are memory-mapped and read in blocks of `block_s` into a rolling
+        window buffer, so the stream never has to fit in memory.
+
+        Returns:
+            Dictionary of file name to aggregated result_json, in stream order.
+        """
+        sr = params.SAMPLE_RATE
+        window, hop = s_to_samples(window_s, sr), s_to_samples(self.hop_s, sr)
+
+        # segment lengths from the headers, the audio is read when the windows reach it
+        names, lengths = [], []
+        for wav_file_path in wav_file_paths:
+            telemetry.count_input("inference", wav_file_path)
+            names.append(Path(wav_file_path).name)
+            try:
+                lengths.append(audio_nsamples(wav_file_path, sr, 0))
+            except Exception as e:
+                print("Error with file:", names[-1], e)
+                lengths.append(0)
+        boundaries = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+
+        results = {name: {"local_predictions": [], "local_confidences": [], "window_offsets_s": []} for name in names}
+        if boundaries[-1] == 0:
+            return {name: self.aggregate_predictions(result_json) for name, result_json in results.items()}
+
+        block = s_to_samples(block_s, sr)
+
+        def segment_blocks():
+            for wav_file_path, name, nsamples in zip(wav_file_paths, names, lengths):
+                if nsamples == 0:
+                    continue
+                try:
+                    audio_file = AudioFile(wav_file_path, sr, mmap=True)
+                except Exception as e:
+                    # keep the offsets of the following segments, the segment is silence
+                    print("Error with file:", name, e)
+                    audio_file = None
+                for i in range(0, nsamples, block):
+                    end = min(i + block, nsamples)
+                    samples = audio_file.get_window(i, end, 'audio') if audio_file is not None else np.zeros(0, dtype=np.float32)
+                    # pad to the header length if the decoded segment is shorter
+                    yield np.pad(samples, (0, end - i - len(samples)))
+
+        if boundaries[-1] < window:
+            # a stream shorter than a window is tiled to one window, like a short file
+            stream = AudioFile.from_array("stream", np.concatenate(list(segment_blocks())), sr)
+            stream.extend(window_s)
+            windows = [(0, stream.get_window(0, window, 'audio'))]
+        else:
+            starts = list(range(0, boundaries[-1] - window + 1, hop))
+            if starts[-1] + window < boundaries[-1]:
+                starts.append(boundaries[-1] - window)
+            windows = sliding_windows(segment_blocks(), starts, window)
+
+        mean, invstd = None, None
+        if (self.mean is not None) and (self.invstd is not None):
+            mean, invstd = np.loadtxt(self.mean), np.loadtxt(self.invstd)
+
+        from tqdm import tqdm
+
+        starts, predictions, confidences = [], [], []
+        for start, samples in tqdm(windows):
+            mel_spec_window = window_features(samples, sr, 'mel_spec')
+            if mean is not None:
+                mel_spec_window = (mel_spec_window - mean) * invstd
+            pred_id, confidence = self.predict_window(mel_spec_window)
+            starts.append(start)
+            predictions.append(pred_id)
+            confidences.append(confidence)
+
+        if self.rolling_avg and len(confidences) > 1:
+            confidences = [confidences[0]] + [(a + b) / 2 for a, b in zip(confidences[:-1], confidences[1:])]
+
+        # map the windows back to the segment they start in
+        segments = np.searchsorted(boundaries, starts, side="right") - 1
+        for start, segment, pred_id, confidence in zip(starts, segments, predictions, confidences):
+            result_json = results[names[segment]]
+            result_json["local_predictions"].append(pred_id)
+            result_json["local_confidences"].append(confidence)
+            result_json["window_offsets_s"].append(round((start - boundaries[segment]) / sr, 3))
+
+        return {name: self.aggregate_predictions(result_json) for name, result_json in results.items()}
+
+    def predict_span(self, source, offset_s, duration_s, window_s=params.WINDOW_S, block_s=params.INFERENCE_CHUNK_S):
+        """
+        Runs the model on the windows starting in [offset_s, offset_s + duration_s) of a long recording.
+
+        The span (plus one window, so windows straddling the end of the span are complete) is decoded
+        by ffmpeg and read in blocks of `block_s`, so memory does not depend on the recording length.
+
+        Returns:
+            Aggregated result_json, with `window_offsets_s` relative to the start of the recording.
+        """
+        sr = params.SAMPLE_RATE
+        telemetry.count_input("inference")
+        window, hop = s_to_samples(window_s, sr), s_to_samples(self.hop_s, sr)
+        span = s_to_samples(duration_s, sr)
+
+        mean, invstd = None, None
+        if (self.mean is not None) and (self.invstd is not None):
+            mean, invstd = np.loadtxt(self.mean), np.loadtxt(self.invstd)
+
+        result_json = {"local_predictions": [], "local_confidences": [], "window_offsets_s": [], "offset_s": offset_s}
+        blocks = stream_audio(source, offset_s, duration_s + window_s, sr, s_to_samples(block_s, sr))
+        for start, samples in sliding_windows(blocks, range(0, span, hop), window):
+            mel_spec_window = window_features(samples, sr, 'mel_spec')
+            if mean is not None:
+                mel_spec_window = (mel_spec_window - mean) * invstd
+            pred_id, confidence = self.predict_window(mel_spec_window)
+            result_json["local_predictions"].append(pred_id)
+            result_json["local_confidences"].append(confidence)
+            result_json["window_offsets_s"].append(round(offset_s + start / sr, 3))
+
+        confidences = result_json["local_confidences"]
+        if self.rolling_avg and len(confidences) > 1:
+            result_json["local_confidences"] = [confidences[0]] + [(a + b) / 2 for a, b in zip(confidences[:-1], confidences[1:])]
+        return self.aggregate_predictions(result_json)
+
+
+def sliding_windows(blocks, starts, window):
+    """
+    Yields (start, samples) for the windows of `window` samples at the increasing `starts` of a
+    stream read in blocks, as soon as the blocks cover them. Only the samples from the next
+    window start on are kept, so memory is bounded by a window and a block. Windows past the
+    end of the stream are not yielded, and no block is read after the last window.
+    """
+    starts = iter(starts)
+    start = next(starts, None)
+    buffer, buffer_start = np.zeros(0, dtype=np.float32), 0
+    for block in blocks:
+        if start is None:
+            return
+        buffer = np.concatenate([buffer, block])
+        while start is not None and start + window <= buffer_start + len(buffer):
+            i = start - buffer_start
+            yield start, buffer[i:i + window]
+            start = next(starts, None)
+        if start is None:
+            return
+        # drop the samples no later window needs, with a hop longer than the window the
+        # next window may start past the buffer and the rest is dropped from later blocks
+        drop = min(start - buffer_start, len(buffer))
+        buffer, buffer_start = buffer[drop:], buffer_start + drop
+
+
+def stream_audio(source, offset_s, duration_s, sr, block_samples):
+    """
+    Decodes `duration_s` seconds of a local file or URL from `offset_s` with ffmpeg,
+    yielding mono float32 blocks of at most `block_samples` samples at `sr`.
+    """
+    import ffmpeg
+
+    process = (
+        ffmpeg.input(source, ss=offset_s, t=duration_s)
+        .output("pipe:", format="f32le", acodec="pcm_f32le", ac=1, ar=sr)
+        .global_args("-nostdin", "-loglevel", "error")
+        .run_async(pipe_stdout=True)
+    )
+    finished = False
+    try:
+        while True:
+            with telemetry.phase("decode"):
+                data = process.stdout.read(block_samples * 4)
+            telemetry.count("bytes_decoded", len(data))
+            if not data:
+                finished = True
+                break
+            yield np.frombuffer(data[:len(data) - len(data) % 4], dtype=np.float32)
+    finally:
+        process.stdout.close()
+        # stopping early closes the pipe under ffmpeg, only a finished decode must exit cleanly
+        if process.wait() != 0 and finished:
+            print("Warning: ffmpeg exited with code {} for {}".format(process.returncode, source))
+
+
+def segment_order(file_path):
+    """Sort key putting `live10.wav` after `live9.wav`."""
+    name = Path(file_path).name
+    number = re.search(r"(\d+)", name)
+    return (int(number.group(1)) if number else -1, name)
+
+
+def read_checkpoint(checkpoint):
+    """Returns the results of the files completed in a checkpoint, skipping a partial last line."""
+    results = {}
+    if checkpoint is None or not os.path.isfile(checkpoint):
+        return results
+    with open(checkpoint, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            results[entry["file"]] = entry["result"]
+    return results
+
+
+def create_checkpoint(checkpoint):
+    """
+    Creates an empty checkpoint if there is none, at the start of the job, so a job evicted
+    before its first file completes still has a checkpoint to transfer back and resume from.
+    """
+    if checkpoint is None:
+        return
+    Path(os.path.dirname(checkpoint) or ".").mkdir(parents=True, exist_ok=True)
+    open(checkpoint, "a").close()
+
+
+def append_checkpoint(checkpoint, results):
+    """Appends the results of completed files to a checkpoint, one JSON line per file."""
+    if checkpoint is None:
+        return
+    Path(os.path.dirname(checkpoint) or ".").mkdir(parents=True, exist_ok=True)
+    with open(checkpoint, "a+") as f:
+        # terminate a partial line from an interrupted job
+        if f.tell() > 0:
+            f.seek(f.tell() - 1)
+            if f.read(1) != "\n":
+                f.write("\n")
+        for name, result in results.items():
+            f.write(json.dumps({"file": name, "result": result}) + "\n")
+
+
+def predict_dir(orca_model, input_dir, stitch=False, checkpoint=None):
+    """
+    Runs the model on every `.wav` (or `.flac`) file of a directory and returns the results keyed by file name.
+    With `stitch` the files are treated as consecutive segments of one stream.
+
+    With a `checkpoint` the result of every file is saved as soon as it completes, and the files
+    already in the checkpoint are not run again, so a preempted job resumes where it stopped.
+    Stitched files depend on each other and are saved and skipped all together.
+    """
+    keys = ["local_predictions", "local_confidences", "global_prediction", "global_confidence"]
+    done = read_checkpoint(checkpoint)
+    if stitch:
+        input_wavs = sorted(list_audio(input_dir), key=segment_order)
+        names = [Path(input_wav).name for input_wav in input_wavs]
+        if names and all(name in done for name in names):
+            return {name: done[name] for name in names}
+        stream_results = orca_model.predict_stream(input_wavs)
+        results = {name: {k: result_json[k] for k in keys + ["window_offsets_s"]} for name, result_json in stream_results.items()}
+        append_checkpoint(checkpoint, results)
+        return results
+
+    results = {}
+    for input_wav in list_audio(input_dir):
+        name = Path(input_wav).name
+        if name in done:
+            results[name] = done[name]
+            continue
+        result_json = orca_model.predict(input_wav)
+        results[name] = {"local_predictions": result_json["local_predictions"], 
+        "local_confidences": result_json["local_confidences"],
+        "global_prediction": result_json["global_prediction"], 
+        "global_confidence": result_json["global_confidence"]}
+        append_checkpoint(checkpoint, {name: results[name]})
+    return results
+
+
+def write_predictions(output, sensor, timestamp, results):
+    final_json = {sensor: {timestamp: [results]}}
+
+    Path(os.path.dirname(output) or ".").mkdir(parents=True, exist_ok=True)
+    with telemetry.phase("serialization"):
+        with open(output, 'w') as f:
+            json.dump(final_json, f)
+    telemetry.count_file("bytes_written", output)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -138,14 +426,16 @@ if __name__ == "__main__":
     parser.add_argument(
         "-i",
         "--input-dir",
-        default=".",
-        help="Path to the input directory with `.wav` files. Default is `.`",
+        nargs="+",
+        default=["."],
+        help="Paths to the input directories with `.wav` files. Default is `.`",
     )
     parser.add_argument(
         "-o",
         "--output",
-        default="predictions.json",
-        help="Path to the predictions file. Default is `predictions.json`.",
+        nargs="+",
+        default=["predictions.json"],
+        help="Paths to the predictions files, one per input directory. Default is `predictions.json`.",
     )
     parser.add_argument(
         "-s",
@@ -156,8 +446,9 @@ if __name__ == "__main__":
     parser.add_argument(
         "-t",
         "--timestamp",
-        default="_",
-        help="Timestamp to be saved in predictions file.",
+        nargs="+",
+        default=["_"],
+        help="Timestamps to be saved in predictions files, one per input directory.",
     )
     parser.add_argument(
         "-c",
@@ -172,19 +463,63 @@ if __name__ == "__main__":
         help="Path to the model that will be used for inference. Default is `model.pkl`.",
     )
 
+    parser.add_argument(
+        "--stitch",
+        action="store_true",
+        help="Treat the files of each input directory as consecutive segments of one stream, windowing across segment boundaries.",
+    )
+    parser.add_argument(
+        "-u",
+        "--url",
+        help="Local path or URL of a long recording to stream instead of input directories. Requires `--duration`.",
+    )
+    parser.add_argument(
+        "--offset",
+        type=float,
+        default=0,
+        help="Offset in seconds of the span of `--url` to run the model on. Default is 0.",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        help="Duration in seconds of the span of `--url` to run the model on.",
+    )
+    parser.add_argument(
+        "--no-checkpoint",
+        action="store_true",
+        help="Do not save the results of completed files to `<output>.ckpt`. By default a restarted job skips the files in the checkpoint.",
+    )
+    parser.add_argument(
+        "--metrics",
+        default=None,
+        help="Path to the JSON metrics sidecar of the job. Default is a file in the directory of `$ORCASOUND_METRICS` if set, else no metrics.",
+    )
+
     args = parser.parse_args()
+    telemetry.configure("inference", args.metrics)
+    if args.url:
+        if args.duration is None:
+            parser.error("--url requires --duration")
+        telemetry.record_inputs(1)
+        orca_model = OrcaDetectionModel(args.model, use_cuda=args.cuda)
+        result_json = orca_model.predict_span(args.url, args.offset, args.duration)
+        keys = ["local_predictions", "local_confidences", "global_prediction", "global_confidence", "window_offsets_s", "offset_s"]
+        results = {Path(args.url).name: {k: result_json[k] for k in keys}}
+        write_predictions(args.output[0], args.sensor, args.timestamp[0], results)
+        sys.exit(0)
+
+    if not len(args.input_dir) == len(args.output) == len(args.timestamp):
+        parser.error("expected one output file and timestamp per input directory")
     
+    # files in the checkpoint are inputs of the job too, although they are not run again
+    telemetry.record_inputs(sum(len(list_audio(input_dir)) for input_dir in args.input_dir))
+    checkpoints = [None if args.no_checkpoint else output + ".ckpt" for output in args.output]
+    for checkpoint in checkpoints:
+        create_checkpoint(checkpoint)
     orca_model = OrcaDetectionModel(args.model, use_cuda=args.cuda)
-    results = {}
-    for input_wav in sorted(glob.glob(os.path.join(args.input_dir, "*.wav"))):
-        result_json = orca_model.predict(input_wav)
-        results[Path(input_wav).name] = {"local_predictions": result_json["local_predictions"], 
-        "local_confidences": result_json["local_confidences"],
-        "global_prediction": result_json["global_prediction"], 
-        "global_confidence": result_json["global_confidence"]}
-
-    final_json = {args.sensor: {args.timestamp: [results]}}
-
-    with open(args.output, 'w') as f:
-        json.dump(final_json, f)
-
+    for input_dir, timestamp, output, checkpoint in zip(args.input_dir, args.timestamp, args.output, checkpoints):
+        results = predict_dir(orca_model, input_dir, args.stitch, checkpoint)
+        write_predictions(output, args.sensor, timestamp, results)
+        # emptied rather than removed, the workflow stages it out with the job
+        if checkpoint:
+            open(checkpoint, "w").close()
@@ -2,14 +2,17 @@
 
 import json
 from argparse import ArgumentParser
+from telemetry import telemetry
 
 
 def merge_predictions(input_files):
     merged_json = None
     json_data = None
     for input_file in input_files:
-        with open(input_file, 'r') as f:
-            json_data = json.load(f)
+        with telemetry.phase("load"):
+            with open(input_file, 'r') as f:
+                json_data = json.load(f)
+        telemetry.count_input("merge", input_file)
 
         if not merged_json:
             merged_json = json_data
@@ -33,13 +36,18 @@ def main():
     parser = ArgumentParser(description="Merge orcasound predictions")
     parser.add_argument("-i", "--input", metavar="INPUT_FILE", nargs='+', help="List of JSON files to be merged.", required=True)
     parser.add_argument("-o", "--output", metavar="OUTPUT_FILE", type=str, default="predictions.json", help="Output file name. Default is `predictions.json`.")
+    parser.add_argument("--metrics", metavar="METRICS_FILE", type=str, default=None, help="JSON metrics sidecar of the job. Default is a file in the directory of `$ORCASOUND_METRICS` if set, else no metrics.")
 
     args = parser.parse_args()
+    telemetry.configure("merge", args.metrics)
+    telemetry.record_inputs(len(args.input))
 
     merged_json = merge_predictions(args.input)
 
-    with open(args.output, 'w') as g:
-        json.dump(merged_json, g)
+    with telemetry.phase("serialization"):
+        with open(args.output, 'w') as g:
+            json.dump(merged_json, g)
+    telemetry.count_file("bytes_written", args.output)
 
 
 if __name__ == "__main__":
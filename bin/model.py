@@ -13,10 +13,6 @@ import params
 from torch.autograd import Variable
 from torch.utils.data import Dataset
 
-# deal with a known bug in sklearn that pollutes stdout: https://stackoverflow.com/questions/52596204/the-imp-module-is-deprecated
-with contextlib.redirect_stderr(None):
-    from sklearn import metrics
-
 
 class BasicBlock_slim(nn.Module):
     def __init__(self, planes):
@@ -199,24 +195,43 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 class PredScorer(object):
-    "Maintains lists of preds, targets, f1 scores, and logs classification details"
-    def __init__(self):
+    "Maintains running confusion matrix counts, f1 scores, and logs classification details"
+    def __init__(self,num_classes=2):
+        self.num_classes = num_classes
         self.reset()
     
     def reset(self):
-        self.preds_list = []
-        self.targets_list = []
+        # counts[target,pred]
+        self.counts = np.zeros((self.num_classes,self.num_classes),dtype=np.int64)
         self.F1_global = 0
+        self.accuracy = 0
+        self.precision = 0
+        self.recall = 0
     
     def update(self,targets,preds):
-        for pred in preds.cpu().numpy(): self.preds_list.append(pred)
-        for target in targets.cpu().numpy(): self.targets_list.append(target)
-        self.F1_global = metrics.f1_score(self.targets_list,self.preds_list)
-        self.accuracy = metrics.accuracy_score(self.targets_list,self.preds_list)
+        targets, preds = targets.cpu().numpy().astype(np.int64), preds.cpu().numpy().astype(np.int64)
+        self.counts += np.bincount(
+            targets*self.num_classes+preds,minlength=self.num_classes**2
+            ).reshape(self.num_classes,self.num_classes)
+        # binary scores of the positive class, 0 when undefined as in sklearn
+        tp = self.counts[1,1]
+        fp, fn = self.counts[:,1].sum()-tp, self.counts[1,:].sum()-tp
+        self.precision = tp/(tp+fp) if tp+fp else 0.
+        self.recall = tp/(tp+fn) if tp+fn else 0.
+        self.F1_global = 2*tp/(2*tp+fp+fn) if tp+fp+fn else 0.
+        self.accuracy = np.trace(self.counts)/self.counts.sum()
     
     def log_classification_report(self,logger,iteration,epoch):
-        cl_report = metrics.classification_report(self.targets_list,self.preds_list)
-        conf_mat = metrics.confusion_matrix(self.targets_list,self.preds_list)
+        # sklearn is only needed for training reports, imported here to keep inference startup short
+        # deal with a known bug in sklearn that pollutes stdout: https://stackoverflow.com/questions/52596204/the-imp-module-is-deprecated
+        with contextlib.redirect_stderr(None):
+            from sklearn import metrics
+        # expand the counts into (target,pred) pairs, the report only depends on the counts
+        labels = np.arange(self.num_classes)
+        targets = np.repeat(np.repeat(labels,self.num_classes),self.counts.ravel())
+        preds = np.repeat(np.tile(labels,self.num_classes),self.counts.ravel())
+        cl_report = metrics.classification_report(targets,preds)
+        conf_mat = metrics.confusion_matrix(targets,preds)
         logger.info(
             "### Iteration {}, Epoch {}, Accuracy {:.2f} ###\nCL Report:\n{}ConfMat:\n{}".format(iteration,epoch,self.accuracy,cl_report,conf_mat)
             )
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import logging
+import os
+import sys
+import tempfile
+from os import path
+
+from audio_io import list_audio
+from convert2wav import convert2wav, convert2wav_prefetch, create_s3_client
+from convert2spectrogram import create_spec_name, save_spectrogram
+from inference import OrcaDetectionModel, create_checkpoint, predict_dir, write_predictions
+from telemetry import telemetry
+
+
+def process_chunk(orca_model, input_dir, png_dir, sensor, timestamp, output, nfft=256, work_dir=None, bucket=None, keys=None, s3_client=None, prefetch_workers=16, pack=False, audio_format="wav", sample_rate=48000, stitch=False, checkpoint=None):
+    """
+    Runs convert2wav, convert2spectrogram and inference on a directory of `.ts` files.
+
+    The decoded `.wav` files are written to a temporary directory under `work_dir`
+    and removed once the spectrograms and predictions have been written.
+
+    Args:
+        `orca_model`: The `OrcaDetectionModel` used for inference.
+        `input_dir`: Path to the input directory with `.ts` files.
+        `png_dir`: Path to the output directory for spectrograms, or to the spectrogram archive with `pack`.
+        `sensor`: Sensor name to be saved in predictions file.
+        `timestamp`: Timestamp to be saved in predictions file.
+        `output`: Path to the predictions file.
+        `nfft`: The number of data points used in each block for the FFT.
+        `work_dir`: Directory for the decoded audio. Default is the system temporary directory.
+        `bucket`: S3 bucket to fetch `keys` from.
+        `keys`: S3 keys of the `.ts` files in `input_dir` to fetch before converting them.
+        `s3_client`: botocore S3 client used to fetch `keys`.
+        `prefetch_workers`: Number of concurrent downloads.
+        `pack`: Pack the spectrograms in one archive instead of one file per segment.
+        `audio_format`: Format of the decoded audio, one of `wav`, `mono16` or `flac`.
+        `sample_rate`: Sample rate of the `mono16` and `flac` formats.
+        `stitch`: Treat the segments as one continuous stream during inference.
+        `checkpoint`: Path to the inference checkpoint. The results of completed files are saved
+            to it, and a restarted job decodes every file again but only runs the model on the others.
+    Returns:
+        None
+    """
+    # the job creates its own output directories, the workflow has no mkdir jobs
+    os.makedirs(path.dirname(png_dir) or "." if pack else png_dir, exist_ok=True)
+    os.makedirs(path.dirname(output) or ".", exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=work_dir) as wav_dir:
+        if keys:
+            convert2wav_prefetch(bucket, keys, {input_dir: wav_dir}, prefetch_workers, s3_client, audio_format, sample_rate)
+        else:
+            convert2wav(input_dir, wav_dir, audio_format, sample_rate)
+
+        # spectrograms first, inference may resample the wav files in place
+        input_wavs = list_audio(wav_dir)
+        if pack:
+            from spectrogram_archive import SpectrogramArchive
+
+            with SpectrogramArchive(png_dir) as archive:
+                for input_wav in input_wavs:
+                    save_spectrogram(input_wav, nfft=nfft, archive=archive)
+        else:
+            for input_wav in input_wavs:
+                save_spectrogram(input_wav, create_spec_name(input_wav, png_dir), nfft)
+
+        results = predict_dir(orca_model, wav_dir, stitch, checkpoint)
+        write_predictions(output, sensor, timestamp, results)
+        # emptied rather than removed, the workflow stages it out with the job
+        if checkpoint:
+            open(checkpoint, "w").close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(levelname)s:%(message)s", stream=sys.stdout, level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(
+        description="Creates spectrograms and predictions for each .ts file in the input directories."
+    )
+    parser.add_argument(
+        "-i",
+        "--input-dir",
+        nargs="+",
+        default=["."],
+        help="Paths to the input directories with `.ts` files. Default is `.`",
+    )
+    parser.add_argument(
+        "-p",
+        "--png-dir",
+        nargs="+",
+        default=["png"],
+        help="Paths to the output directories for spectrograms, one per input directory. Default is `png`.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        nargs="+",
+        default=["predictions.json"],
+        help="Paths to the predictions files, one per input directory. Default is `predictions.json`.",
+    )
+    parser.add_argument(
+        "-s",
+        "--sensor",
+        default="_",
+        help="Sensor name to be saved in predictions file.",
+    )
+    parser.add_argument(
+        "-t",
+        "--timestamp",
+        nargs="+",
+        default=["_"],
+        help="Timestamps to be saved in predictions files, one per input directory.",
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        default="model.pkl",
+        help="Path to the model that will be used for inference. Default is `model.pkl`.",
+    )
+    parser.add_argument(
+        "-n",
+        "--nfft",
+        type=int,
+        default=256,
+        help="The number of data points used in each block for the FFT. A power 2 is most efficient. Default is %(default)s.",
+    )
+    parser.add_argument(
+        "-c",
+        "--cuda",
+        action="store_true",
+        help="Enable CUDA.",
+    )
+    parser.add_argument(
+        "-w",
+        "--work-dir",
+        default=None,
+        help="Local directory for the decoded audio. Default is the system temporary directory.",
+    )
+    parser.add_argument(
+        "-b",
+        "--bucket",
+        default="streaming-orcasound-net",
+        help="S3 bucket to fetch `--keys` from. Default is `streaming-orcasound-net`.",
+    )
+    parser.add_argument(
+        "-k",
+        "--keys",
+        nargs="+",
+        default=None,
+        help="S3 keys of the `.ts` files to fetch into the input directories before processing them.",
+    )
+    parser.add_argument(
+        "--prefetch-workers",
+        type=int,
+        default=16,
+        help="Number of concurrent downloads with `--keys`. Default is %(default)s.",
+    )
+    parser.add_argument(
+        "--pack",
+        action="store_true",
+        help="Pack the spectrograms of each input directory in one archive. The spectrogram paths are the archives.",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=["wav", "mono16", "flac"],
+        default="wav",
+        help="Format of the decoded audio: `wav` (ffmpeg defaults), `mono16` or `flac` (mono 16-bit at `--sample-rate`). Default is `wav`.",
+    )
+    parser.add_argument(
+        "-r",
+        "--sample-rate",
+        type=int,
+        default=48000,
+        help="Sample rate of the `mono16` and `flac` formats. Default is %(default)s.",
+    )
+    parser.add_argument(
+        "--stitch",
+        action="store_true",
+        help="Treat the segments of each input directory as one stream during inference, windowing across segment boundaries.",
+    )
+    parser.add_argument(
+        "--no-checkpoint",
+        action="store_true",
+        help="Do not save the inference results of completed files to `<output>.ckpt`. By default a restarted job skips the model on the files in the checkpoint.",
+    )
+    parser.add_argument(
+        "--metrics",
+        default=None,
+        help="Path to the JSON metrics sidecar of the job. Default is a file in the directory of `$ORCASOUND_METRICS` if set, else no metrics.",
+    )
+    args = parser.parse_args()
+    # the .ts files are the inputs, not the intermediate audio read by the later stages
+    telemetry.configure("process_chunk", args.metrics, input_stage="convert2wav")
+    telemetry.record_inputs(len(args.keys) if args.keys else sum(len(glob.glob(path.join(i, "*.ts"))) for i in args.input_dir))
+    if not len(args.input_dir) == len(args.png_dir) == len(args.output) == len(args.timestamp):
+        parser.error("expected one spectrogram directory, output file and timestamp per input directory")
+
+    s3_client = create_s3_client(max_pool_connections=args.prefetch_workers) if args.keys else None
+    checkpoints = [None if args.no_checkpoint else output + ".ckpt" for output in args.output]
+    for checkpoint in checkpoints:
+        create_checkpoint(checkpoint)
+    orca_model = OrcaDetectionModel(args.model, use_cuda=args.cuda)
+    for input_dir, png_dir, timestamp, output, checkpoint in zip(args.input_dir, args.png_dir, args.timestamp, args.output, checkpoints):
+        input_dir = path.normpath(input_dir)
+        keys = [k for k in args.keys if path.dirname(k) == input_dir] if args.keys else None
+        process_chunk(orca_model, input_dir, png_dir, args.sensor, timestamp, output, args.nfft, args.work_dir, args.bucket, keys, s3_client, args.prefetch_workers, args.pack, args.format, args.sample_rate, args.stitch, checkpoint)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+import zipfile
+from os import path
+from pathlib import Path
+
+
+class SpectrogramArchive:
+    """Packs the spectrograms of a job in a single uncompressed zip archive, one `<segment>.png` member per segment.
+
+    The zip central directory indexes the members, so a single spectrogram can be read
+    without unpacking the rest. PNGs are already compressed, members are stored as is.
+    """
+
+    def __init__(self, archive_path):
+        Path(path.dirname(archive_path) or ".").mkdir(parents=True, exist_ok=True)
+        self.archive_path = archive_path
+        self.archive = zipfile.ZipFile(archive_path, "w", compression=zipfile.ZIP_STORED)
+
+    def add(self, segment, data):
+        """Adds the PNG bytes of a segment to the archive."""
+        self.archive.writestr(f"{segment}.png", data)
+
+    def close(self):
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def list_spectrograms(archive_path):
+    """Returns the segment names in a spectrogram archive."""
+    with zipfile.ZipFile(archive_path) as archive:
+        return [path.splitext(name)[0] for name in archive.namelist()]
+
+
+def read_spectrogram(archive_path, segment):
+    """Returns the PNG bytes of a segment (e.g. `live0` or `live0.ts`) from a spectrogram archive."""
+    segment = path.splitext(path.basename(segment))[0]
+    with zipfile.ZipFile(archive_path) as archive:
+        return archive.read(f"{segment}.png")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Lists or extracts spectrograms from a spectrogram archive."
+    )
+    parser.add_argument(
+        "archive",
+        help="Path to the spectrogram archive.",
+    )
+    parser.add_argument(
+        "segments",
+        nargs="*",
+        help="Segments to extract. Lists the archive if none is given.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        default=".",
+        help="Path to the output directory for extracted spectrograms. Default is `.`",
+    )
+    args = parser.parse_args()
+
+    if not args.segments:
+        for segment in list_spectrograms(args.archive):
+            print(segment)
+        sys.exit(0)
+
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    for segment in args.segments:
+        output_file = path.join(args.output_dir, path.splitext(path.basename(segment))[0] + ".png")
+        with open(output_file, "wb") as f:
+            f.write(read_spectrogram(args.archive, segment))
+        print(output_file)
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+from os import path
+
+from convert2wav import audio_extension, convert_with_ffmpeg, create_s3_client, fetch_object
+from inference import OrcaDetectionModel
+from telemetry import telemetry
+
+
+def segment_number(name):
+    """Returns the number of `liveN.ts`, or -1 for other names."""
+    match = re.match(r"^live(\d+)\.ts$", name)
+    return int(match.group(1)) if match else -1
+
+
+def playlist_segments(playlist):
+    """Returns the segment numbers listed in the text of an HLS playlist."""
+    lines = (line.strip() for line in playlist.splitlines())
+    return [segment_number(path.basename(line)) for line in lines if line and not line.startswith("#")]
+
+
+class LocalHLS:
+    """
+    HLS stream of a sensor in a local directory, `<root>/<sensor>/hls/<timestamp>/live<n>.ts`.
+
+    A segment is complete once the playlist lists it, a newer segment exists, or it has not
+    been modified for `settle_s` seconds.
+    """
+    def __init__(self, root, sensor, settle_s=2.0):
+        self.hls_dir = path.join(root, sensor, "hls")
+        self.settle_s = settle_s
+
+    def timestamps(self):
+        if not path.isdir(self.hls_dir):
+            return []
+        return sorted(int(name) for name in os.listdir(self.hls_dir) if name.isdigit())
+
+    def last_segment(self, ts, finished=False):
+        """
+        Returns the number of the newest complete segment of a timestamp, -1 if there is none.
+        Every segment of a `finished` timestamp is complete.
+        """
+        ts_dir = path.join(self.hls_dir, str(ts))
+        newest = max(map(segment_number, os.listdir(ts_dir)), default=-1)
+        if newest < 0 or finished:
+            return newest
+        playlist = path.join(ts_dir, "live.m3u8")
+        listed = -1
+        if path.isfile(playlist):
+            with open(playlist, "r") as f:
+                listed = max(playlist_segments(f.read()), default=-1)
+        settled = time.time() - self.modified(ts, newest) >= self.settle_s
+        return max(listed, newest if settled else newest - 1)
+
+    def modified(self, ts, n):
+        """Returns the time segment `n` of timestamp `ts` was last written."""
+        return path.getmtime(path.join(self.hls_dir, str(ts), "live{}.ts".format(n)))
+
+    def fetch(self, ts, n, work_dir):
+        return path.join(self.hls_dir, str(ts), "live{}.ts".format(n))
+
+
+class S3HLS:
+    """
+    HLS stream of a sensor in an S3 bucket, `<sensor>/hls/<timestamp>/live<n>.ts`.
+
+    Objects are complete once listed, the playlist is read first and the directory only
+    listed when there is no playlist.
+    """
+    def __init__(self, bucket, sensor, s3_client=None):
+        self.bucket = bucket
+        self.prefix = "{}/hls/".format(sensor)
+        self.s3_client = s3_client or create_s3_client(max_pool_connections=4)
+        self.known = set()
+
+    def timestamps(self):
+        # after the first listing only the directories after the newest known one are listed
+        kwargs = {"Bucket": self.bucket, "Prefix": self.prefix, "Delimiter": "/"}
+        if self.known:
+            kwargs["StartAfter"] = "{}{}/".format(self.prefix, max(self.known))
+        for page in self.s3_client.get_paginator("list_objects_v2").paginate(**kwargs):
+            for common_prefix in page.get("CommonPrefixes", []):
+                name = common_prefix["Prefix"][len(self.prefix):].strip("/")
+                if name.isdigit():
+                    self.known.add(int(name))
+        return sorted(self.known)
+
+    def last_segment(self, ts, finished=False):
+        """
+        Returns the number of the newest segment of a timestamp, -1 if there is none.
+        Objects are complete once they exist, so `finished` makes no difference.
+        """
+        from botocore.exceptions import ClientError
+
+        ts_prefix = "{}{}/".format(self.prefix, ts)
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=ts_prefix + "live.m3u8")
+            return max(playlist_segments(response["Body"].read().decode("utf8")), default=-1)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                raise e
+
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        numbers = [-1]
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=ts_prefix):
+            numbers.extend(segment_number(path.basename(obj["Key"])) for obj in page.get("Contents", []))
+        return max(numbers)
+
+    def modified(self, ts, n):
+        """Segments are not stat'ed, the latency is counted from the poll that found them."""
+        return None
+
+    def fetch(self, ts, n, work_dir):
+        key = "{}{}/live{}.ts".format(self.prefix, ts, n)
+        return fetch_object(self.s3_client, self.bucket, key, path.join(work_dir, path.basename(key)))
+
+
+def completed_segments(output):
+    """Returns the newest segment number per timestamp already in a detections file."""
+    done = {}
+    if not path.isfile(output):
+        return done
+    with open(output, "r") as f:
+        for line in f:
+            try:
+                detection = json.loads(line)
+            except ValueError:
+                # a partial line from an interrupted run
+                continue
+            done[detection["timestamp"]] = max(done.get(detection["timestamp"], -1), detection["segment"])
+    return done
+
+
+def detect_segment(orca_model, source, sensor, ts, n, work_dir, audio_format="wav", sample_rate=48000):
+    """Fetches, decodes and runs the model on segment `n` of timestamp `ts`, returning its detection."""
+    input_ts = source.fetch(ts, n, work_dir)
+    output_file = path.join(work_dir, "live{}{}".format(n, audio_extension(audio_format)))
+    try:
+        convert_with_ffmpeg(input_ts, output_file, audio_format, sample_rate)
+        result_json = orca_model.predict(output_file)
+    finally:
+        for f in (output_file, input_ts if input_ts.startswith(work_dir) else None):
+            if f and path.exists(f):
+                os.remove(f)
+
+    return {
+        "sensor": sensor,
+        "timestamp": ts,
+        "segment": n,
+        "filename": "live{}.ts".format(n),
+        "global_prediction": int(result_json["global_prediction"]),
+        "global_confidence": float(result_json["global_confidence"]),
+        "local_predictions": result_json["local_predictions"],
+        "local_confidences": result_json["local_confidences"],
+    }
+
+
+def stream_detect(orca_model, source, sensor, output, poll_s=1.0, max_backlog=30, max_idle_s=None, work_dir=None, audio_format="wav", sample_rate=48000):
+    """
+    Tails the HLS stream of a sensor and appends one JSON line per segment to `output` as soon as
+    the segment is complete.
+
+    Only the newest timestamp is followed, when the stream restarts in a new timestamp the
+    remaining segments of the old one are processed first. Segments already in `output` are
+    skipped, so a restarted tail resumes where it stopped. When more than `max_backlog`
+    segments are waiting, the oldest ones are skipped so the latency stays bounded.
+
+    Args:
+        `orca_model`: The `OrcaDetectionModel` used for inference.
+        `source`: `LocalHLS` or `S3HLS` stream of the sensor.
+        `sensor`: Sensor name saved in the detections.
+        `output`: Path to the JSON lines detections file.
+        `poll_s`: Seconds between two polls of the stream when it is idle.
+        `max_backlog`: Number of waiting segments above which the oldest ones are skipped.
+        `max_idle_s`: Stop after this many seconds without a new segment. Default is to run forever.
+        `work_dir`: Directory for the fetched and decoded segments. Default is the system temporary directory.
+        `audio_format`: Format of the decoded audio, one of `wav`, `mono16` or `flac`.
+        `sample_rate`: Sample rate of the `mono16` and `flac` formats.
+    Returns:
+        None
+    """
+    done = completed_segments(output)
+    current, last_seen = None, time.time()
+    with tempfile.TemporaryDirectory(dir=work_dir) as segment_dir, open(output, "a+") as f:
+        # terminate a partial line from an interrupted run
+        if f.tell() > 0:
+            f.seek(f.tell() - 1)
+            if f.read(1) != "\n":
+                f.write("\n")
+        while True:
+            timestamps = source.timestamps()
+            if current is None and timestamps:
+                current = timestamps[-1]
+            newer = [ts for ts in timestamps if current is not None and ts > current]
+
+            pending, polled = [], time.time()
+            if current is not None:
+                first = done.get(current, -1) + 1
+                # a newer timestamp means this one is finished, its newest segment included
+                last = source.last_segment(current, finished=bool(newer))
+                if last - first + 1 > max_backlog:
+                    logging.warning(f"{last - first + 1} segments of {sensor}/{current} waiting, skipping to live{last - max_backlog + 1}.ts")
+                    first = last - max_backlog + 1
+                pending = list(range(first, last + 1))
+
+            for n in pending:
+                try:
+                    detection = detect_segment(orca_model, source, sensor, current, n, segment_dir, audio_format, sample_rate)
+                except Exception as e:
+                    logging.error(f"Segment {sensor}/{current}/live{n}.ts failed: {e}")
+                    done[current] = n
+                    continue
+                # from the end of the segment's upload to its detection
+                detection["latency_s"] = round(time.time() - (source.modified(current, n) or polled), 3)
+                f.write(json.dumps(detection) + "\n")
+                f.flush()
+                done[current] = n
+                telemetry.count("segments")
+
+            if pending:
+                last_seen = time.time()
+            elif newer:
+                logging.info(f"Stream of {sensor} moved to timestamp {newer[0]}")
+                current = newer[0]
+                last_seen = time.time()
+                continue
+            elif max_idle_s is not None and time.time() - last_seen > max_idle_s:
+                return
+            else:
+                time.sleep(poll_s)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(levelname)s:%(message)s", stream=sys.stdout, level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(
+        description="Runs the model on the live HLS segments of a sensor as they appear."
+    )
+    parser.add_argument(
+        "-i",
+        "--input-dir",
+        default=None,
+        help="Local root of the HLS streams, `<input-dir>/<sensor>/hls/<timestamp>/live<n>.ts`. Default is to read `--bucket`.",
+    )
+    parser.add_argument(
+        "-b",
+        "--bucket",
+        default="streaming-orcasound-net",
+        help="S3 bucket of the HLS streams when there is no `--input-dir`. Default is `streaming-orcasound-net`.",
+    )
+    parser.add_argument(
+        "-s",
+        "--sensor",
+        required=True,
+        help="Sensor to follow, e.g. `rpi_bush_point`.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="detections.jsonl",
+        help="Path to the detections file, one JSON line per segment is appended. Default is `detections.jsonl`.",
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        default="model.pkl",
+        help="Path to the model that will be used for inference. Default is `model.pkl`.",
+    )
+    parser.add_argument(
+        "-c",
+        "--cuda",
+        action="store_true",
+        help="Enable CUDA.",
+    )
+    parser.add_argument(
+        "-p",
+        "--poll",
+        type=float,
+        default=1.0,
+        help="Seconds between two polls of an idle stream. Default is %(default)s.",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=2.0,
+        help="Seconds after its last write a local segment is complete even if it is the newest one. Default is %(default)s.",
+    )
+    parser.add_argument(
+        "--max-backlog",
+        type=int,
+        default=30,
+        help="Number of waiting segments above which the oldest ones are skipped. Default is %(default)s.",
+    )
+    parser.add_argument(
+        "--max-idle",
+        type=float,
+        default=None,
+        help="Stop after this many seconds without a new segment. Default is to run forever.",
+    )
+    parser.add_argument(
+        "-w",
+        "--work-dir",
+        default=None,
+        help="Local directory for the fetched and decoded segments. Default is the system temporary directory.",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=["wav", "mono16", "flac"],
+        default="wav",
+        help="Format of the decoded audio: `wav` (ffmpeg defaults), `mono16` or `flac` (mono 16-bit at `--sample-rate`). Default is `wav`.",
+    )
+    parser.add_argument(
+        "-r",
+        "--sample-rate",
+        type=int,
+        default=48000,
+        help="Sample rate of the `mono16` and `flac` formats. Default is %(default)s.",
+    )
+    parser.add_argument(
+        "--metrics",
+        default=None,
+        help="Path to the JSON metrics sidecar. Default is a file in the directory of `$ORCASOUND_METRICS` if set, else no metrics.",
+    )
+    args = parser.parse_args()
+    telemetry.configure("stream_detect", args.metrics)
+
+    if args.input_dir:
+        source = LocalHLS(args.input_dir, args.sensor, args.settle)
+    else:
+        source = S3HLS(args.bucket, args.sensor)
+    orca_model = OrcaDetectionModel(args.model, use_cuda=args.cuda)
+    try:
+        stream_detect(orca_model, source, args.sensor, args.output, args.poll, args.max_backlog, args.max_idle, args.work_dir, args.format, args.sample_rate)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,154 @@
+"""
+Performance telemetry of the stage scripts
+
+Phases record wall and CPU time, counters record amounts of work (files, windows, bytes).
+`files` and `bytes_read` are the input files of the job, counted once by its first stage even
+when a fused job runs several stages in one process.
+Both are no-ops until `configure` enables the telemetry, with the `--metrics` argument of a
+script or the `ORCASOUND_METRICS` environment variable, and the metrics are written as a
+JSON sidecar when the job exits.
+
+"""
+
+import atexit
+import json
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_ENV = "ORCASOUND_METRICS"
+
+# counters reported per second of job wall time
+RATE_COUNTERS = ("files", "windows", "bytes_read", "bytes_written")
+
+
+def rusage_cpu(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Telemetry:
+    """Wall and CPU time per phase and counters of a job.
+
+    Phases can nest and run in threads, their times are inclusive and summed over calls.
+    The CPU time of a phase is the CPU time of its thread plus that of the child processes
+    (ffmpeg) that finished during the phase.
+    """
+
+    def __init__(self):
+        self.stage = None
+        self.input_stage = None
+        self.input_files = None
+        self.path = None
+        self.phases = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def configure(self, stage, metrics=None, input_stage=None):
+        """Enables the telemetry of a job.
+
+        Args:
+            `stage`: Name of the stage script, e.g. `inference`.
+            `metrics`: Path to the JSON sidecar. Default is `<stage>_<host>_<pid>.json` in the
+                directory of `ORCASOUND_METRICS`, and disabled if it is not set either.
+            `input_stage`: Stage reading the input files of the job, e.g. `convert2wav` for
+                `process_chunk`. Default is `stage`.
+        """
+        if metrics is None and os.environ.get(METRICS_ENV):
+            metrics = os.path.join(os.environ[METRICS_ENV], f"{stage}_{socket.gethostname()}_{os.getpid()}.json")
+        if metrics is None:
+            return
+
+        self.stage, self.input_stage, self.path = stage, input_stage or stage, metrics
+        self.start_time = time.time()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.start_children_cpu = rusage_cpu(resource.RUSAGE_CHILDREN)
+        atexit.register(self.write)
+
+    @contextmanager
+    def phase(self, name):
+        """Times the enclosed block as phase `name`."""
+        if not self.enabled:
+            yield
+            return
+
+        wall, cpu, children_cpu = time.perf_counter(), time.thread_time(), rusage_cpu(resource.RUSAGE_CHILDREN)
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu + rusage_cpu(resource.RUSAGE_CHILDREN) - children_cpu
+            with self.lock:
+                phase = self.phases.setdefault(name, {"wall_s": 0.0, "cpu_s": 0.0, "calls": 0})
+                phase["wall_s"] += wall
+                phase["cpu_s"] += cpu
+                phase["calls"] += 1
+
+    def count(self, name, value=1):
+        """Adds `value` to counter `name`."""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_inputs(self, files):
+        """Records the number of input files passed to the job, whether or not they are all processed."""
+        self.input_files = files
+
+    def count_input(self, stage, file_path=None):
+        """Counts an input file of `stage` in `files`, and its size in `bytes_read`.
+
+        Only the input stage of the job counts, so the intermediate files passed between the
+        stages of a fused job are not counted again.
+        """
+        if not self.enabled or stage != self.input_stage:
+            return
+        self.count("files")
+        if file_path is not None:
+            self.count_file("bytes_read", file_path)
+
+    def count_file(self, name, file_path):
+        """Adds the size of a file to counter `name`, e.g. `bytes_read`."""
+        if self.enabled and os.path.isfile(file_path):
+            self.count(name, os.path.getsize(file_path))
+
+    def metrics(self):
+        """Returns the metrics of the job so far."""
+        wall = time.perf_counter() - self.start_wall
+        return {
+            "stage": self.stage,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "argv": sys.argv,
+            "input_files": self.input_files,
+            "start_time": self.start_time,
+            "wall_s": wall,
+            "cpu_s": time.process_time() - self.start_cpu,
+            "children_cpu_s": rusage_cpu(resource.RUSAGE_CHILDREN) - self.start_children_cpu,
+            # kilobytes on Linux
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "children_peak_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            "phases": self.phases,
+            "counters": self.counters,
+            "rates": {f"{name}_per_s": self.counters[name] / wall for name in RATE_COUNTERS if name in self.counters and wall > 0},
+        }
+
+    def write(self):
+        """Writes the metrics to the sidecar."""
+        if not self.enabled:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(self.metrics(), f, indent=2)
+
+
+telemetry = Telemetry()
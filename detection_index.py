@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import json
+import sqlite3
+import numpy as np
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+
+# duration of a streaming segment and hop and length of the model windows in seconds
+SEGMENT_S = 10.0
+HOP_S = 2.45
+WINDOW_S = 2.45
+
+
+def run_lengths(predictions):
+    """Returns the start and end (exclusive) indices of the runs of 1 in a 0/1 array."""
+    edges = np.diff(np.concatenate(([0], np.asarray(predictions, dtype=np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def read_playlist(path, segment_s=SEGMENT_S):
+    """
+    Returns the start offsets in seconds of the segments `live<n>` of an HLS playlist, from their
+    #EXTINF durations. Segments the playlist does not list, e.g. those before the window of a live
+    playlist, are taken as `segment_s` long.
+    """
+    durations, duration = {}, None
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#EXTINF:"):
+                duration = float(line[len("#EXTINF:"):].split(",")[0])
+            elif line and not line.startswith("#") and duration is not None:
+                number = re.search(r"(\d+)", os.path.basename(line))
+                if number:
+                    durations[int(number.group(1))] = duration
+                duration = None
+    lengths = [durations.get(n, segment_s) for n in range(max(durations) + 1 if durations else 0)]
+    return np.concatenate(([0.0], np.cumsum(lengths)))
+
+
+def playlist_key(path):
+    """(sensor, timestamp) of a playlist at <sensor>/hls/<timestamp>/live.m3u8."""
+    parts = os.path.normpath(path).split(os.sep)
+    return parts[-4], parts[-2]
+
+
+def segment_offset(number, offsets=None, segment_s=SEGMENT_S):
+    """Start of segment `number` in seconds, from the playlist `offsets` and `segment_s` past them."""
+    if offsets is None or not len(offsets):
+        return number * segment_s
+    if number < len(offsets):
+        return float(offsets[number])
+    return float(offsets[-1]) + (number - len(offsets) + 1) * segment_s
+
+
+def window_times(timestamp, filename, result, segment_s=SEGMENT_S, hop_s=HOP_S, offsets=None):
+    """
+    Returns the absolute start times of the windows of a segment (or recording) result.
+
+    Windows start at `window_offsets_s` when the result has them (stitched and lossless results),
+    else every `hop_s`. Offsets of lossless results (with `offset_s`) are relative to the start of
+    the recording at `timestamp`, the others to the start of segment `live<n>`, read from the
+    playlist `offsets` of the timestamp or else `n * segment_s` after `timestamp`.
+    """
+    if "window_offsets_s" in result:
+        times = np.asarray(result["window_offsets_s"], dtype=np.float64)
+    else:
+        times = np.arange(len(result.get("local_predictions", []))) * hop_s
+    base = float(timestamp)
+    if "offset_s" not in result:
+        number = re.search(r"(\d+)", filename)
+        base += segment_offset(int(number.group(1)), offsets, segment_s) if number else 0
+    return base + times
+
+
+def result_events(times, result, window_s=WINDOW_S):
+    """
+    Collapses the consecutive positive windows of a result, starting at `times`, into events.
+
+    Returns:
+        Arrays of the absolute start and end times, windows and confidence sums and maxima of the events.
+    """
+    predictions = result.get("local_predictions", [])
+    starts, ends = run_lengths(predictions)
+    if not len(starts):
+        return [np.zeros(0)] * 5
+
+    confidences = np.asarray(result.get("local_confidences", [0.0] * len(predictions)), dtype=np.float64)
+    positive = np.where(np.asarray(predictions) == 1, confidences, 0.0)
+    sums = np.add.reduceat(positive, starts)
+    maxima = np.maximum.reduceat(positive, starts)
+    return times[starts], times[ends - 1] + window_s, (ends - starts).astype(np.float64), sums, maxima
+
+
+def segment_tail(segment_s=SEGMENT_S, hop_s=HOP_S, window_s=WINDOW_S):
+    """Seconds at the end of a segment not covered by a window, e.g. 0.2 for 4 windows of 2.45 in 10."""
+    if segment_s < window_s:
+        return 0.0
+    windows = int((segment_s - window_s) // hop_s) + 1
+    return max(0.0, segment_s - (windows - 1) * hop_s - window_s)
+
+
+def merge_events(start, end, windows, sums, maxima, max_gap_s=0.0):
+    """
+    Merges overlapping events, and events less than `max_gap_s` apart, e.g. the parts of an
+    event split by a segment boundary, which are apart by the uncovered tail of the segment.
+    """
+    if not len(start):
+        return start, end, windows, sums, maxima
+    order = np.argsort(start, kind="stable")
+    start, end, windows, sums, maxima = start[order], end[order], windows[order], sums[order], maxima[order]
+    # an event starts a new group when it starts after every earlier event has ended
+    new_group = np.concatenate(([True], start[1:] > np.maximum.accumulate(end)[:-1] + max_gap_s + 1e-6))
+    firsts = np.flatnonzero(new_group)
+    group_end = np.maximum.reduceat(end, firsts)
+    return start[firsts], group_end, np.add.reduceat(windows, firsts), np.add.reduceat(sums, firsts), np.maximum.reduceat(maxima, firsts)
+
+
+class DetectionIndex():
+    """
+    SQLite index of detection events, runs of consecutive positive windows, keyed by sensor
+    and absolute start time in seconds since the epoch.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=300)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS events (
+                sensor TEXT NOT NULL,
+                start REAL NOT NULL,
+                end REAL NOT NULL,
+                windows INTEGER NOT NULL,
+                mean_confidence REAL NOT NULL,
+                max_confidence REAL NOT NULL,
+                PRIMARY KEY (sensor, start)
+            ) WITHOUT ROWID""")
+        # longest event per sensor, bounds the range scan of a query on start
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sensors (
+                sensor TEXT PRIMARY KEY,
+                max_duration REAL NOT NULL
+            )""")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def index(self, predictions_files, segment_s=SEGMENT_S, hop_s=HOP_S, window_s=WINDOW_S, max_gap_s=None, playlists=None):
+        """
+        Indexes the events of merged predictions files ({sensor: {timestamp: [{wav: result}]}}).
+        Segments start at the offsets of their playlist in `playlists` ({(sensor, timestamp):
+        offsets}), else every `segment_s`. Events overlapping or less than `max_gap_s` apart are
+        merged, by default the longest uncovered tail of a segment so events are merged across
+        segment boundaries. The events in the time spans covered by the predictions are replaced,
+        so indexing predictions again also drops the events they no longer have.
+
+        Returns:
+            Number of indexed events.
+        """
+        playlists = playlists or {}
+        events, spans = {}, {}
+        for predictions_file in predictions_files:
+            with open(predictions_file, "r") as f:
+                predictions = json.load(f)
+            for sensor in predictions:
+                for timestamp in predictions[sensor]:
+                    offsets = playlists.get((sensor, str(timestamp)))
+                    for results in predictions[sensor][timestamp]:
+                        for filename, result in results.items():
+                            times = window_times(timestamp, filename, result, segment_s, hop_s, offsets)
+                            if not len(times):
+                                continue
+                            spans.setdefault(sensor, []).append((times[:1], times[-1:] + window_s))
+                            events.setdefault(sensor, []).append(result_events(times, result, window_s))
+
+        if max_gap_s is None:
+            durations = np.concatenate([[segment_s]] + [np.diff(offsets) for offsets in playlists.values()])
+            max_gap_s = max(segment_tail(duration, hop_s, window_s) for duration in np.unique(durations))
+        indexed = 0
+        with self.conn:
+            for sensor, sensor_events in events.items():
+                # replace the events of the covered spans, merged like the events
+                span_start, span_end = [np.concatenate(x) for x in zip(*spans[sensor])]
+                span_start, span_end = merge_events(span_start, span_end, *[np.zeros(len(span_start))] * 3, max_gap_s=max_gap_s)[:2]
+                self.conn.executemany("DELETE FROM events WHERE sensor = ? AND start < ? AND end > ?",
+                    zip([sensor] * len(span_start), span_end.tolist(), span_start.tolist()))
+                start, end, windows, sums, maxima = merge_events(*[np.concatenate(x) for x in zip(*sensor_events)], max_gap_s=max_gap_s)
+                if not len(start):
+                    continue
+                self.conn.executemany("INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?)",
+                    zip([sensor] * len(start), start.tolist(), end.tolist(), windows.astype(int).tolist(), np.round(sums / windows, 3).tolist(), np.round(maxima, 3).tolist()))
+                self.conn.execute("""
+                    INSERT INTO sensors VALUES (?, ?)
+                    ON CONFLICT(sensor) DO UPDATE SET max_duration = MAX(max_duration, excluded.max_duration)""", (sensor, float((end - start).max())))
+                indexed += len(start)
+        return indexed
+
+    def query(self, sensors, start, end, min_confidence=0.0):
+        """
+        Returns the events of `sensors` overlapping [start, end) with a mean confidence of at
+        least `min_confidence`, as (sensor, start, end, windows, mean_confidence, max_confidence).
+        """
+        events = []
+        for sensor in sensors:
+            row = self.conn.execute("SELECT max_duration FROM sensors WHERE sensor = ?", (sensor,)).fetchone()
+            if row is None:
+                continue
+            events.extend(self.conn.execute("""
+                SELECT * FROM events
+                WHERE sensor = ? AND start >= ? AND start < ? AND end > ? AND mean_confidence >= ?
+                ORDER BY start""", (sensor, start - row[0], end, start, min_confidence)))
+        return events
+
+    def sensors(self):
+        return [sensor for sensor, in self.conn.execute("SELECT sensor FROM sensors ORDER BY sensor")]
+
+
+def parse_time(value):
+    """Seconds since the epoch of an epoch or an ISO date (time), taken as UTC."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp()
+
+
+def format_time(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")[:-4]
+
+
+def main():
+    parser = ArgumentParser(description="Index orcasound detection events and query them by sensor and time")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = subparsers.add_parser("index", help="Index the events of merged predictions files.")
+    index_parser.add_argument("-d", "--database", metavar="INDEX_FILE", type=str, required=True, help="Path to the SQLite detection index.")
+    index_parser.add_argument("-i", "--input", metavar="INPUT_FILE", nargs='+', required=True, help="List of JSON files to be indexed.")
+    index_parser.add_argument("-p", "--playlists", metavar="PLAYLIST_FILE", nargs='+', default=[], help="HLS playlists <sensor>/hls/<timestamp>/live.m3u8 with the segment durations of the timestamps.")
+    index_parser.add_argument("--segment-seconds", metavar="FLOAT", type=float, default=SEGMENT_S, help="Duration of the streaming segments not in a playlist. Default is %(default)s.")
+    index_parser.add_argument("--hop-seconds", metavar="FLOAT", type=float, default=HOP_S, help="Hop between the windows of results without window offsets. Default is %(default)s.")
+    index_parser.add_argument("--window-seconds", metavar="FLOAT", type=float, default=WINDOW_S, help="Duration of a window. Default is %(default)s.")
+    index_parser.add_argument("--max-gap-seconds", metavar="FLOAT", type=float, default=None, help="Merge events at most this far apart. Default is the longest tail of a segment not covered by a window.")
+
+    query_parser = subparsers.add_parser("query", help="Print the events of a time range.")
+    query_parser.add_argument("-d", "--database", metavar="INDEX_FILE", type=str, required=True, help="Path to the SQLite detection index.")
+    query_parser.add_argument("-s", "--sensors", metavar="STR", nargs='+', default=None, help="Sensors to query. Default is every indexed sensor.")
+    query_parser.add_argument("--start", metavar="TIME", type=parse_time, required=True, help="Start of the range, epoch or UTC ISO date (example: '2021-03-01').")
+    query_parser.add_argument("--end", metavar="TIME", type=parse_time, required=True, help="End of the range (exclusive), epoch or UTC ISO date (example: '2021-04-01').")
+    query_parser.add_argument("--min-confidence", metavar="FLOAT", type=float, default=0.0, help="Minimum mean confidence of an event. Default is 0.")
+    query_parser.add_argument("--json", action="store_true", help="Print the events as JSON lines.")
+
+    args = parser.parse_args()
+
+    if args.command == "index":
+        if os.path.dirname(args.database):
+            os.makedirs(os.path.dirname(args.database), exist_ok=True)
+        index = DetectionIndex(args.database)
+        playlists = {playlist_key(playlist): read_playlist(playlist, args.segment_seconds) for playlist in args.playlists}
+        indexed = index.index(args.input, args.segment_seconds, args.hop_seconds, args.window_seconds, args.max_gap_seconds, playlists)
+        index.close()
+        print("Indexed {} events in {}".format(indexed, args.database))
+        return
+
+    if not os.path.isfile(args.database):
+        sys.exit("No detection index at {}".format(args.database))
+    index = DetectionIndex(args.database)
+    events = index.query(args.sensors or index.sensors(), args.start, args.end, args.min_confidence)
+    index.close()
+    keys = ["sensor", "start", "end", "windows", "mean_confidence", "max_confidence"]
+    for event in events:
+        if args.json:
+            print(json.dumps(dict(zip(keys, event))))
+        else:
+            print("{}  {}  {:8.2f}s  {:4d} windows  mean {:.3f}  max {:.3f}".format(event[0], format_time(event[1]), event[2] - event[1], event[3], event[4], event[5]))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,155 @@
 #!/usr/bin/env python3
 
+import os
 import pandas as pd
 import boto3
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from botocore import UNSIGNED
 from botocore.config import Config
-    
-def fetch_s3_catalog(bucket_name):
-    s3_cache = []
-    s3_client = boto3.client("s3", config=Config(signature_version=UNSIGNED))
+
+
+def parse_item(item):
+    splitted = item["Key"].split("/")
+    if len(splitted) < 4 or item["Size"] == 0:
+        print(item)
+        return None
+
+    try:
+        item["Sensor"] = splitted[0]
+        item["Protocol"] = splitted[1]
+        item["Timestamp"] = splitted[2]
+        item["Filename"] = splitted[3]
+        item["LastModified"] = item["LastModified"].timestamp()
+        item["ETag"] = item["ETag"].replace('"', '')
+    except Exception as e:
+        print(f"EXCEPTION: {e}")
+        print(f"EXCEPTION ON {item}")
+        return None
+
+    return item
+
+
+def list_prefixes(s3_client, bucket_name):
+    """Returns the top level prefixes (one per sensor) of the bucket."""
+    prefixes = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Delimiter="/"):
+        for prefix in page.get("CommonPrefixes", []):
+            prefixes.append(prefix["Prefix"])
+    return prefixes
+
+
+def resume_key(keys, from_directory=True):
+    """
+    Returns the key to resume a listing from, given the keys already in the catalog.
+
+    S3 lists keys lexicographically, so `live10.ts` sorts before `live9.ts` and a
+    directory that was still being written during the last refresh may receive keys
+    that sort before the last one we saw. With `from_directory` we therefore resume from
+    the start of the last known directory and rely on deduplication for the keys we list
+    again. Without it the listing resumes after the last key itself, for layouts whose new
+    keys always sort after the known ones (the dated recordings of the lossless bucket).
+    """
+    if len(keys) == 0:
+        return None
+    last_key = max(keys)
+    if not from_directory:
+        return last_key
+    if "/" not in last_key:
+        return None
+    return last_key.rsplit("/", 1)[0] + "/"
+
+
+def list_prefix(s3_client, bucket_name, prefix, start_after, parse=parse_item):
+    items = []
     paginator = s3_client.get_paginator("list_objects_v2")
-    page_iterator = paginator.paginate(Bucket=bucket_name)
-    counter = 0
-    for page in page_iterator:
-        for item in page["Contents"]:
-            splitted = item["Key"].split("/")
-            if len(splitted) < 4 or item["Size"] == 0:
-                print(item)
-                continue
-
-            try:
-                item["Sensor"] = splitted[0]
-                item["Protocol"] = splitted[1]
-                item["Timestamp"] = splitted[2]
-                item["Filename"] = splitted[3]
-                item["LastModified"] = item["LastModified"].timestamp()
-                item["ETag"] = item["ETag"].replace('"', '')
-            except Exception as e:
-                print(f"EXCEPTION: {e}")
-                print(f"EXCEPTION ON {item}")
-                continue
-
-            s3_cache.append(item)
-
-    s3_cache_df = pd.DataFrame(s3_cache)
-    s3_cache_df.to_csv("%s.csv" % bucket_name, index=False)
+    kwargs = {"Bucket": bucket_name, "Prefix": prefix}
+    if start_after:
+        kwargs["StartAfter"] = start_after
+    for page in paginator.paginate(**kwargs):
+        for item in page.get("Contents", []):
+            item = parse(item)
+            if item is not None:
+                items.append(item)
+    return items
+
+
+def merge_catalog(s3_cache_df, items):
+    """Merges newly listed objects into the catalog, keeping one row per key, from its latest listing."""
+    new_df = pd.DataFrame(items)
+    if s3_cache_df is None or s3_cache_df.empty:
+        merged = new_df
+    elif new_df.empty:
+        merged = s3_cache_df
+    else:
+        merged = pd.concat([s3_cache_df, new_df], ignore_index=True)
+
+    if merged.empty:
+        return merged
+
+    # a relisted object shows up again with the same ETag, a rewritten one with a new
+    # ETag. either way only the latest listing of the key is kept.
+    merged = merged.drop_duplicates(subset=["Key"], keep="last")
+    return merged.sort_values("Key").reset_index(drop=True)
+
+
+def fetch_s3_catalog(bucket_name, output=None, s3_client=None, prefixes=None, workers=8, full=False, parse=parse_item, resume_from_directory=True):
+    """
+    Refreshes the csv catalog of a bucket.
+
+    Every top level prefix (sensor) is listed concurrently. If a catalog already exists
+    each listing resumes from the last known directory of its prefix via `StartAfter`
+    (or after its last known key without `resume_from_directory`) and only new objects
+    are merged in. Objects added with keys sorting before that point are only found by
+    relisting everything with `full=True`.
+
+    Args:
+        `bucket_name`: Name of the S3 bucket.
+        `output`: Path to the csv catalog. Default is `<bucket_name>.csv`.
+        `s3_client`: botocore S3 client. Default is an unsigned boto3 client.
+        `prefixes`: Prefixes to list. Default is every top level prefix of the bucket.
+        `workers`: Number of concurrent listings.
+        `full`: Ignore the existing catalog and relist the bucket.
+        `parse`: Function that annotates a listed item, or returns None to skip it.
+        `resume_from_directory`: Resume from the start of the last known directory rather than after the last known key.
+    Returns:
+        The catalog as a DataFrame.
+    """
+    if output is None:
+        output = "%s.csv" % bucket_name
+    if s3_client is None:
+        s3_client = boto3.client("s3", config=Config(signature_version=UNSIGNED, max_pool_connections=max(workers, 10)))
+
+    s3_cache_df = None
+    if not full and os.path.isfile(output):
+        s3_cache_df = pd.read_csv(output)
+
+    if prefixes is None:
+        prefixes = list_prefixes(s3_client, bucket_name)
+
+    start_after = {}
+    for prefix in prefixes:
+        known_keys = []
+        if s3_cache_df is not None and not s3_cache_df.empty:
+            known_keys = s3_cache_df["Key"][s3_cache_df["Key"].str.startswith(prefix)]
+        start_after[prefix] = resume_key(known_keys, resume_from_directory)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        listings = executor.map(lambda p: list_prefix(s3_client, bucket_name, p, start_after[p], parse), prefixes)
+        items = [item for listing in listings for item in listing]
+
+    s3_cache_df = merge_catalog(s3_cache_df, items)
+    s3_cache_df.to_csv(output, index=False)
+    return s3_cache_df
+
 
 if __name__ == "__main__":
-    fetch_s3_catalog("streaming-orcasound-net")
+    parser = ArgumentParser(description="Fetch the Orcasound S3 catalog")
+    parser.add_argument("-b", "--bucket", metavar="STR", type=str, default="streaming-orcasound-net", help="S3 bucket (default: streaming-orcasound-net)")
+    parser.add_argument("-o", "--output", metavar="STR", type=str, default=None, help="Output csv (default: <bucket>.csv)")
+    parser.add_argument("-w", "--workers", metavar="INT", type=int, default=8, help="Concurrent prefix listings (default: 8)")
+    parser.add_argument("-f", "--full", action="store_true", help="Relist the whole bucket instead of refreshing the existing catalog")
+
+    args = parser.parse_args()
+    fetch_s3_catalog(args.bucket, output=args.output, workers=args.workers, full=args.full)
@@ -1,56 +1,44 @@
 #!/usr/bin/env python3
 
-import pandas as pd
-import boto3
-from botocore import UNSIGNED
-from botocore.config import Config
+from argparse import ArgumentParser
 from datetime import datetime
-    
-def fetch_s3_catalog(bucket_name):
-    s3_cache = []
-    s3_client = boto3.client("s3", config=Config(signature_version=UNSIGNED))
-    paginator = s3_client.get_paginator("list_objects_v2")
-    page_iterator = paginator.paginate(Bucket=bucket_name)
-    counter = 0
-    for page in page_iterator:
-        for item in page["Contents"]:
-            if item["Key"][-1] == "/":
-                item["Key"] = item["Key"][:-1]
-
-            splitted = item["Key"].split("/")
-            #if "test" in splitted:
-            #    if len(splitted) < 4:
-            #        print(item)
-            #        continue
-                    
-            #    item["Sensor"] = splitted[0]
-            #    item["Protocol"] = splitted[1]
-            #    temp_timestamp = splitted[3].split("_")
-            #    item["Timestamp"] = int(datetime.strptime(temp_timestamp[0]+"_"+temp_timestamp[1], "%Y-%m-%d_%H-%M-%S").timestamp())
-            #    item["Filename"] = splitted[3]
-            #    item["LastModified"] = int(item["LastModified"].timestamp())
-            #    item["ETag"] = item["ETag"].replace('"', '')
-            #else:
-            #if len(splitted) < 2:
-            #    print(item)
-            #    continue
-            
-            try:
-                item["Sensor"] = splitted[0]
-                item["Protocol"] = splitted[1] if len(splitted) == 3 else splitted[-1].split(".")[-1]
-                temp_timestamp = splitted[-1].split("_")
-                item["Timestamp"] = int(datetime.strptime(temp_timestamp[0]+"_"+temp_timestamp[1], "%Y-%m-%d_%H-%M-%S").timestamp())
-                item["Filename"] = splitted[-1]
-                item["LastModified"] = int(item["LastModified"].timestamp())
-                item["ETag"] = item["ETag"].replace('"', '')
-            except Exception:
-                print(item)
-                continue
-
-            s3_cache.append(item)
-
-    s3_cache_df = pd.DataFrame(s3_cache)
-    s3_cache_df.to_csv("%s.csv" % bucket_name, index=False)
+
+import fetch_s3_catalog as catalog
+
+
+def parse_item(item):
+    if item["Key"][-1] == "/":
+        item["Key"] = item["Key"][:-1]
+
+    splitted = item["Key"].split("/")
+
+    try:
+        item["Sensor"] = splitted[0]
+        item["Protocol"] = splitted[1] if len(splitted) == 3 else splitted[-1].split(".")[-1]
+        temp_timestamp = splitted[-1].split("_")
+        item["Timestamp"] = int(datetime.strptime(temp_timestamp[0]+"_"+temp_timestamp[1], "%Y-%m-%d_%H-%M-%S").timestamp())
+        item["Filename"] = splitted[-1]
+        item["LastModified"] = int(item["LastModified"].timestamp())
+        item["ETag"] = item["ETag"].replace('"', '')
+    except Exception:
+        print(item)
+        return None
+
+    return item
+
+
+def fetch_s3_catalog(bucket_name, **kwargs):
+    # recordings are written once and named by their start time, so new ones sort after the
+    # last known key, while the directory of that key is the whole sensor prefix
+    return catalog.fetch_s3_catalog(bucket_name, parse=parse_item, resume_from_directory=False, **kwargs)
+
 
 if __name__ == "__main__":
-    fetch_s3_catalog("archive-orcasound-net")
+    parser = ArgumentParser(description="Fetch the Orcasound lossless S3 catalog")
+    parser.add_argument("-b", "--bucket", metavar="STR", type=str, default="archive-orcasound-net", help="S3 bucket (default: archive-orcasound-net)")
+    parser.add_argument("-o", "--output", metavar="STR", type=str, default=None, help="Output csv (default: <bucket>.csv)")
+    parser.add_argument("-w", "--workers", metavar="INT", type=int, default=8, help="Concurrent prefix listings (default: 8)")
+    parser.add_argument("-f", "--full", action="store_true", help="Relist the whole bucket instead of refreshing the existing catalog")
+
+    args = parser.parse_args()
+    fetch_s3_catalog(args.bucket, output=args.output, workers=args.workers, full=args.full)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import sqlite3
+import hashlib
+import pandas as pd
+from argparse import ArgumentParser
+
+
+def hash_files(*paths):
+    """Returns the sha256 of the concatenated contents of the files."""
+    sha256 = hashlib.sha256()
+    for file_path in paths:
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(block)
+    return sha256.hexdigest()
+
+
+class ResultsLedger():
+    """
+    SQLite ledger of per segment inference results.
+
+    A result is valid for an S3 object as long as its ETag, the model and the
+    inference parameters are unchanged, so entries are keyed by all four.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=300)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT NOT NULL,
+                etag TEXT NOT NULL,
+                model_hash TEXT NOT NULL,
+                params_hash TEXT NOT NULL,
+                sensor TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                result TEXT NOT NULL,
+                PRIMARY KEY (key, etag, model_hash, params_hash)
+            )""")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def lookup(self, s3_files, model_hash, params_hash):
+        """
+        Returns the cached results for the rows of an S3 catalog DataFrame.
+
+        Returns:
+            Dictionary of S3 key to result.
+        """
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (key TEXT, etag TEXT)")
+        self.conn.execute("DELETE FROM wanted")
+        self.conn.executemany("INSERT INTO wanted VALUES (?, ?)", zip(s3_files["Key"], s3_files["ETag"].astype(str)))
+        rows = self.conn.execute("""
+            SELECT r.key, r.result FROM results r
+            JOIN wanted w ON r.key = w.key AND r.etag = w.etag
+            WHERE r.model_hash = ? AND r.params_hash = ?""", (model_hash, params_hash))
+        return {key: json.loads(result) for key, result in rows}
+
+    def record(self, manifest, predictions_files, model_hash, params_hash):
+        """
+        Records the results of merged predictions files.
+
+        Args:
+            `manifest`: DataFrame with the Key, ETag, Sensor, Timestamp and Filename of the processed segments.
+            `predictions_files`: Paths to predictions files ({sensor: {timestamp: [{wav: result}]}}).
+        Returns:
+            Number of recorded results.
+        """
+        segments = {}
+        for row in manifest.itertuples(index=False):
+            segments[(str(row.Sensor), str(row.Timestamp), os.path.splitext(row.Filename)[0])] = row
+
+        entries = []
+        for predictions_file in predictions_files:
+            with open(predictions_file, "r") as f:
+                predictions = json.load(f)
+            for sensor in predictions:
+                for timestamp in predictions[sensor]:
+                    for results in predictions[sensor][timestamp]:
+                        for wav_name, result in results.items():
+                            row = segments.get((sensor, timestamp, os.path.splitext(wav_name)[0]))
+                            if row is None:
+                                continue
+                            entries.append((row.Key, str(row.ETag), model_hash, params_hash, sensor, timestamp, row.Filename, json.dumps(result)))
+
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)", entries)
+        return len(entries)
+
+
+def main():
+    parser = ArgumentParser(description="Record orcasound predictions in the results ledger")
+    parser.add_argument("-l", "--ledger", metavar="LEDGER_FILE", type=str, required=True, help="Path to the SQLite ledger.")
+    parser.add_argument("-m", "--manifest", metavar="MANIFEST_FILE", type=str, required=True, help="CSV with the Key, ETag, Sensor, Timestamp and Filename of the processed segments.")
+    parser.add_argument("--model-hash", metavar="STR", type=str, required=True, help="Hash of the model used for the predictions.")
+    parser.add_argument("--params-hash", metavar="STR", type=str, required=True, help="Hash of the inference parameters used for the predictions.")
+    parser.add_argument("-i", "--input", metavar="INPUT_FILE", nargs='+', help="List of JSON files to be recorded.", required=True)
+
+    args = parser.parse_args()
+
+    ledger = ResultsLedger(args.ledger)
+    recorded = ledger.record(pd.read_csv(args.manifest), args.input, args.model_hash, args.params_hash)
+    ledger.close()
+    print("Recorded {} results in {}".format(recorded, args.ledger))
+
+
+if __name__ == "__main__":
+    main()
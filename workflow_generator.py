@@ -1,14 +1,24 @@
 #!/usr/bin/env python3
 
+import io
 import os
+import re
 import sys
+import json
+import math
+import shutil
+import hashlib
 import logging
 import tarfile
+import tempfile
 import requests
+import urllib3
 import numpy as np
 import pandas as pd
 from pathlib import Path
+from urllib.parse import quote
 from argparse import ArgumentParser
+from results_ledger import ResultsLedger, hash_files
 from datetime import datetime
 from datetime import timedelta
 
@@ -17,6 +27,77 @@ from datetime import timedelta
 # --- Import Pegasus API -----------------------------------------------------------
 from Pegasus.api import *
 
+class ResumableDownload(io.RawIOBase):
+    """
+    Read-only stream over an HTTP download.
+
+    If the connection drops, the download is resumed with a Range request from the
+    last byte received, so a consumer (e.g. a streaming tarfile) never sees the
+    interruption. The sha256 of every byte read is kept in `sha256`.
+    """
+    def __init__(self, url, headers=None, max_retries=5, timeout=60):
+        self.url = url
+        self.headers = headers or {}
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.offset = 0
+        self.size = None
+        self.sha256 = hashlib.sha256()
+        self.response = self._request()
+        self.status_code = self.response.status_code
+        self.etag = self.response.headers.get("ETag")
+        self.last_modified = self.response.headers.get("Last-Modified")
+        if self.status_code == 200 and "Content-Length" in self.response.headers:
+            self.size = int(self.response.headers["Content-Length"])
+
+    def _request(self):
+        headers = dict(self.headers)
+        if self.offset > 0:
+            headers["Range"] = "bytes={}-".format(self.offset)
+            # only resume if the file did not change under us
+            validator = self.etag or self.last_modified
+            if validator:
+                headers["If-Range"] = validator
+
+        response = requests.get(self.url, headers=headers, stream=True, timeout=self.timeout)
+        if self.offset > 0 and response.status_code != 206:
+            response.close()
+            raise ConnectionError("Resuming download for {} failed with error code: {}".format(self.url, response.status_code))
+        if self.offset == 0 and response.status_code not in (200, 304):
+            response.close()
+            raise ConnectionError("Download for {} failed with error code: {}".format(self.url, response.status_code))
+        return response
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        retries = 0
+        while True:
+            try:
+                data = self.response.raw.read(len(b))
+                if not data and self.size is not None and self.offset < self.size:
+                    raise ConnectionError("Download for {} ended at byte {} of {}".format(self.url, self.offset, self.size))
+                break
+            except (ConnectionError, OSError, requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+                retries += 1
+                if retries > self.max_retries:
+                    raise
+                print("Download interrupted ({}), resuming from byte {}...".format(e, self.offset))
+                self.response.close()
+                self.response = self._request()
+
+        n = len(data)
+        b[:n] = data
+        self.offset += n
+        self.sha256.update(data)
+        return n
+
+    def close(self):
+        self.response.close()
+        super().close()
+
+
 class OrcasoundWorkflow():
     wf = None
     sc = None
@@ -29,25 +110,97 @@ class OrcasoundWorkflow():
     shared_scratch_dir = None
     local_storage_dir = None
     wf_name = "orcasound"
+    sub_workflows_dir = "subworkflows"
+    cached_predictions_dir = "cached"
+    ledger_manifest_file = "ledger_manifest.csv"
     
     s3_cache = None
     s3_files = None
     s3_bucket = "streaming-orcasound-net"
     s3_cache_location = ".s3_cache"
     s3_cache_file = ".s3_cache/streaming-orcasound-net.csv"
-    s3_cache_xz = "streaming-orcasound-net.tar.xz"
+    s3_cache_meta = ".s3_cache/streaming-orcasound-net.tar.xz.json"
     s3_cache_xz_url = "https://workflow.isi.edu/Panorama/Data/Orcasound/streaming-orcasound-net.tar.xz"
+    s3_cache_xz_sha256 = None
+
+    # lossless recordings are hours long, they are streamed in chunks of chunk_seconds
+    lossless_bucket = "archive-orcasound-net"
+    lossless_cache_file = ".s3_cache/archive-orcasound-net.csv"
+    lossless_extensions = (".flac", ".wav")
+
+    # container images of the stage scripts, part of the ledger parameters hash
+    processing_image = "docker://papajim/orcasound-processing:latest"
+    ml_processing_image = "docker://papajim/orcasound-ml-processing:latest"
+
+    # timestamps smaller than this fraction of the byte budget are coalesced
+    min_job_fill = 0.5
+
+    # dry-run estimates per stage: CPU seconds per job and per input file, and bytes written
+    # per input file, rough figures for the streaming catalog and wav intermediates that
+    # `aggregate_metrics.py --coefficients` calibrates from the metrics of a past run
+    stage_coefficients = {
+        "convert2wav": {"job_cpu_s": 1.0, "file_cpu_s": 0.15, "file_output_bytes": 1920000},
+        "convert2spectrogram": {"job_cpu_s": 2.0, "file_cpu_s": 0.5, "file_output_bytes": 100000},
+        "inference": {"job_cpu_s": 5.0, "file_cpu_s": 1.0, "file_output_bytes": 300},
+        "process_chunk": {"job_cpu_s": 6.0, "file_cpu_s": 1.65, "file_output_bytes": 100300},
+        "merge": {"job_cpu_s": 0.5, "file_cpu_s": 0.01, "file_output_bytes": 20000},
+    }
+    # stages whose outputs are staged out to the local storage
+    staged_out_stages = ("convert2spectrogram", "process_chunk", "merge")
+    # stages clustered with --clustering
+    clustered_stages = ("convert2wav", "convert2spectrogram", "inference", "process_chunk")
+
+    # resource requests per transformation, memory and disk in MB scaled by the input files
+    # and the input MB (segment sizes in the catalog) of a job; rough figures for wav
+    # intermediates that `aggregate_metrics.py --resource-profile` calibrates from the
+    # metrics of a past run
+    resource_profiles = {
+        "convert2wav": {"cpus": 1, "memory_mb": 256, "memory_mb_per_file": 0.0, "disk_mb": 100, "disk_mb_per_file": 0.0, "disk_mb_per_input_mb": 13.0},
+        "convert2spectrogram": {"cpus": 1, "memory_mb": 512, "memory_mb_per_file": 0.0, "disk_mb": 100, "disk_mb_per_file": 2.1, "disk_mb_per_input_mb": 0.0},
+        "inference": {"cpus": 1, "memory_mb": 2048, "memory_mb_per_file": 0.05, "disk_mb": 200, "disk_mb_per_file": 2.0, "disk_mb_per_input_mb": 0.0},
+        "process_chunk": {"cpus": 1, "memory_mb": 2560, "memory_mb_per_file": 0.05, "disk_mb": 200, "disk_mb_per_file": 0.1, "disk_mb_per_input_mb": 13.0},
+        "merge": {"cpus": 1, "memory_mb": 256, "memory_mb_per_file": 0.1, "disk_mb": 100, "disk_mb_per_file": 0.05, "disk_mb_per_input_mb": 0.0},
+    }
     
     # --- Init ---------------------------------------------------------------------
-    def __init__(self, sensors, start_date, end_date, max_files, dagfile="workflow.yml"):
+    def __init__(self, sensors, start_date, end_date, max_files, dagfile="workflow.yml", refresh_s3_cache=False, s3_cache_sha256=None, job_bytes=None, fused=False, sub_workflows=None, sub_workflow_days=1, exec_site_name="condorpool", replica_mode="file", ledger=None, prefetch_workers=None, pack_spectrograms=False, audio_format="wav", stitch=False, catalog="streaming", chunk_seconds=600, max_recording_seconds=21600, metrics=False, resources=None, detection_index=None, clustering=None, cluster_size=10):
         self.dagfile = dagfile
         self.wf_dir = str(Path(__file__).parent.resolve())
         self.shared_scratch_dir = os.path.join(self.wf_dir, "scratch")
         self.local_storage_dir = os.path.join(self.wf_dir, "output")
         self.sensors = sensors
         self.max_files = max_files
+        self.job_bytes = job_bytes
+        self.fused = fused
+        self.sub_workflows = sub_workflows
+        self.sub_workflow_days = sub_workflow_days
+        self.sub_wfs = {}
+        self.exec_site_name = exec_site_name
+        self.replica_mode = replica_mode
+        self.ledger = ledger
+        self.prefetch_workers = prefetch_workers
+        self.pack_spectrograms = pack_spectrograms
+        self.audio_format = audio_format
+        self.stitch = stitch
+        self.catalog = catalog
+        self.chunk_seconds = chunk_seconds
+        self.max_recording_seconds = max_recording_seconds
+        self.metrics = metrics
+        self.resources = resources
+        self.detection_index = detection_index
+        self.clustering = clustering
+        self.cluster_size = cluster_size
+        self.cluster_counters = {}
+        if catalog == "lossless":
+            self.s3_bucket = self.lossless_bucket
+            self.s3_cache_file = self.lossless_cache_file
+        self.ledger_manifest = []
+        self.cached_results = {}
         self.start_date = int(start_date.timestamp())
         self.end_date = int(end_date.timestamp())
+        self.refresh_s3_cache = refresh_s3_cache
+        if s3_cache_sha256:
+            self.s3_cache_xz_sha256 = s3_cache_sha256
 
     
     # --- Write files in directory -------------------------------------------------
@@ -57,7 +210,11 @@ class OrcasoundWorkflow():
         self.props.write()
         self.rc.write()
         self.tc.write()
-        self.wf.write()
+        if self.sub_wfs:
+            os.makedirs(self.sub_workflows_dir, exist_ok=True)
+        for sub_wf_path, sub_wf in self.sub_wfs.items():
+            sub_wf.write(sub_wf_path)
+        self.wf.write(self.dagfile)
 
 
     # --- Configuration (Pegasus Properties) ---------------------------------------
@@ -65,6 +222,12 @@ class OrcasoundWorkflow():
         self.props = Properties()
 
         self.props["pegasus.transfer.threads"] = "16"
+
+        # sub-workflows are planned from their own directory, point them to our catalogs
+        if self.sub_workflows:
+            self.props["pegasus.catalog.site.file"] = os.path.abspath("sites.yml")
+            self.props["pegasus.catalog.replica.file"] = os.path.abspath("replicas.yml")
+            self.props["pegasus.catalog.transformation.file"] = os.path.abspath("transformations.yml")
         return
 
 
@@ -97,43 +260,89 @@ class OrcasoundWorkflow():
         
         orcasound_container = Container("orcasound_container",
             container_type = Container.SINGULARITY,
-            image="docker://papajim/orcasound-processing:latest",
+            image=self.processing_image,
             image_site="docker_hub"
         )
         
         orcasound_ml_container = Container("orcasound_ml_container",
             container_type = Container.SINGULARITY,
-            image="docker://papajim/orcasound-ml-processing:latest",
+            image=self.ml_processing_image,
             image_site="docker_hub"
         )
 
         # Add the orcasound processing
-        mkdir = Transformation("mkdir", site="local", pfn="/bin/mkdir", is_stageable=False)
+        ledger = Transformation("ledger", site="local", pfn=os.path.join(self.wf_dir, "results_ledger.py"), is_stageable=False)
+        detection_index = Transformation("detection_index", site="local", pfn=os.path.join(self.wf_dir, "detection_index.py"), is_stageable=False)
         convert2wav = Transformation("convert2wav", site=exec_site_name, pfn=os.path.join(self.wf_dir, "bin/convert2wav.py"), is_stageable=True, container=orcasound_container)
         convert2spectrogram = Transformation("convert2spectrogram", site=exec_site_name, pfn=os.path.join(self.wf_dir, "bin/convert2spectrogram.py"), is_stageable=True, container=orcasound_container)
         inference = Transformation("inference", site=exec_site_name, pfn=os.path.join(self.wf_dir, "bin/inference.py"), is_stageable=True, container=orcasound_ml_container)
+        process_chunk = Transformation("process_chunk", site=exec_site_name, pfn=os.path.join(self.wf_dir, "bin/process_chunk.py"), is_stageable=True, container=orcasound_ml_container)
         merge = Transformation("merge", site=exec_site_name, pfn=os.path.join(self.wf_dir, "bin/merge.py"), is_stageable=True, container=orcasound_container)
 
         
         self.tc.add_containers(orcasound_container, orcasound_ml_container)
-        self.tc.add_transformations(convert2wav, convert2spectrogram, inference, merge, mkdir)
+        # horizontal clustering runs `cluster_size` jobs of a transformation and level as one job
+        if self.clustering == "horizontal":
+            for transformation in (convert2wav, convert2spectrogram, inference, process_chunk):
+                transformation.add_pegasus_profiles(clusters_size=self.cluster_size)
+
+        self.tc.add_transformations(convert2wav, convert2spectrogram, inference, process_chunk, merge, ledger, detection_index)
 
     
     # --- Fetch s3 catalog ---------------------------------------------------------
     def fetch_s3_catalog(self):
+        """
+        Streams the catalog archive and unpacks it on the fly.
+
+        The download is never held in memory or written to disk as an archive. The
+        ETag/Last-Modified of the last download are kept next to the catalog, and the
+        download is skipped when the server reports that the local copy is current.
+        """
+        headers = {}
+        if os.path.isfile(self.s3_cache_file) and os.path.isfile(self.s3_cache_meta):
+            with open(self.s3_cache_meta, "r") as f:
+                meta = json.load(f)
+            if meta.get("ETag"):
+                headers["If-None-Match"] = meta["ETag"]
+            if meta.get("Last-Modified"):
+                headers["If-Modified-Since"] = meta["Last-Modified"]
+
         print("Downloading S3 cache...")
-        data = requests.get(self.s3_cache_xz_url)
-        if data.status_code != 200:
-            raise ConnectionError("Download for {} failed with error code: {}".format(self.s3_cache_xz_url, data.status_code))
+        download = ResumableDownload(self.s3_cache_xz_url, headers=headers)
+        if download.status_code == 304:
+            download.close()
+            print("S3 cache is up to date...")
+            return
+
+        # unpack next to the final location and move files in place only once the
+        # whole archive has been read and verified
+        unpack_dir = tempfile.mkdtemp(prefix=".s3_cache_", dir=".")
+        try:
+            print("Unpacking S3 cache...")
+            with tarfile.open(fileobj=download, mode="r|xz") as f:
+                f.extractall(unpack_dir)
+            # consume any trailing padding so the checksum covers the whole archive
+            while download.read(1 << 20):
+                pass
+            download.close()
 
-        with open(self.s3_cache_xz, "wb") as f:
-            f.write(data.content)
+            if self.s3_cache_xz_sha256 and download.sha256.hexdigest() != self.s3_cache_xz_sha256:
+                raise ValueError("Checksum mismatch for {}: expected {}, got {}".format(self.s3_cache_xz_url, self.s3_cache_xz_sha256, download.sha256.hexdigest()))
 
-        print("Unpacking S3 cache...")
-        with tarfile.open(self.s3_cache_xz) as f:
-            f.extractall('.')
+            for root, _, files in os.walk(unpack_dir):
+                for name in files:
+                    src = os.path.join(root, name)
+                    dst = os.path.relpath(src, unpack_dir)
+                    if os.path.dirname(dst):
+                        os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    os.replace(src, dst)
+        finally:
+            shutil.rmtree(unpack_dir, ignore_errors=True)
+
+        os.makedirs(os.path.dirname(self.s3_cache_meta), exist_ok=True)
+        with open(self.s3_cache_meta, "w") as f:
+            json.dump({"ETag": download.etag, "Last-Modified": download.last_modified, "sha256": download.sha256.hexdigest()}, f)
 
-        os.remove(self.s3_cache_xz)
         print("S3 cache fetched successfully...")
 
 
@@ -154,13 +363,30 @@ class OrcasoundWorkflow():
 
     # --- Read s3 catalog files ----------------------------------------------------
     def read_s3_cache(self):
-        if not os.path.isfile(self.s3_cache_file):
+        if self.refresh_s3_cache or not os.path.isfile(self.s3_cache_file):
+            if self.catalog == "lossless":
+                print("Lossless S3 cache not found, run: ./fetch_s3_catalog_lossless.py -o {}".format(self.s3_cache_file))
+                exit()
             self.fetch_s3_catalog()
         
         print("Reading S3 cache...")
         self.s3_cache = pd.read_csv(self.s3_cache_file)
+        if self.catalog == "lossless":
+            self.add_recording_durations()
         self.check_s3_cache()
 
+
+    def add_recording_durations(self):
+        """
+        Keeps the audio files of the lossless catalog and sets their Duration, the time
+        until the next recording of the sensor, capped by `max_recording_seconds`.
+        """
+        self.s3_cache = self.s3_cache[self.s3_cache["Filename"].str.lower().str.endswith(self.lossless_extensions)]
+        starts = self.s3_cache[["Sensor", "Timestamp"]].drop_duplicates().sort_values(["Sensor", "Timestamp"])
+        next_starts = starts.groupby("Sensor")["Timestamp"].shift(-1)
+        starts["Duration"] = (next_starts - starts["Timestamp"]).fillna(self.max_recording_seconds).clip(upper=self.max_recording_seconds)
+        self.s3_cache = self.s3_cache.merge(starts, on=["Sensor", "Timestamp"])
+
     
     # --- Replica Catalog ----------------------------------------------------------
     def create_replica_catalog(self):
@@ -173,121 +399,706 @@ class OrcasoundWorkflow():
         # Drop m3u8 files
         # self.s3_files = self.s3_files[~self.s3_files["Filename"].str.endswith(".m3u8")]
 
-        # Add s3 files as deep lfns
-        for f in self.s3_files["Key"]:
-            self.rc.add_replica("AmazonS3", f, "s3://george@amazon/{}/{}".format(self.s3_bucket, f))
+        # Add s3 files as deep lfns, prefetching jobs fetch them on their own
+        # and lossless recordings are streamed by the inference jobs
+        if not self.prefetch_workers and self.catalog == "streaming":
+            if self.replica_mode == "file":
+                for f in self.s3_files["Key"]:
+                    self.rc.add_replica("AmazonS3", f, "s3://george@amazon/{}/{}".format(self.s3_bucket, f))
+            else:
+                self.add_s3_regex_replicas()
+        elif self.detection_index and self.catalog == "streaming":
+            # the jobs fetch the segments on their own, the index job stages the playlists
+            for f in self.playlists():
+                self.rc.add_replica("AmazonS3", f, "s3://george@amazon/{}/{}".format(self.s3_bucket, f))
 
         # Add inference dependencies
         self.rc.add_replica("local", "model.py", os.path.join(self.wf_dir, "bin/model.py"))
         self.rc.add_replica("local", "dataloader.py", os.path.join(self.wf_dir, "bin/dataloader.py"))
         self.rc.add_replica("local", "params.py", os.path.join(self.wf_dir, "bin/params.py"))
+        self.rc.add_replica("local", "audio_io.py", os.path.join(self.wf_dir, "bin/audio_io.py"))
+        self.rc.add_replica("local", "telemetry.py", os.path.join(self.wf_dir, "bin/telemetry.py"))
         self.rc.add_replica("local", "model.pkl", os.path.join(self.wf_dir, "input/model.pkl"))
+
+        # Add spectrogram packing dependencies
+        if self.pack_spectrograms:
+            self.rc.add_replica("local", "spectrogram_archive.py", os.path.join(self.wf_dir, "bin/spectrogram_archive.py"))
+
+        # Add fused job dependencies
+        if self.fused:
+            self.rc.add_replica("local", "convert2wav.py", os.path.join(self.wf_dir, "bin/convert2wav.py"))
+            self.rc.add_replica("local", "convert2spectrogram.py", os.path.join(self.wf_dir, "bin/convert2spectrogram.py"))
+            self.rc.add_replica("local", "inference.py", os.path.join(self.wf_dir, "bin/inference.py"))
      
 
+    def add_s3_regex_replicas(self):
+        """
+        Registers the s3 files with one regular expression entry per directory
+        (`directory` mode) or per sensor (`sensor` mode), so the size of the replica
+        catalog scales with the number of directories instead of the number of files.
+        """
+        if self.replica_mode == "directory":
+            prefixes = self.s3_files["Key"].str.rsplit("/", n=1).str[0].unique()
+        else:
+            prefixes = self.s3_files["Sensor"].unique()
+
+        for prefix in sorted(prefixes):
+            self.rc.add_regex_replica("AmazonS3", "^{}/(.+)$".format(re.escape(prefix)), "s3://george@amazon/{}/{}/[1]".format(self.s3_bucket, prefix))
+
+
+    # --- Select segments ----------------------------------------------------------
+    def sensor_segments(self, sensor):
+        """
+        Yields (ts, files) for every timestamp of a sensor, with the files in stream order.
+        The playlist and the newest segment, which may still be written, are skipped.
+        Lossless timestamps are whole recordings and are yielded as is.
+        """
+        sensor_files = self.s3_files[self.s3_files["Sensor"] == sensor]
+        if self.catalog == "lossless":
+            yield from sensor_files.groupby("Timestamp", sort=True)
+            return
+
+        for ts, sensor_ts_files in sensor_files.groupby("Timestamp", sort=True):
+            sensor_ts_files = sensor_ts_files[sensor_ts_files["Filename"] != "live.m3u8"]
+            sensor_ts_files_len = len(sensor_ts_files.index)
+            # -2 if m3u8 in the list else -1
+            sensor_ts_files = sensor_ts_files[sensor_ts_files["Filename"] != "live{}.ts".format(sensor_ts_files_len-1)]
+            if sensor_ts_files.empty:
+                continue
+
+            segment_number = sensor_ts_files["Filename"].str.extract(r"(\d+)", expand=False).fillna(-1).astype(int)
+            yield ts, sensor_ts_files.iloc[np.argsort(segment_number.values, kind="stable")]
+
+
+    # --- Partition segments into jobs ---------------------------------------------
+    def split_by_size(self, files, num_of_splits):
+        """
+        Splits files into contiguous chunks of roughly equal total size. Chunks of more
+        than `max_files` files, a few large files next to many small ones, are split again.
+        """
+        sizes = files["Size"].values
+        midpoints = np.cumsum(sizes) - sizes / 2.0
+        bins = np.minimum((midpoints * num_of_splits // max(sizes.sum(), 1)).astype(int), num_of_splits - 1)
+        chunks = []
+        for _, job_files in files.groupby(bins, sort=True):
+            chunks.extend(np.array_split(job_files, -(-len(job_files.index)//self.max_files)))
+        return chunks
+
+
+    def partition_segments(self, segments):
+        """
+        Splits the (ts, files) groups of a sensor into jobs.
+
+        Every job is a list of (ts, files) parts. Without a byte budget each timestamp is
+        split in chunks of at most `max_files` files. With a byte budget each timestamp is
+        split in chunks of balanced size close to the budget, and timestamps too small to
+        fill a job on their own are coalesced with their neighbours.
+        """
+        if self.job_bytes is None:
+            for ts, files in segments:
+                num_of_splits = -(-len(files.index)//self.max_files)
+                for job_files in np.array_split(files, num_of_splits):
+                    yield [(ts, job_files)]
+            return
+
+        pending, pending_bytes, pending_files = [], 0, 0
+        for ts, files in segments:
+            ts_bytes = int(files["Size"].sum())
+            if ts_bytes < self.job_bytes * self.min_job_fill and len(files.index) < self.max_files:
+                if pending and (pending_bytes + ts_bytes > self.job_bytes or pending_files + len(files.index) > self.max_files):
+                    yield pending
+                    pending, pending_bytes, pending_files = [], 0, 0
+                pending.append((ts, files))
+                pending_bytes += ts_bytes
+                pending_files += len(files.index)
+                continue
+
+            if pending:
+                yield pending
+                pending, pending_bytes, pending_files = [], 0, 0
+
+            num_of_splits = max(-(-ts_bytes//self.job_bytes), -(-len(files.index)//self.max_files))
+            for job_files in self.split_by_size(files, num_of_splits):
+                yield [(ts, job_files)]
+
+        if pending:
+            yield pending
+
+
     # --- Create Workflow ----------------------------------------------------------
-    def create_workflow(self):
-        self.wf = Workflow(self.wf_name, infer_dependencies=True)
-        
+    def cluster_label(self, sensor, label):
+        """
+        Returns the label of the next chunk of a sensor. With label clustering the chunks of
+        a sensor are labeled in groups of `cluster_size`, and every group runs as one job.
+        """
+        if self.clustering != "label":
+            return label
+        index = self.cluster_counters.get(sensor, 0)
+        self.cluster_counters[sensor] = index + 1
+        return "{0}_cluster_{1}".format(sensor, index // self.cluster_size)
+
+
+    def add_chunk_jobs(self, wf, sensor, parts, part_counters):
+        """
+        Adds the convert2wav, convert2spectrogram and inference jobs of a chunk.
+
+        Returns:
+            List of (ts, predictions file) for every part of the chunk.
+        """
         model_py = File("model.py")
         dataloader_py = File("dataloader.py")
         params_py = File("params.py")
+        audio_io_py = File("audio_io.py")
         model_file = File("model.pkl")
+        audio_extension = ".flac" if self.audio_format == "flac" else ".wav"
 
-        # Create a job for each Sensor and Timestamp
-        predictions_files = []
-        for sensor in self.sensors:
-            predictions_sensor_files = []
-            for ts in self.s3_files[self.s3_files["Sensor"] == sensor]["Timestamp"].unique():
-                predictions_sensor_ts_files = []
-                sensor_ts_files = self.s3_files[(self.s3_files["Sensor"] == sensor) & (self.s3_files["Timestamp"] == ts) & (self.s3_files["Filename"] != "live.m3u8")]
-                sensor_ts_files_len = len(sensor_ts_files.index)
-                # -2 if m3u8 in the list else -1
-                sensor_ts_files = sensor_ts_files[sensor_ts_files["Filename"] != "live{}.ts".format(sensor_ts_files_len-1)]
-                sensor_ts_files_len -= 1
-
-                num_of_splits = -(-sensor_ts_files_len//self.max_files)
-
-                mkdir_job = (Job("mkdir", _id="scratch_mkdir_{0}_{1}".format(sensor, ts), node_label="scratch_mkdir_{0}_{1}".format(sensor, ts))
-                                .add_args("-p ${0}/png/{1}/{2} ${0}/wav/{1}/{2}".format("_PEGASUS_INITIAL_DIR", sensor, ts))
-                                .add_profiles(Namespace.SELECTOR, key="execution.site", value="local")
-                )
-                self.wf.add_jobs(mkdir_job)
-
-                counter = 1
-                for job_files in np.array_split(sensor_ts_files, num_of_splits):
-                    input_files = job_files["Key"]
-                    wav_files = []
-                    png_files = []
-                    for f in job_files["Filename"]:
-                        wav_files.append("wav/{0}/{1}/{2}".format(sensor, ts, f.replace(".ts", ".wav")))
-                        png_files.append("png/{0}/{1}/{2}".format(sensor, ts, f.replace(".ts", ".png")))
-                
-                    convert2wav_job = (Job("convert2wav", _id="wav_{0}_{1}_{2}".format(sensor, ts, counter), node_label="wav_{0}_{1}_{2}".format(sensor, ts, counter))
-                                        .add_args("-i {0}/hls/{1} -o wav/{0}/{1}".format(sensor, ts))
-                                        .add_inputs(*input_files, bypass_staging=True)
-                                        .add_outputs(*wav_files, stage_out=False, register_replica=False)
-                                        .add_pegasus_profiles(label="{0}_{1}_{2}".format(sensor, ts, counter))
-                                    )
-                    
-                    convert2spectrogram_job = (Job("convert2spectrogram", _id="png_{0}_{1}_{2}".format(sensor, ts, counter), node_label="spectrogram_{0}_{1}_{2}".format(sensor, ts, counter))
-                                        .add_args("-i wav/{0}/{1} -o png/{0}/{1}".format(sensor, ts))
-                                        .add_inputs(*wav_files)
-                                        .add_outputs(*png_files, stage_out=True, register_replica=False)
-                                        .add_pegasus_profiles(label="{0}_{1}_{2}".format(sensor, ts, counter))
-                                    )
-                    
-                    predictions = File("predictions_{0}_{1}_{2}.json".format(sensor, ts, counter))
-                    predictions_sensor_ts_files.append(predictions)
-                    inference_job = (Job("inference", _id="predict_{0}_{1}_{2}".format(sensor, ts, counter), node_label="inference_{0}_{1}_{2}".format(sensor, ts, counter))
-                                        .add_args("-i wav/{0}/{1} -s {0} -t {1} -m {3} -o predictions_{0}_{1}_{2}.json".format(sensor, ts, counter, model_file.lfn))
-                                        .add_inputs(model_file, model_py, dataloader_py, params_py, *wav_files)
-                                        .add_outputs(predictions, stage_out=False, register_replica=False)
-                                        .add_pegasus_profiles(label="{0}_{1}_{2}".format(sensor, ts, counter))
-                                    )
-                    
+        input_files = []
+        wav_files = []
+        png_files = []
+        hls_dirs = []
+        wav_dirs = []
+        png_dirs = []
+        timestamps = []
+        predictions = []
+        for ts, files in parts:
+            part_counters[ts] = part_counters.get(ts, 0) + 1
+            input_files.extend(files["Key"])
+            for f in files["Filename"]:
+                wav_files.append("wav/{0}/{1}/{2}".format(sensor, ts, f.replace(".ts", audio_extension)))
+                if not self.pack_spectrograms:
+                    png_files.append("png/{0}/{1}/{2}".format(sensor, ts, f.replace(".ts", ".png")))
+            hls_dirs.append("{0}/hls/{1}".format(sensor, ts))
+            wav_dirs.append("wav/{0}/{1}".format(sensor, ts))
+            if self.pack_spectrograms:
+                png_files.append("png/{0}/{1}/spectrograms_{2}.zip".format(sensor, ts, part_counters[ts]))
+                png_dirs.append(png_files[-1])
+            else:
+                png_dirs.append("png/{0}/{1}".format(sensor, ts))
+            timestamps.append(str(ts))
+            predictions.append((ts, File("predictions_{0}_{1}_{2}.json".format(sensor, ts, part_counters[ts]))))
 
-                    # Increase counter
-                    counter += 1
+        # a chunk is named after its first part
+        ts, counter = parts[0][0], part_counters[parts[0][0]]
+        label = self.cluster_label(sensor, "{0}_{1}_{2}".format(sensor, ts, counter))
+        input_bytes = sum(int(files["Size"].sum()) for _, files in parts)
 
-                    # Share files to jobs
-                    self.wf.add_jobs(convert2wav_job, convert2spectrogram_job, inference_job)
-                    self.wf.add_dependency(mkdir_job, children=[convert2wav_job, convert2spectrogram_job])
+        # packed spectrograms are written to one archive per part
+        pack_args = ""
+        pack_inputs = []
+        if self.pack_spectrograms:
+            pack_args = " --pack"
+            pack_inputs = [File("spectrogram_archive.py")]
 
-                #merge predictions for sensor timestamps
-                merged_predictions = File("predictions_{0}_{1}.json".format(sensor, ts))
-                predictions_sensor_files.append(merged_predictions)
-                merge_job_ts = (Job("merge", _id="merge_{0}_{1}".format(sensor, ts), node_label="merge_{0}_{1}".format(sensor, ts))
-                                    .add_args("-i {0} -o {1}".format(" ".join([x.lfn for x in predictions_sensor_ts_files]), merged_predictions.lfn))
-                                    .add_inputs(*predictions_sensor_ts_files)
-                                    .add_outputs(merged_predictions, stage_out=True, register_replica=False)
-                                    .add_pegasus_profiles(label="{0}_{1}".format(sensor, ts))
+        # with prefetching the jobs fetch their own inputs instead of the job wrapper
+        prefetch_args = ""
+        if self.prefetch_workers:
+            prefetch_args = " -b {0} --prefetch-workers {1} -k {2}".format(self.s3_bucket, self.prefetch_workers, " ".join(input_files))
+
+        format_args = " -f {0}".format(self.audio_format)
+        stitch_args = " --stitch" if self.stitch else ""
+
+        if self.fused:
+            process_chunk_job = (Job("process_chunk", _id="process_{0}_{1}_{2}".format(sensor, ts, counter), node_label="process_{0}_{1}_{2}".format(sensor, ts, counter))
+                                .add_args("-i {0} -p {1} -s {2} -t {3} -m {4} -o {5}{6}".format(" ".join(hls_dirs), " ".join(png_dirs), sensor, " ".join(timestamps), model_file.lfn, " ".join([x.lfn for _, x in predictions]), format_args + prefetch_args + pack_args + stitch_args))
+                                .add_inputs(model_file, model_py, dataloader_py, params_py, audio_io_py, File("convert2wav.py"), File("convert2spectrogram.py"), File("inference.py"), *pack_inputs)
+                                .add_outputs(*png_files, stage_out=True, register_replica=False)
+                                .add_outputs(*[x for _, x in predictions], stage_out=False, register_replica=False)
+                                .add_pegasus_profiles(label=label)
+                            )
+            if not self.prefetch_workers:
+                process_chunk_job.add_inputs(*input_files, bypass_staging=True)
+            # the inference results of completed files are transferred back when the job is
+            # evicted, the retry decodes the chunk again but skips them in inference
+            for _, x in predictions:
+                process_chunk_job.add_checkpoint(File("{0}.ckpt".format(x.lfn)), stage_out=False)
+
+            wf.add_jobs(self.add_resources(self.add_metrics(process_chunk_job), len(input_files), input_bytes))
+            return predictions
+
+        convert2wav_job = (Job("convert2wav", _id="wav_{0}_{1}_{2}".format(sensor, ts, counter), node_label="wav_{0}_{1}_{2}".format(sensor, ts, counter))
+                            .add_args("-i {0} -o {1}{2}".format(" ".join(hls_dirs), " ".join(wav_dirs), format_args + prefetch_args))
+                            .add_outputs(*wav_files, stage_out=False, register_replica=False)
+                            .add_pegasus_profiles(label=label)
+                        )
+        if not self.prefetch_workers:
+            convert2wav_job.add_inputs(*input_files, bypass_staging=True)
+
+        convert2spectrogram_job = (Job("convert2spectrogram", _id="png_{0}_{1}_{2}".format(sensor, ts, counter), node_label="spectrogram_{0}_{1}_{2}".format(sensor, ts, counter))
+                            .add_args("-i {0} -o {1}{2}".format(" ".join(wav_dirs), " ".join(png_dirs), pack_args))
+                            .add_inputs(audio_io_py, *wav_files, *pack_inputs)
+                            .add_outputs(*png_files, stage_out=True, register_replica=False)
+                            .add_pegasus_profiles(label=label)
+                        )
+
+        inference_job = (Job("inference", _id="predict_{0}_{1}_{2}".format(sensor, ts, counter), node_label="inference_{0}_{1}_{2}".format(sensor, ts, counter))
+                            .add_args("-i {0} -s {1} -t {2} -m {3} -o {4}{5}".format(" ".join(wav_dirs), sensor, " ".join(timestamps), model_file.lfn, " ".join([x.lfn for _, x in predictions]), stitch_args))
+                            .add_inputs(model_file, model_py, dataloader_py, params_py, audio_io_py, *wav_files)
+                            .add_outputs(*[x for _, x in predictions], stage_out=False, register_replica=False)
+                            .add_pegasus_profiles(label=label)
+                        )
+        # the results of completed files are transferred back when the job is evicted, and
+        # the retry skips them; the checkpoints exist from the start of the job
+        for _, x in predictions:
+            inference_job.add_checkpoint(File("{0}.ckpt".format(x.lfn)), stage_out=False)
+
+        wf.add_jobs(*[self.add_resources(self.add_metrics(job), len(input_files), input_bytes) for job in (convert2wav_job, convert2spectrogram_job, inference_job)])
+
+        return predictions
+
+
+    def add_recording_jobs(self, wf, sensor, ts, files):
+        """
+        Adds the inference jobs of a lossless recording, one per time-offset chunk of
+        `chunk_seconds`. The jobs stream their span from the bucket over https, so their
+        memory does not depend on the length of the recording.
+
+        Returns:
+            List of the chunk predictions files.
+        """
+        model_py = File("model.py")
+        dataloader_py = File("dataloader.py")
+        params_py = File("params.py")
+        audio_io_py = File("audio_io.py")
+        model_file = File("model.pkl")
+
+        predictions = []
+        for key, duration, size in zip(files["Key"], files["Duration"], files["Size"]):
+            url = "https://{0}.s3.amazonaws.com/{1}".format(self.s3_bucket, quote(key))
+            for offset in range(0, int(duration), self.chunk_seconds):
+                counter = len(predictions) + 1
+                chunk_predictions = File("predictions_{0}_{1}_{2}.json".format(sensor, ts, counter))
+                predictions.append(chunk_predictions)
+                inference_job = (Job("inference", _id="predict_{0}_{1}_{2}".format(sensor, ts, counter), node_label="inference_{0}_{1}_{2}".format(sensor, ts, counter))
+                                    .add_args("-u {0} --offset {1} --duration {2} -s {3} -t {4} -m {5} -o {6}".format(url, offset, min(self.chunk_seconds, int(duration) - offset), sensor, ts, model_file.lfn, chunk_predictions.lfn))
+                                    .add_inputs(model_file, model_py, dataloader_py, params_py, audio_io_py)
+                                    .add_outputs(chunk_predictions, stage_out=False, register_replica=False)
+                                    .add_pegasus_profiles(label=self.cluster_label(sensor, "{0}_{1}_{2}".format(sensor, ts, counter)))
                                 )
+                wf.add_jobs(self.add_resources(self.add_metrics(inference_job), 1, size * min(self.chunk_seconds, int(duration) - offset) / max(int(duration), 1)))
+
+        return predictions
 
-                self.wf.add_jobs(merge_job_ts)
+
+    def add_metrics(self, job):
+        """
+        Stages telemetry.py, imported by every stage script, and with `metrics` adds the
+        metrics sidecar of the job as an output staged out next to the predictions.
+        """
+        job.add_inputs(File("telemetry.py"))
+        if self.metrics:
+            sidecar = File("metrics_{0}.json".format(job._id))
+            job.add_args("--metrics {0}".format(sidecar.lfn))
+            job.add_outputs(sidecar, stage_out=True, register_replica=False)
+        return job
+
+
+    def add_resources(self, job, files, input_bytes=0):
+        """
+        Requests the cores, memory and disk of the job's transformation in `resources`,
+        scaled by the number of input files and input bytes of the job.
+        Pegasus turns them into the request_cpus, request_memory and request_disk of condor.
+        """
+        if self.resources is None or job.transformation not in self.resources:
+            return job
+        profile = self.resources[job.transformation]
+        input_mb = input_bytes / 2**20
+        job.add_pegasus_profiles(
+            cores=int(profile.get("cpus", 1)),
+            memory=int(math.ceil(profile.get("memory_mb", 0) + profile.get("memory_mb_per_file", 0) * files)),
+            diskspace=int(math.ceil(profile.get("disk_mb", 0) + profile.get("disk_mb_per_file", 0) * files + profile.get("disk_mb_per_input_mb", 0) * input_mb))
+        )
+        return job
+
+
+    def add_sensor_jobs(self, wf, sensor, segments):
+        """
+        Adds the jobs processing the (ts, files) segments of a sensor, and one merge job per timestamp.
+        Segments with a valid entry in the results ledger are not processed again, their
+        cached results are merged instead.
+
+        Returns:
+            List of the merged predictions files, one per timestamp.
+        """
+        predictions_sensor_ts_files = {}
+        if self.cached_results:
+            pending_segments = []
+            for ts, files in segments:
+                cached = files["Key"].isin(self.cached_results.keys())
+                if cached.any():
+                    predictions_sensor_ts_files[ts] = [self.write_cached_predictions(sensor, ts, files[cached])]
+                if not cached.all():
+                    pending_segments.append((ts, files[~cached]))
+        else:
+            pending_segments = segments
+
+        if self.catalog == "lossless":
+            for ts, files in pending_segments:
+                predictions_sensor_ts_files[ts] = self.add_recording_jobs(wf, sensor, ts, files)
+            pending_segments = []
+
+        # the stage scripts create their output directories
+        part_counters = {}
+        for parts in self.partition_segments(pending_segments):
+            for ts, predictions in self.add_chunk_jobs(wf, sensor, parts, part_counters):
+                predictions_sensor_ts_files.setdefault(ts, []).append(predictions)
+
+        #merge predictions for sensor timestamps
+        predictions_sensor_files = []
+        for ts, _ in segments:
+            merged_predictions = File("predictions_{0}_{1}.json".format(sensor, ts))
+            predictions_sensor_files.append(merged_predictions)
+            merge_job_ts = (Job("merge", _id="merge_{0}_{1}".format(sensor, ts), node_label="merge_{0}_{1}".format(sensor, ts))
+                                .add_args("-i {0} -o {1}".format(" ".join([x.lfn for x in predictions_sensor_ts_files[ts]]), merged_predictions.lfn))
+                                .add_inputs(*predictions_sensor_ts_files[ts])
+                                .add_outputs(merged_predictions, stage_out=True, register_replica=False)
+                                .add_pegasus_profiles(label="{0}_{1}".format(sensor, ts))
+                            )
+
+            wf.add_jobs(self.add_resources(self.add_metrics(merge_job_ts), len(predictions_sensor_ts_files[ts])))
+
+        #record the new results in the ledger
+        if self.ledger and pending_segments:
+            self.ledger_manifest.extend(files for _, files in pending_segments)
+            ledger_manifest = File(os.path.basename(self.ledger_manifest_file))
+            ledger_job = (Job("ledger", _id="ledger_{0}_{1}".format(sensor, pending_segments[0][0]), node_label="ledger_{0}_{1}".format(sensor, pending_segments[0][0]))
+                            .add_args("-l {0} -m {1} --model-hash {2} --params-hash {3} -i {4}".format(os.path.abspath(self.ledger), ledger_manifest.lfn, self.model_hash, self.params_hash, " ".join([x.lfn for x in predictions_sensor_files])))
+                            .add_inputs(ledger_manifest, *predictions_sensor_files)
+                            .add_profiles(Namespace.SELECTOR, key="execution.site", value="local")
+                        )
+            wf.add_jobs(ledger_job)
+
+        return predictions_sensor_files
+
+
+    # --- Results Ledger -----------------------------------------------------------
+    def read_ledger(self):
+        """Looks up the segments that were already processed with the same model and parameters."""
+        self.model_hash = hash_files(os.path.join(self.wf_dir, "input/model.pkl"))
+        # every stage script and the images they run in (decoding, resampling, scoring), the
+        # intermediate audio format and stitching change what the model sees
+        code_files = sorted(str(x) for x in Path(self.wf_dir, "bin").glob("*.py"))
+        code_hash = hash_files(*code_files)
+        self.params_hash = hashlib.sha256("{0}:{1}:{2}:{3}:{4}".format(code_hash, self.processing_image, self.ml_processing_image, self.audio_format, self.stitch).encode()).hexdigest()
+
+        print("Reading results ledger...")
+        ledger = ResultsLedger(self.ledger)
+        self.cached_results = ledger.lookup(self.s3_files, self.model_hash, self.params_hash)
+        ledger.close()
+        print("Found {} cached results...".format(len(self.cached_results)))
+
+
+    def write_cached_predictions(self, sensor, ts, files):
+        """Writes the cached results of a sensor timestamp as a predictions file and registers it."""
+        results = {}
+        for key, filename in zip(files["Key"], files["Filename"]):
+            results[filename.replace(".ts", ".flac" if self.audio_format == "flac" else ".wav")] = self.cached_results[key]
+
+        cached_predictions = File("predictions_{0}_{1}_cached.json".format(sensor, ts))
+        cached_predictions_path = os.path.join(os.path.abspath(self.cached_predictions_dir), cached_predictions.lfn)
+        os.makedirs(self.cached_predictions_dir, exist_ok=True)
+        with open(cached_predictions_path, "w") as f:
+            json.dump({sensor: {str(ts): [results]}}, f)
+
+        self.rc.add_replica("local", cached_predictions.lfn, cached_predictions_path)
+        return cached_predictions
+
+
+    def write_ledger_manifest(self):
+        """Writes the segments scheduled by this workflow, used by the ledger jobs to key their results."""
+        if not self.ledger_manifest:
+            return
+        manifest = pd.concat(self.ledger_manifest)[["Key", "ETag", "Sensor", "Timestamp", "Filename"]]
+        manifest.to_csv(self.ledger_manifest_file, index=False)
+        self.rc.add_replica("local", os.path.basename(self.ledger_manifest_file), os.path.abspath(self.ledger_manifest_file))
+
+
+    def sub_workflow_key(self, sensor, ts):
+        """Returns the name of the sub-workflow a (sensor, ts) segment group belongs to."""
+        day = (int(ts) - self.start_date) // (86400 * self.sub_workflow_days)
+        day = datetime.utcfromtimestamp(self.start_date + day * 86400 * self.sub_workflow_days).strftime("%Y-%m-%d")
+        if self.sub_workflows == "sensor":
+            return sensor
+        elif self.sub_workflows == "day":
+            return day
+        return "{0}_{1}".format(sensor, day)
+
+
+    def create_workflow(self):
+        if self.ledger:
+            self.read_ledger()
+
+        if self.sub_workflows:
+            self.create_hierarchical_workflow()
+        else:
+            self.create_flat_workflow()
+
+        if self.ledger:
+            self.write_ledger_manifest()
+
+
+    def playlists(self):
+        """Returns the keys of the HLS playlists of the selected streaming timestamps."""
+        return list(self.s3_files.loc[self.s3_files["Filename"] == "live.m3u8", "Key"])
+
+
+    def add_index_job(self, wf, predictions_files):
+        """
+        Adds the local job indexing the detection events of the merged predictions files. The
+        streaming segments are placed with the durations in the playlists of their timestamps.
+        """
+        playlists = [File(key) for key in self.playlists()] if self.catalog == "streaming" else []
+        playlist_args = " -p {0}".format(" ".join([x.lfn for x in playlists])) if playlists else ""
+        index_job = (Job("detection_index", _id="index_detections", node_label="index_detections")
+                        .add_args("index -d {0} -i {1}{2}".format(os.path.abspath(self.detection_index), " ".join([x.lfn for x in predictions_files]), playlist_args))
+                        .add_inputs(*predictions_files, *playlists)
+                        .add_profiles(Namespace.SELECTOR, key="execution.site", value="local")
+                    )
+        wf.add_jobs(index_job)
+
+
+    def create_flat_workflow(self):
+
+        self.wf = Workflow(self.wf_name, infer_dependencies=True)
+
+        # Create jobs for each Sensor, split by Timestamp
+        predictions_files = []
+        timestamp_files = []
+        for sensor in self.sensors:
+            predictions_sensor_files = self.add_sensor_jobs(self.wf, sensor, list(self.sensor_segments(sensor)))
+            timestamp_files.extend(predictions_sensor_files)
 
             #merge predictions for sensor if more than 1 files
             if len(predictions_sensor_files) > 1:
                 merged_predictions = File("predictions_{0}.json".format(sensor))
                 predictions_files.append(merged_predictions)
-                merge_job_sensor = (Job("merge", _id="merge_{0}".format(sensor, ts), node_label="merge_{0}".format(sensor, ts))
+                merge_job_sensor = (Job("merge", _id="merge_{0}".format(sensor), node_label="merge_{0}".format(sensor))
                                         .add_args("-i {0} -o {1}".format(" ".join([x.lfn for x in predictions_sensor_files]), merged_predictions.lfn))
                                         .add_inputs(*predictions_sensor_files)
                                         .add_outputs(merged_predictions, stage_out=True, register_replica=False)
                                         .add_pegasus_profiles(label="{0}".format(sensor))
                                     )
 
-                self.wf.add_jobs(merge_job_sensor)
+                self.wf.add_jobs(self.add_resources(self.add_metrics(merge_job_sensor), len(predictions_sensor_files)))
 
         #merge predictions for all sensors if more than 1 files
         if len(predictions_files) > 1:
             merged_predictions = File("predictions_all.json")
-            merge_job_all = (Job("merge", _id="merge_all".format(sensor, ts), node_label="merge_all".format(sensor, ts))
+            merge_job_all = (Job("merge", _id="merge_all", node_label="merge_all")
                                     .add_args("-i {0} -o {1}".format(" ".join([x.lfn for x in predictions_files]), merged_predictions.lfn))
                                     .add_inputs(*predictions_files)
                                     .add_outputs(merged_predictions, stage_out=True, register_replica=False)
                             )
 
-            self.wf.add_jobs(merge_job_all)
+            self.wf.add_jobs(self.add_resources(self.add_metrics(merge_job_all), len(predictions_files)))
+
+        # the timestamp merges cover every sensor, also those without a sensor merge
+        if self.detection_index:
+            self.add_index_job(self.wf, timestamp_files)
+
+
+    # --- Create Hierarchical Workflow ---------------------------------------------
+    def create_hierarchical_workflow(self):
+        """
+        Creates one sub-workflow per partition (sensor, day or sensor and day) and a
+        top level workflow that plans them and merges their predictions. Every
+        sub-workflow is planned on its own when it runs, so planning scales with
+        the partition rather than the whole date range. The replica catalog they
+        share holds regex entries, with one entry per file it would hold the range.
+        """
+        self.wf = Workflow(self.wf_name, infer_dependencies=True)
+
+        partitions = {}
+        for sensor in self.sensors:
+            for ts, files in self.sensor_segments(sensor):
+                partitions.setdefault(self.sub_workflow_key(sensor, ts), {}).setdefault(sensor, []).append((ts, files))
+
+        predictions_files = []
+        for key in sorted(partitions):
+            sub_wf = Workflow("{0}_{1}".format(self.wf_name, key), infer_dependencies=True)
+
+            predictions_partition_files = []
+            for sensor, segments in partitions[key].items():
+                predictions_partition_files.extend(self.add_sensor_jobs(sub_wf, sensor, segments))
+
+            merged_predictions = File("predictions_{0}.json".format(key))
+            predictions_files.append(merged_predictions)
+            merge_job_partition = (Job("merge", _id="merge_{0}".format(key), node_label="merge_{0}".format(key))
+                                    .add_args("-i {0} -o {1}".format(" ".join([x.lfn for x in predictions_partition_files]), merged_predictions.lfn))
+                                    .add_inputs(*predictions_partition_files)
+                                    .add_outputs(merged_predictions, stage_out=True, register_replica=False)
+                                    .add_pegasus_profiles(label="{0}".format(key))
+                                )
+            sub_wf.add_jobs(self.add_resources(self.add_metrics(merge_job_partition), len(predictions_partition_files)))
+
+            sub_wf_file = File("{0}_{1}.yml".format(self.wf_name, key))
+            self.sub_wfs[os.path.join(self.sub_workflows_dir, sub_wf_file.lfn)] = sub_wf
+            self.rc.add_replica("local", sub_wf_file.lfn, os.path.join(os.path.abspath(self.sub_workflows_dir), sub_wf_file.lfn))
+
+            cluster_args = ["--cluster", self.clustering] if self.clustering else []
+            sub_wf_job = (SubWorkflow(sub_wf_file, is_planned=False, _id="subwf_{0}".format(key), node_label="subwf_{0}".format(key))
+                            .add_args("--sites", self.exec_site_name, "--output-sites", "local", *cluster_args)
+                            .add_outputs(merged_predictions, stage_out=False, register_replica=False)
+                        )
+            self.wf.add_jobs(sub_wf_job)
+
+        #merge predictions for all partitions if more than 1 files
+        if len(predictions_files) > 1:
+            merged_predictions = File("predictions_all.json")
+            merge_job_all = (Job("merge", _id="merge_all", node_label="merge_all")
+                                    .add_args("-i {0} -o {1}".format(" ".join([x.lfn for x in predictions_files]), merged_predictions.lfn))
+                                    .add_inputs(*predictions_files)
+                                    .add_outputs(merged_predictions, stage_out=True, register_replica=False)
+                            )
+
+            self.wf.add_jobs(self.add_resources(self.add_metrics(merge_job_all), len(predictions_files)))
+
+        if self.detection_index:
+            self.add_index_job(self.wf, predictions_files)
+
+
+    # --- Dry Run ------------------------------------------------------------------
+    def plan_sensor_jobs(self, sensor, segments, add_job):
+        """
+        Counts the jobs `add_sensor_jobs` would add for the (ts, files) segments of a sensor,
+        calling `add_job(transformation, files)` for each of them.
+
+        Returns:
+            Number of merged predictions files, one per timestamp.
+        """
+        predictions_ts = {}
+        pending_segments = []
+        for ts, files in segments:
+            cached = files["Key"].isin(self.cached_results.keys())
+            if cached.any():
+                predictions_ts[ts] = 1
+            if not cached.all():
+                pending_segments.append((ts, files[~cached]))
+
+        if self.catalog == "lossless":
+            for ts, files in pending_segments:
+                for duration in files["Duration"]:
+                    for _ in range(-(-int(duration)//self.chunk_seconds)):
+                        add_job("inference", 1)
+                        predictions_ts[ts] = predictions_ts.get(ts, 0) + 1
+            pending_segments = []
+
+        for parts in self.partition_segments(pending_segments):
+            num_files = sum(len(files.index) for _, files in parts)
+            for stage in (["process_chunk"] if self.fused else ["convert2wav", "convert2spectrogram", "inference"]):
+                add_job(stage, num_files)
+            for ts, _ in parts:
+                predictions_ts[ts] = predictions_ts.get(ts, 0) + 1
+
+        for ts, _ in segments:
+            add_job("merge", predictions_ts.get(ts, 0))
+
+        if self.ledger and pending_segments:
+            add_job("ledger", len(segments))
+
+        return len(segments)
+
+
+    def plan(self, coefficients=None):
+        """
+        Plans the workflow from the S3 catalog without building any Pegasus object.
+
+        Returns:
+            Dictionary of the segments and bytes per sensor and day, the jobs and input files
+            per transformation, and the CPU hours, scratch and storage bytes estimated with
+            the per stage `coefficients` (default: `stage_coefficients`).
+        """
+        coefficients = coefficients or self.stage_coefficients
+        days = {}
+        transformations = {}
+
+        def add_job(transformation, files):
+            stage = transformations.setdefault(transformation, {"jobs": 0, "files": 0})
+            stage["jobs"] += 1
+            stage["files"] += files
+
+        partitions = {}
+        for sensor in self.sensors:
+            for ts, files in self.sensor_segments(sensor):
+                day = days.setdefault("{0} {1}".format(sensor, datetime.utcfromtimestamp(int(ts)).strftime("%Y-%m-%d")), {"segments": 0, "bytes": 0})
+                day["segments"] += len(files.index)
+                day["bytes"] += int(files["Size"].sum())
+                key = self.sub_workflow_key(sensor, ts) if self.sub_workflows else sensor
+                partitions.setdefault(key, {}).setdefault(sensor, []).append((ts, files))
+
+        def chunk_jobs():
+            # every chunk has one inference or process_chunk job
+            return sum(transformations.get(x, {"jobs": 0})["jobs"] for x in ("inference", "process_chunk"))
+
+        # merges of the sensors (or sub-workflows) and of everything, as in create_workflow
+        predictions_files = 0
+        label_clusters, sensor_chunks = 0, {}
+        for key in sorted(partitions):
+            predictions_partition_files = 0
+            for sensor, segments in partitions[key].items():
+                chunks = chunk_jobs()
+                predictions_partition_files += self.plan_sensor_jobs(sensor, segments, add_job)
+                chunks = chunk_jobs() - chunks
+                # cluster_label numbers the chunks of a sensor across the whole workflow, the
+                # chunks of a partition fall in the labels of their numbers
+                first = sensor_chunks.get(sensor, 0)
+                sensor_chunks[sensor] = first + chunks
+                if chunks:
+                    label_clusters += (first + chunks - 1)//self.cluster_size - first//self.cluster_size + 1
+            if self.sub_workflows or predictions_partition_files > 1:
+                add_job("merge", predictions_partition_files)
+                predictions_files += 1
+        if predictions_files > 1:
+            add_job("merge", predictions_files)
+        if self.detection_index:
+            add_job("detection_index", 0)
+
+        cpu_s, scratch_bytes, storage_bytes = 0.0, 0, 0
+        for transformation, stage in transformations.items():
+            if transformation not in coefficients:
+                continue
+            stage["cpu_s"] = stage["jobs"] * coefficients[transformation]["job_cpu_s"] + stage["files"] * coefficients[transformation]["file_cpu_s"]
+            stage["output_bytes"] = int(stage["files"] * coefficients[transformation]["file_output_bytes"])
+            cpu_s += stage["cpu_s"]
+            scratch_bytes += stage["output_bytes"]
+            if transformation in self.staged_out_stages:
+                storage_bytes += stage["output_bytes"]
+
+        # horizontal clusters are per transformation, label clusters hold every stage of
+        # `cluster_size` chunks of one sensor
+        clustered = [stage["jobs"] for transformation, stage in transformations.items() if transformation in self.clustered_stages]
+        nodes = sum(stage["jobs"] for stage in transformations.values()) - sum(clustered)
+        if self.clustering == "horizontal":
+            nodes += sum(-(-jobs//self.cluster_size) for jobs in clustered)
+        elif self.clustering == "label":
+            nodes += label_clusters
+        else:
+            nodes += sum(clustered)
+
+        return {
+            "days": days,
+            "transformations": transformations,
+            "dag_nodes": nodes,
+            "cached_segments": len(self.cached_results),
+            "cpu_hours": cpu_s / 3600,
+            "scratch_bytes": scratch_bytes,
+            "storage_bytes": storage_bytes,
+        }
+
+
+    def print_plan(self, plan):
+        print("Segments per sensor and day:")
+        for day, stats in sorted(plan["days"].items()):
+            print("    {:<32} {:>8} segments {:>10.2f} GB".format(day, stats["segments"], stats["bytes"] / 1e9))
+        if plan["cached_segments"]:
+            print("Segments cached in the results ledger: {}".format(plan["cached_segments"]))
+        print("Jobs per transformation:")
+        for transformation, stage in sorted(plan["transformations"].items()):
+            estimate = ""
+            if "cpu_s" in stage:
+                estimate = " {:>10.2f} CPU hours {:>10.2f} GB written".format(stage["cpu_s"] / 3600, stage["output_bytes"] / 1e9)
+            print("    {:<20} {:>8} jobs {:>10} files{}".format(transformation, stage["jobs"], stage["files"], estimate))
+        print("DAG nodes{}: {}".format(" after clustering" if self.clustering else "", plan["dag_nodes"]))
+        print("Estimated CPU hours: {:.2f}, scratch: {:.2f} GB, storage: {:.2f} GB".format(plan["cpu_hours"], plan["scratch_bytes"] / 1e9, plan["storage_bytes"] / 1e9))
 
 
 if __name__ == '__main__':
@@ -297,6 +1108,31 @@ if __name__ == '__main__':
     parser.add_argument("-e", "--execution-site-name", metavar="STR", type=str, default="condorpool", help="Execution site name (default: condorpool)")
     parser.add_argument("-o", "--output", metavar="STR", type=str, default="workflow.yml", help="Output file (default: workflow.yml)")
     parser.add_argument("-m", "--max-files", metavar="INT", type=int, default=200, help="Max files per job (default: 200)")
+    parser.add_argument("-b", "--job-bytes", metavar="INT", type=int, default=None, help="Pack segments into jobs of about this many input bytes, coalescing small timestamps (default: split by --max-files only)")
+    parser.add_argument("--job-runtime", metavar="FLOAT", type=float, default=None, help="Pack segments into jobs of about this many seconds, estimated with --throughput")
+    parser.add_argument("--throughput", metavar="FLOAT", type=float, default=32768, help="Estimated processing throughput in input bytes per second, used by --job-runtime (default: 32768)")
+    parser.add_argument("-f", "--fused", action="store_true", help="Run convert2wav, convert2spectrogram and inference of a chunk in a single job")
+    parser.add_argument("--sub-workflows", metavar="STR", type=str, choices=["sensor", "day", "sensor-day"], default=None, help="Generate one sub-workflow per partition [sensor, day, sensor-day] (default: single workflow)")
+    parser.add_argument("--sub-workflow-days", metavar="INT", type=int, default=1, help="Days per sub-workflow partition with --sub-workflows day or sensor-day (default: 1)")
+    parser.add_argument("--replica-mode", metavar="STR", type=str, choices=["file", "directory", "sensor"], default=None, help="Register S3 inputs one entry per file, or one regex entry per directory or per sensor [file, directory, sensor]. Sub-workflows share the replica catalog and require a regex mode (default: file, directory with --sub-workflows)")
+    parser.add_argument("-l", "--ledger", metavar="STR", type=str, default=None, help="SQLite results ledger. Segments already processed with the same ETag, model and parameters are not processed again")
+    parser.add_argument("-p", "--prefetch-workers", metavar="INT", type=int, default=None, help="Fetch the S3 inputs inside the jobs with this many concurrent downloads, overlapping fetching and decoding (default: staged by Pegasus)")
+    parser.add_argument("--pack-spectrograms", action="store_true", help="Stage out one spectrogram archive per job and timestamp instead of one png per segment")
+    parser.add_argument("-a", "--audio-format", metavar="STR", type=str, choices=["wav", "mono16", "flac"], default="wav", help="Intermediate audio format [wav, mono16, flac]. mono16 and flac are mono 16-bit at the model sample rate (default: wav)")
+    parser.add_argument("--stitch", action="store_true", help="Run inference on the segments of a timestamp as one continuous stream, windowing across segment boundaries")
+    parser.add_argument("--catalog", metavar="STR", type=str, choices=["streaming", "lossless"], default="streaming", help="S3 catalog to process [streaming, lossless]. Lossless recordings are streamed by the inference jobs in time-offset chunks (default: streaming)")
+    parser.add_argument("--chunk-seconds", metavar="INT", type=int, default=600, help="Seconds of a lossless recording per inference job (default: 600)")
+    parser.add_argument("--max-recording-seconds", metavar="INT", type=int, default=21600, help="Cap on the duration of a lossless recording, estimated from the start of the next one (default: 21600)")
+    parser.add_argument("--metrics", action="store_true", help="Stage out a JSON metrics sidecar per job, aggregated with aggregate_metrics.py")
+    parser.add_argument("--resource-profile", metavar="STR", type=str, default=None, help="JSON per transformation resource profile, written by aggregate_metrics.py --resource-profile. Jobs request cores, memory and disk scaled by their input files and bytes (default: no requests)")
+    parser.add_argument("--resource", metavar="STR", type=str, nargs="+", default=None, help="Override a value of the resource profile, e.g. inference.memory_mb=4096. Enables the requests with the built-in profile if --resource-profile is not set")
+    parser.add_argument("--clustering", metavar="STR", type=str, choices=["label", "horizontal"], default=None, help="Cluster the convert2wav, convert2spectrogram, inference and process_chunk jobs [label, horizontal]. label runs --cluster-size chunks of a sensor, every stage, as one job, horizontal runs --cluster-size jobs of a stage as one job. Plan with pegasus-plan --cluster <STR> (default: no clustering)")
+    parser.add_argument("--cluster-size", metavar="INT", type=int, default=10, help="Chunks per label cluster or jobs per horizontal cluster (default: 10)")
+    parser.add_argument("--detection-index", metavar="STR", type=str, default=None, help="SQLite detection index. A local job indexes the detection events of the merged predictions, queried with detection_index.py query")
+    parser.add_argument("--dry-run", action="store_true", help="Report the segments, jobs and estimated CPU hours and storage of the workflow without generating it")
+    parser.add_argument("--coefficients", metavar="STR", type=str, default=None, help="JSON per stage coefficients of the --dry-run estimates, written by aggregate_metrics.py --coefficients (default: built-in estimates)")
+    parser.add_argument("--refresh-s3-cache", action="store_true", help="Download the S3 cache again if the server has a newer copy")
+    parser.add_argument("--s3-cache-sha256", metavar="STR", type=str, default=None, help="Expected sha256 of the S3 cache archive")
     parser.add_argument("--sensors", metavar="STR", type=str, choices=["rpi_bush_point", "rpi_port_townsend", "rpi_orcasound_lab"], required=True, nargs="+", help="Sensor source [rpi_bush_point, rpi_port_townsend, rpi_orcasound_lab]")
     parser.add_argument("--start-date", metavar="STR", type=lambda s: datetime.strptime(s, '%Y-%m-%d'), required=True, help="Start date (example: '2021-08-10')")
     parser.add_argument("--end-date", metavar="STR", type=lambda s: datetime.strptime(s, '%Y-%m-%d'), default=None, help="End date (default: Start date + 1 day)")
@@ -304,9 +1140,43 @@ if __name__ == '__main__':
     args = parser.parse_args()
     if not args.end_date:
         args.end_date = args.start_date + timedelta(days=1)
+    # every sub-workflow is planned against the shared replica catalog, one entry per file
+    # of the whole range would make planning a partition scale with the range again
+    if args.replica_mode is None:
+        args.replica_mode = "directory" if args.sub_workflows else "file"
+    elif args.sub_workflows and args.replica_mode == "file":
+        parser.error("--sub-workflows requires --replica-mode directory or sensor")
+    if args.job_runtime and not args.job_bytes:
+        args.job_bytes = int(args.job_runtime * args.throughput)
+    if args.catalog == "lossless" and (args.fused or args.ledger or args.prefetch_workers or args.pack_spectrograms):
+        parser.error("--fused, --ledger, --prefetch-workers and --pack-spectrograms apply to the streaming catalog only")
+
+    resources = None
+    if args.resource_profile or args.resource:
+        resources = {transformation: dict(profile) for transformation, profile in OrcasoundWorkflow.resource_profiles.items()}
+        if args.resource_profile:
+            with open(args.resource_profile, "r") as f:
+                for transformation, profile in json.load(f).items():
+                    resources.setdefault(transformation, {}).update(profile)
+        for override in args.resource or []:
+            match = re.match(r"^(\w+)\.(\w+)=(\d+(\.\d+)?)$", override)
+            if not match or match.group(1) not in resources or match.group(2) not in resources[match.group(1)]:
+                parser.error("invalid --resource {}, expected TRANSFORMATION.KEY=VALUE with a key of the resource profile".format(override))
+            resources[match.group(1)][match.group(2)] = float(match.group(3))
     
-    workflow = OrcasoundWorkflow(sensors=args.sensors, start_date=args.start_date, end_date=args.end_date, max_files=args.max_files, dagfile=args.output)
-    
+    workflow = OrcasoundWorkflow(sensors=args.sensors, start_date=args.start_date, end_date=args.end_date, max_files=args.max_files, dagfile=args.output, refresh_s3_cache=args.refresh_s3_cache, s3_cache_sha256=args.s3_cache_sha256, job_bytes=args.job_bytes, fused=args.fused, sub_workflows=args.sub_workflows, sub_workflow_days=args.sub_workflow_days, exec_site_name=args.execution_site_name, replica_mode=args.replica_mode, ledger=args.ledger, prefetch_workers=args.prefetch_workers, pack_spectrograms=args.pack_spectrograms, audio_format=args.audio_format, stitch=args.stitch, catalog=args.catalog, chunk_seconds=args.chunk_seconds, max_recording_seconds=args.max_recording_seconds, metrics=args.metrics, resources=resources, detection_index=args.detection_index, clustering=args.clustering, cluster_size=args.cluster_size)
+
+    if args.dry_run:
+        coefficients = dict(workflow.stage_coefficients)
+        if args.coefficients:
+            with open(args.coefficients, "r") as f:
+                coefficients.update(json.load(f))
+        workflow.read_s3_cache()
+        if args.ledger:
+            workflow.read_ledger()
+        workflow.print_plan(workflow.plan(coefficients))
+        sys.exit(0)
+
     if not args.skip_sites_catalog:
         print("Creating execution sites...")
         workflow.create_sites_catalog(args.execution_site_name)
@@ -324,3 +1194,6 @@ if __name__ == '__main__':
     workflow.create_workflow()
 
     workflow.write()
+
+    if args.clustering and not args.sub_workflows:
+        print("Plan the workflow with: pegasus-plan --cluster {} ...".format(args.clustering))